@@ -0,0 +1,183 @@
+from argparse import ArgumentParser
+from typing import Any
+from collections.abc import Sequence
+from ampel.cli.AbsCoreCommand import AbsCoreCommand
+from ampel.cli.ArgParserBuilder import ArgParserBuilder
+from ampel.cli.AmpelArgumentParser import AmpelArgumentParser
+from ampel.core.AmpelContext import AmpelContext
+from ampel.log.AmpelLogger import AmpelLogger
+from ampel.log.LogFlag import LogFlag
+
+hlp = {
+	"index": "Verify (or create) the t0 indexes used by ZiMongoMuxer and ZiArchiveMuxer",
+	"catalog": "Convert a catalog file to a local copy usable by CatalogMatchUnit (see local_catalogs)",
+	"config": "Path to an ampel config file (yaml/json)",
+	"secrets": "Path to a YAML secrets store in sops format",
+	"create": "Create missing indexes",
+	"in": "Catalog file in any format readable by astropy.table.Table.read (fits, csv, ecsv, hdf5...)",
+	"out": "Directory of local catalogs; the copy is written to a subdirectory named after the catalog",
+	"name": "Catalog name, as used in cone search requests",
+	"ra-key": "Column holding the right ascension in degrees (default: ra)",
+	"dec-key": "Column holding the declination in degrees (default: dec)",
+	"columns": "Columns to include (default: all)",
+	"order": "HEALPix order of the partitions, nside = 2**order (default: 5)",
+	"backtest": "Run an alert filter with one or more parameter sets over archived alerts, in parallel",
+	"unit": "Fully qualified name of the filter unit, e.g. ampel.ztf.t0.DecentFilter",
+	"params": "YAML/JSON file with the filter config, or with a top-level 'sets' key mapping parameter set name to config",
+	"alerts": "Alert tarballs, avro files or directories of avro files",
+	"processes": "Number of worker processes (default: number of CPUs, 0: no pool)",
+	"shards": "Number of shards each alert source is split into (default: 1)",
+	"catalogmatch": "URL of catalogmatch-service",
+	"offline": "Answer cone searches with no match instead of querying catalogmatch-service",
+	"batch-size": "Pass alerts to process_many in batches of this size if the filter implements it",
+	"report": "Write the full reports, including accepted candids, to this JSON file",
+	"debug": "Debug",
+}
+
+
+class ZTFCommand(AbsCoreCommand):
+
+	def __init__(self):
+		self.parsers = {}
+
+	# Mandatory implementation
+	def get_parser(self, sub_op: None | str = None) -> ArgumentParser | AmpelArgumentParser:
+
+		if sub_op in self.parsers:
+			return self.parsers[sub_op]
+
+		sub_ops = ["index", "catalog", "backtest"]
+		if sub_op is None or sub_op not in sub_ops:
+			return AmpelArgumentParser.build_choice_help(
+				"ztf", sub_ops, hlp, description = "ZTF-specific maintenance operations"
+			)
+
+		builder = ArgParserBuilder("ztf")
+		builder.add_parsers(sub_ops, hlp)
+		builder.notation_add_note_references()
+		builder.notation_add_example_references()
+
+		builder.add_arg("index.required", "config")
+		builder.add_arg("index.optional", "secrets")
+		builder.add_arg("optional", "debug", action="store_true")
+		builder.add_arg("index.optional", "create", action="store_true")
+
+		builder.add_arg("catalog.required", "in")
+		builder.add_arg("catalog.required", "out")
+		builder.add_arg("catalog.required", "name")
+		builder.add_arg("catalog.optional", "ra-key", default="ra")
+		builder.add_arg("catalog.optional", "dec-key", default="dec")
+		builder.add_arg("catalog.optional", "columns", nargs="+", default=None)
+		builder.add_arg("catalog.optional", "order", type=int, default=5)
+
+		builder.add_arg("backtest.required", "unit")
+		builder.add_arg("backtest.required", "params")
+		builder.add_arg("backtest.required", "alerts", nargs="+")
+		builder.add_arg("backtest.optional", "processes", type=int, default=None)
+		builder.add_arg("backtest.optional", "shards", type=int, default=1)
+		builder.add_arg("backtest.optional", "catalogmatch", default=None)
+		builder.add_arg("backtest.optional", "offline", action="store_true")
+		builder.add_arg("backtest.optional", "batch-size", type=int, default=0)
+		builder.add_arg("backtest.optional", "report", default=None)
+
+		builder.add_example("index", "-config ampel_conf.yaml")
+		builder.add_example("index", "-config ampel_conf.yaml -create")
+		builder.add_example(
+			"catalog",
+			"-in gaia_dr2.fits -out /data/catalogs -name GAIADR2 -ra-key RA -dec-key Dec "
+			"-columns Mag_G PMRA ErrPMRA PMDec ErrPMDec Plx ErrPlx ExcessNoiseSig"
+		)
+		builder.add_example(
+			"backtest",
+			"-unit ampel.ztf.t0.DecentFilter -params decentfilter_params.yaml "
+			"-alerts /data/ztf_public_2021*.tar.gz -processes 16 -shards 4 -offline"
+		)
+
+		self.parsers.update(
+			builder.get()
+		)
+
+		return self.parsers[sub_op]
+
+
+	# Mandatory implementation
+	def run(self, args: dict[str, Any], unknown_args: Sequence[str], sub_op: None | str = None) -> None:
+
+		if sub_op == "catalog":
+			import os
+			from astropy.table import Table
+			from ampel.ztf.base.LocalCatalog import build_local_catalog
+			catalog = build_local_catalog(
+				Table.read(args["in"]),
+				os.path.join(args["out"], args["name"]),
+				args["name"],
+				ra_key = args["ra_key"],
+				dec_key = args["dec_key"],
+				columns = args["columns"],
+				order = args["order"],
+			)
+			print(f"Wrote {len(catalog)} sources to {catalog.path}")
+			return
+
+		if sub_op == "backtest":
+			self.run_backtest(args)
+			return
+
+		ctx: AmpelContext = self.get_context(args, unknown_args)
+		logger = AmpelLogger.from_profile(
+			ctx, 'console_debug' if args['debug'] else 'console_info',
+			base_flag = LogFlag.MANUAL_RUN
+		)
+
+		if sub_op == "index":
+			from ampel.ztf.ingest.indexes import ensure_t0_indexes, get_index_id
+			if missing := ensure_t0_indexes(
+				ctx.db.get_collection("t0", "w"), logger, create=args["create"]
+			):
+				raise SystemExit(
+					"Missing t0 indexes: " + ", ".join(get_index_id(idx["index"]) for idx in missing)
+				)
+
+
+	@staticmethod
+	def run_backtest(args: dict[str, Any]) -> None:
+
+		import json, yaml
+		from ampel.ztf.dev.FilterBacktest import run_backtest
+
+		with open(args["params"]) as f:
+			params = yaml.safe_load(f)
+		# a single config, or parameter set name -> config under "sets"
+		params = params["sets"] if "sets" in params else {"default": params}
+
+		reports = run_backtest(
+			args["unit"],
+			params,
+			args["alerts"],
+			processes = args["processes"],
+			shards_per_source = args["shards"],
+			resource = {"ampel-ztf/catalogmatch": args["catalogmatch"]} if args["catalogmatch"] else None,
+			offline = args["offline"],
+			batch_size = args["batch_size"],
+		)
+
+		for name, report in reports.items():
+			print(
+				f"{name}: {report['accepted']}/{report['alerts']} alerts accepted, "
+				f"{report['rate']:.0f} alerts/s filter time, "
+				f"{report['alerts'] / report['elapsed']:.0f} alerts/s wall clock"
+			)
+			if report["truncated"]:
+				print(f"  {report['truncated']} alert packets could not be decoded to the end")
+			for cut, stats in report["cuts"].items():
+				if stats["evaluated"]:
+					print(
+						f"  {cut:<16} {stats['evaluated']:>9} evaluated "
+						f"{stats['acceptance']:>8.2%} accepted {stats['seconds']:>9.3f} s"
+					)
+			for reason, count in sorted(report["rejected"].items(), key=lambda kv: -kv[1]):
+				print(f"  rejected on {reason}: {count}")
+
+		if args["report"]:
+			with open(args["report"], "w") as f:
+				json.dump(reports, f, indent=1)
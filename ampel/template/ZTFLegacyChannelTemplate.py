@@ -40,6 +40,10 @@ class ZTFLegacyChannelTemplate(AbsEasyChannelTemplate):
 	live_history: bool = True
 	#: include X days of archival datapoints in emitted states
 	archive_history: None | int = None
+	#: skip archive requests for intervals already covered. Only honored when
+	#: live_history is enabled, since ZiMongoMuxer then supplies the skipped
+	#: archival points from t0.
+	archive_track_coverage: bool = False
 
 	# Mandatory implementation
 	def get_channel(self, logger: AmpelLogger) -> dict[str, Any]:
@@ -75,8 +79,11 @@ class ZTFLegacyChannelTemplate(AbsEasyChannelTemplate):
 			else None
 		)
 		if mongo_muxer and archive_muxer:
+			if self.archive_track_coverage:
+				# archival points already in t0 are supplied by ZiMongoMuxer
+				archive_muxer["config"]["track_coverage"] = True
 			muxer: None | dict[str,Any] = {
-				"unit": "ChainedT0Muxer",
+				"unit": "ZiChainedT0Muxer",
 				"config": {"muxers": [mongo_muxer, archive_muxer]},
 			}
 		elif mongo_muxer:
@@ -0,0 +1,79 @@
+from collections.abc import Callable, Hashable
+from threading import local
+from typing import Any, TypeVar
+
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+
+stat_lookups = AmpelMetricsRegistry.counter(
+    "alert_cache_lookups",
+    "Number of lookups in the alert-scoped cache of filter computations",
+    subsystem="alertfilter",
+    labelnames=("outcome",),
+)
+
+T = TypeVar("T")
+
+
+class AlertCache(local):
+    """
+    Cache of quantities derived from the alert being filtered, e.g. its
+    galactic latitude or catalog matches, shared by the filter units of a
+    process. With the channels of a process merged into one AlertConsumer
+    (see ZTFAlertStreamController.merge_processes), the filter of each
+    channel receives the same alert in turn, so the first filter computes
+    a quantity and the following ones reuse it.
+
+    Filters call :meth:`enter` with the alert before using the cache; the
+    cached values are dropped as soon as a different alert is entered.
+    Keys must include everything the value depends on (position, catalog
+    request, ...), as the cache is also reachable outside of a filter's
+    process method.
+
+    The cache holds the values of a single alert, relying on the filters
+    sharing it to process one alert after the other in the same thread, as
+    AlertConsumer does. Its state is thread-local, so that filters running
+    in other threads (e.g. a T0 process per thread) each get their own scope
+    instead of dropping each other's values; it is not shared across threads.
+    Batched processing (DecentFilter.process_many) does not use the cache.
+    """
+
+    def __init__(self) -> None:
+        self._alert: Any = None
+        self._values: dict[Hashable, Any] = {}
+
+    def enter(self, alert: Any) -> None:
+        """
+        scope the cache to alert, dropping the values of the previous one
+        """
+        if alert is not self._alert:
+            self._alert = alert
+            self._values = {}
+
+    def lookup(self, key: Hashable) -> tuple[bool, Any]:
+        """
+        :returns: (found, value)
+        """
+        if key in self._values:
+            stat_lookups.labels("hit").inc()
+            return True, self._values[key]
+        stat_lookups.labels("miss").inc()
+        return False, None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._values[key] = value
+
+    def get(self, key: Hashable, compute: Callable[[], T]) -> T:
+        """
+        :returns: the cached value of key, computing it on first use
+        """
+        found, value = self.lookup(key)
+        if not found:
+            value = self._values[key] = compute()
+        return value
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+
+#: the cache shared by all filter units of the process
+alert_cache = AlertCache()
@@ -7,10 +7,15 @@
 # Last Modified Date:  24.11.2021
 # Last Modified By:    Jakob van Santen <jakob.van.santen@desy.de>
 
-from typing import Literal, Any, cast
+import atexit, json
+from functools import cached_property
+from typing import Literal, Any, Union, cast
 
 from ampel.abstract.AbsAlertFilter import AbsAlertFilter
+from ampel.ztf.base.AlertCache import alert_cache
 from ampel.ztf.base.CatalogMatchUnit import CatalogMatchUnit, ConeSearchRequest
+from ampel.ztf.base.ConeSearchGuard import ConeSearchUnavailable
+from ampel.ztf.base.RejectionStats import RejectionStats, close_at_exit
 from ampel.protocol.AmpelAlertProtocol import AmpelAlertProtocol
 from ampel.model.operator.AnyOf import AnyOf
 from ampel.model.operator.AllOf import AllOf
@@ -31,6 +36,10 @@ class ExtcatsMatchRequest(BaseCatalogMatchRequest):
 
 CatalogMatchRequest = BaseCatalogMatchRequest | ExtcatsMatchRequest
 
+#: A condition compiled by CatalogMatchFilter: the index of a catalog request,
+#: or a logical operator applied to sub-clauses
+Clause = Union[int, tuple[Literal["all", "any"], list["Clause"]]]
+
 
 class CatalogMatchFilter(CatalogMatchUnit, AbsAlertFilter):
     """
@@ -39,38 +48,123 @@ class CatalogMatchFilter(CatalogMatchUnit, AbsAlertFilter):
     against a set of catalogs. An alert will be accepted if accept condition is
     either None or evaluates to True, and the rejection condition is either not
     or evaluates to False.
+
+    The catalog requests of both conditions are sent together in one cone
+    search per alert, and only for alerts that pass the detection cuts.
+
+    Rejections are counted by reason and summarized every
+    rejection_stats_interval alerts or rejection_stats_seconds, and on
+    :meth:`close` or at exit (see RejectionStats).
     """
 
     min_ndet: int
     accept: None | CatalogMatchRequest | AnyOf[CatalogMatchRequest] | AllOf[CatalogMatchRequest]
     reject: None | CatalogMatchRequest | AnyOf[CatalogMatchRequest] | AllOf[CatalogMatchRequest]
-
-    # TODO: cache catalog lookups if deeply nested models ever become a thing
-    def _evaluate_match(
-        self,
-        ra: float,
-        dec: float,
-        selection: CatalogMatchRequest | AnyOf[CatalogMatchRequest] | AllOf[CatalogMatchRequest],
-    ) -> bool:
-        if isinstance(selection, AllOf):
-            return all(
-                self.cone_search_any(ra, dec, [cast(ConeSearchRequest, r.dict()) for r in selection.all_of])
-            )
-        elif isinstance(selection, AnyOf):
-            # recurse into OR conditions
-            if isinstance(selection.any_of, AllOf):
-                return all(self._evaluate_match(ra, dec, clause) for clause in selection.any_of.all_of)
-            else:
-                return any(
-                    self.cone_search_any(ra, dec, [cast(ConeSearchRequest, r.dict()) for r in selection.any_of])
-                )
-        else:
-            return all(self.cone_search_any(ra, dec, [cast(ConeSearchRequest, r.dict()) for r in [selection]]))
+    #: Number of alerts between rejection summaries
+    rejection_stats_interval: int = 1000
+    #: Maximum time between rejection summaries, also without alerts, in
+    #: seconds, flushed from a background thread (disabled if None)
+    rejection_stats_seconds: None | float = None
+    #: Log every rejected alert, in addition to the rejection summaries
+    log_rejections: bool = False
+    #: Share catalog matches of an alert with the other filters of the
+    #: process (e.g. of merged channels) processing the same alert
+    use_alert_cache: bool = False
+
+    @cached_property
+    def _rejections(self) -> RejectionStats:
+        # publish what is pending when the interpreter exits
+        self._close_at_exit = close_at_exit(self)
+        return RejectionStats(
+            self.__class__.__name__, self.logger, self.log_rejections, self.rejection_stats_seconds
+        )
+
+    def close(self) -> None:
+        """
+        publish the pending rejection statistics, e.g. at shutdown
+        """
+        if "_rejections" in self.__dict__:
+            atexit.unregister(self._close_at_exit)
+            self._rejections.flush()
+
+    def rejection_totals(self) -> dict[str, int]:
+        """
+        number of rejections per reason since instantiation
+        """
+        return self._rejections.totals()
+
+    @cached_property
+    def _plan(self) -> tuple[list[ConeSearchRequest], None | Clause, None | Clause]:
+        """
+        Distinct catalog requests of the accept and reject conditions, and
+        both conditions compiled to refer to requests by index, so that a
+        single cone search answers all clauses.
+        """
+        requests: list[ConeSearchRequest] = []
+        keys: dict[str, int] = {}
+
+        def compile(
+            selection: CatalogMatchRequest | AnyOf[CatalogMatchRequest] | AllOf[CatalogMatchRequest],
+        ) -> Clause:
+            if isinstance(selection, AllOf):
+                return ("all", [compile(clause) for clause in selection.all_of])
+            elif isinstance(selection, AnyOf):
+                return ("any", [compile(clause) for clause in selection.any_of])
+            request = cast(ConeSearchRequest, selection.dict())
+            key = json.dumps(request, sort_keys=True)
+            if key not in keys:
+                keys[key] = len(requests)
+                requests.append(request)
+            return keys[key]
+
+        return (
+            requests,
+            None if self.accept is None else compile(self.accept),
+            None if self.reject is None else compile(self.reject),
+        )
+
+    @cached_property
+    def _request_keys(self) -> list[str]:
+        return [json.dumps(request, sort_keys=True) for request in self._plan[0]]
+
+    def _cached_cone_search_any(self, ra: float, dec: float) -> list[bool]:
+        """
+        cone_search_any with the requests of the plan, answered from the
+        alert cache where possible
+        """
+        requests = self._plan[0]
+        keys = [("cone_search_any", ra, dec, key) for key in self._request_keys]
+        found = [alert_cache.lookup(key) for key in keys]
+        matches = [match for _, match in found]
+        if missing := [idx for idx, (hit, _) in enumerate(found) if not hit]:
+            for idx, match in zip(
+                missing, self.cone_search_any(ra, dec, [requests[idx] for idx in missing])
+            ):
+                matches[idx] = match
+                alert_cache.put(keys[idx], match)
+        return matches
+
+    @classmethod
+    def _evaluate(cls, clause: Clause, matches: list[bool]) -> bool:
+        if isinstance(clause, int):
+            return matches[clause]
+        op, clauses = clause
+        if op == "all":
+            return all(cls._evaluate(c, matches) for c in clauses)
+        return any(cls._evaluate(c, matches) for c in clauses)
 
     def process(self, alert: AmpelAlertProtocol) -> bool:
 
+        stats = self._rejections
+        if stats.alerts >= self.rejection_stats_interval:
+            stats.flush()
+        stats.count()
+        if self.use_alert_cache:
+            alert_cache.enter(alert)
+
         # cut on the number of previous detections
-        if len([el for el in alert.datapoints if el['id'] > 0]) < self.min_ndet:
+        if (ndet := len([el for el in alert.datapoints if el['id'] > 0])) < self.min_ndet:
+            stats.reject({"nDet": ndet})
             return False
 
         # now consider the last photopoint
@@ -81,15 +175,25 @@ class CatalogMatchFilter(CatalogMatchUnit, AbsAlertFilter):
             latest["isdiffpos"]
             and (latest["isdiffpos"] == "t" or latest["isdiffpos"] == "1")
         ):
-            self.logger.debug("rejected: 'isdiffpos' is %s", latest["isdiffpos"])
+            stats.reject({"isdiffpos": latest["isdiffpos"]})
             return False
 
-        ra = latest["ra"]
-        dec = latest["dec"]
-        if self.accept:
-            if not self._evaluate_match(ra, dec, self.accept):
-                return False
-        if self.reject:
-            if self._evaluate_match(ra, dec, self.reject):
-                return False
+        requests, accept, reject = self._plan
+        if not requests:
+            return True
+
+        try:
+            if self.use_alert_cache:
+                matches = self._cached_cone_search_any(latest["ra"], latest["dec"])
+            else:
+                matches = self.cone_search_any(latest["ra"], latest["dec"], requests)
+        except ConeSearchUnavailable:
+            stats.reject({"catalogUnavailable": True})
+            return False
+        if accept is not None and not self._evaluate(accept, matches):
+            stats.reject({"accept": False})
+            return False
+        if reject is not None and self._evaluate(reject, matches):
+            stats.reject({"reject": True})
+            return False
         return True
@@ -7,6 +7,9 @@
 # Last Modified Date:  10.03.2021
 # Last Modified By:    Jakob van Santen <jakob.van.santen@desy.de>
 
+import asyncio, nest_asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from functools import cached_property
 from typing import (
     Sequence,
@@ -20,12 +23,16 @@ from typing import (
     overload,
 )
 
+import aiohttp
 import backoff
 import requests
 from requests_toolbelt.sessions import BaseUrlSession
 
 from ampel.base.LogicalUnit import LogicalUnit
 from ampel.core.ContextUnit import ContextUnit
+from ampel.ztf.base.ConeSearchCache import ConeSearchCache, ConeSearchCacheConfig
+from ampel.ztf.base.ConeSearchGuard import ConeSearchGuard, ConeSearchGuardConfig, FallbackResult
+from ampel.ztf.base.LocalCatalog import LocalCatalog, open_local_catalogs
 
 
 class BaseConeSearchRequest(TypedDict):
@@ -84,6 +91,20 @@ class CatalogMatchUnitBase:
     A mixin providing catalog matching with catalogmatch-service
     """
 
+    #: Maximum number of cone searches in flight in the cone_search_*_many methods
+    max_concurrent_cone_searches: int = 8
+    #: Number of positions submitted at once in the cone_search_*_many methods
+    cone_search_chunk_size: int = 100
+    #: Cache results of cone searches (disabled if None)
+    cone_search_cache: None | ConeSearchCacheConfig = None
+    #: Directory of local catalog copies built with `ampel ztf catalog`.
+    #: Cone searches in catalogs found there are answered locally
+    #: instead of by catalogmatch-service.
+    local_catalogs: None | str = None
+    #: Deadline, hedging and circuit breaker for requests to
+    #: catalogmatch-service (disabled if None)
+    cone_search_guard: None | ConeSearchGuardConfig = None
+
     @cached_property
     def session(self) -> BaseUrlSession:
         """
@@ -140,6 +161,16 @@ class CatalogMatchUnitBase:
         dec: float,
         catalogs: Sequence[ConeSearchRequest],
     ) -> list[bool] | list[None | CatalogItem] | list[None | list[CatalogItem]]:
+        return self._post_cone_search(method, ra, dec, catalogs)
+
+    def _post_cone_search(
+        self,
+        method: Literal["any", "nearest", "all"],
+        ra: float,
+        dec: float,
+        catalogs: Sequence[ConeSearchRequest],
+        timeout: None | float = None,
+    ) -> Any:
         response = self.session.post(
             f"cone_search/{method}",
             json={
@@ -147,24 +178,316 @@ class CatalogMatchUnitBase:
                 "dec_deg": dec,
                 "catalogs": catalogs,
             },
+            timeout=timeout,
         )
         response.raise_for_status()
         return response.json()
 
+    @cached_property
+    def _cone_search_guard(self) -> None | ConeSearchGuard:
+        return (
+            # room for a hedged request per cone search
+            ConeSearchGuard(self.cone_search_guard, 2 * self.max_concurrent_cone_searches)
+            if self.cone_search_guard
+            else None
+        )
+
+    def _guarded_cone_search(
+        self,
+        method: Literal["any", "nearest", "all"],
+        ra: float,
+        dec: float,
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> Any:
+        """
+        :meth:`_cone_search`, with bounded latency if cone_search_guard is set.
+        Failing open yields a :class:`FallbackResult` without any match.
+        """
+        if (guard := self._cone_search_guard) is None:
+            return self._cone_search(method, ra, dec, catalogs)
+        return guard.call(
+            lambda timeout: self._post_cone_search(method, ra, dec, catalogs, timeout),
+            lambda: FallbackResult(False if method == "any" else None for _ in catalogs),
+        )
+
+    @cached_property
+    def _cone_search_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.max_concurrent_cone_searches,
+            thread_name_prefix="cone_search",
+        )
+
+    @cached_property
+    def _local_catalogs(self) -> dict[str, LocalCatalog]:
+        return open_local_catalogs(self.local_catalogs) if self.local_catalogs else {}
+
+    @cached_property
+    def _cone_search_results(self) -> None | ConeSearchCache:
+        return ConeSearchCache(self.cone_search_cache) if self.cone_search_cache else None
+
+    def _cone_search_many(
+        self,
+        method: Literal["any", "nearest", "all"],
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[Any]:
+        """
+        Cone search around each (ra, dec) position, answering from the result
+        cache where possible.
+
+        :returns: results of :meth:`_cone_search`, in the order of positions
+        """
+        if (cache := self._cone_search_results) is None:
+            return self._lookup_cone_search_many(method, positions, catalogs)
+
+        results: list[Any] = [None] * len(positions)
+        # key -> indexes of positions in the same cell
+        missing: dict[Any, list[int]] = {}
+        for idx, (ra, dec) in enumerate(positions):
+            key = cache.key(method, ra, dec, catalogs)
+            if key in missing:
+                missing[key].append(idx)
+                continue
+            found, results[idx] = cache.get(key)
+            if not found:
+                missing[key] = [idx]
+
+        if missing:
+            for (key, indexes), result in zip(
+                missing.items(),
+                self._lookup_cone_search_many(
+                    method, [positions[indexes[0]] for indexes in missing.values()], catalogs
+                ),
+            ):
+                if not isinstance(result, FallbackResult):
+                    cache.put(key, result)
+                for idx in indexes:
+                    results[idx] = result
+        return results
+
+    def _lookup_cone_search_many(
+        self,
+        method: Literal["any", "nearest", "all"],
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[Any]:
+        """
+        Cone search around each (ra, dec) position, in local catalogs where
+        available and with catalogmatch-service otherwise. Requests with pre-
+        or post-filters are always sent to the service.
+        """
+        local = [
+            idx
+            for idx, catalog in enumerate(catalogs)
+            if catalog["name"] in self._local_catalogs
+            and not catalog.get("pre_filter")
+            and not catalog.get("post_filter")
+        ]
+        if not local:
+            return self._query_cone_search_many(method, positions, catalogs)
+
+        remote = [catalog for idx, catalog in enumerate(catalogs) if idx not in local]
+        remote_results = (
+            self._query_cone_search_many(method, positions, remote)
+            if remote
+            else [[] for _ in positions]
+        )
+        results = []
+        for (ra, dec), remote_result in zip(positions, remote_results):
+            it = iter(remote_result)
+            result = [
+                self._local_catalogs[catalog["name"]].cone_search(
+                    method, ra, dec, catalog["rs_arcsec"], catalog.get("keys_to_append")
+                )
+                if idx in local
+                else next(it)
+                for idx, catalog in enumerate(catalogs)
+            ]
+            # the remote part is unknown if the service failed open
+            results.append(FallbackResult(result) if isinstance(remote_result, FallbackResult) else result)
+        return results
+
+    def _query_cone_search_many(
+        self,
+        method: Literal["any", "nearest", "all"],
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[Any]:
+        """
+        Cone search around each (ra, dec) position, with up to
+        max_concurrent_cone_searches requests in flight.
+        """
+        if len(positions) == 1:
+            return [self._guarded_cone_search(method, *positions[0], catalogs)]
+        results: list[Any] = []
+        for start in range(0, len(positions), self.cone_search_chunk_size):
+            results += self._cone_search_executor.map(
+                lambda pos: self._guarded_cone_search(method, pos[0], pos[1], catalogs),
+                positions[start : start + self.cone_search_chunk_size],
+            )
+        return results
+
+    def cone_search_any_many(
+        self,
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[list[bool]]:
+        return self._cone_search_many("any", positions, catalogs)
+
+    def cone_search_nearest_many(
+        self,
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[list[None | CatalogItem]]:
+        return self._cone_search_many("nearest", positions, catalogs)
+
+    def cone_search_all_many(
+        self,
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[list[None | list[CatalogItem]]]:
+        return self._cone_search_many("all", positions, catalogs)
+
     def cone_search_any(
         self, ra: float, dec: float, catalogs: Sequence[ConeSearchRequest]
     ) -> list[bool]:
-        return self._cone_search("any", ra, dec, catalogs)
+        return self.cone_search_any_many([(ra, dec)], catalogs)[0]
 
     def cone_search_nearest(
         self, ra: float, dec: float, catalogs: Sequence[ConeSearchRequest]
     ) -> list[None | CatalogItem]:
-        return self._cone_search("nearest", ra, dec, catalogs)
+        return self.cone_search_nearest_many([(ra, dec)], catalogs)[0]
 
     def cone_search_all(
         self, ra: float, dec: float, catalogs: Sequence[ConeSearchRequest]
     ) -> list[None | list[CatalogItem]]:
-        return self._cone_search("all", ra, dec, catalogs)
+        return self.cone_search_all_many([(ra, dec)], catalogs)[0]
+
+
+class AsyncCatalogMatchUnitBase(CatalogMatchUnitBase):
+    """
+    A mixin providing catalog matching with catalogmatch-service over aiohttp.
+    Cone searches for many positions share one connection pool, with up to
+    max_parallel_cone_searches requests in flight.
+    Retries follow the same rules as :meth:`CatalogMatchUnitBase._cone_search`.
+    """
+
+    #: Maximum number of cone searches in flight
+    max_parallel_cone_searches = 100
+
+    _aiohttp_session: None | aiohttp.ClientSession = None
+    _cone_search_semaphore: None | asyncio.Semaphore = None
+
+    @asynccontextmanager
+    async def cone_search_session(self):
+        """
+        Open a connection pool for the *_async methods
+        """
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_parallel_cone_searches),
+            raise_for_status=True,
+        ) as session:
+            self._aiohttp_session = session
+            self._cone_search_semaphore = asyncio.Semaphore(
+                self.max_parallel_cone_searches
+            )
+            try:
+                yield self
+            finally:
+                self._aiohttp_session = None
+                self._cone_search_semaphore = None
+
+    @backoff.on_exception(
+        backoff.expo,
+        (aiohttp.ClientConnectionError, asyncio.TimeoutError),
+        max_tries=5,
+        factor=10,
+    )
+    @backoff.on_exception(
+        backoff.expo,
+        aiohttp.ClientResponseError,
+        giveup=lambda e: e.status not in {503, 504, 429, 408},
+        max_time=60,
+    )
+    async def _cone_search_async(
+        self,
+        method: Literal["any", "nearest", "all"],
+        ra: float,
+        dec: float,
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[bool] | list[None | CatalogItem] | list[None | list[CatalogItem]]:
+        if self._aiohttp_session is None or self._cone_search_semaphore is None:
+            raise ValueError(
+                "call operations within an `async with self.cone_search_session()` block"
+            )
+        async with self._cone_search_semaphore:
+            async with self._aiohttp_session.post(
+                self.session.create_url(f"cone_search/{method}"),
+                json={
+                    "ra_deg": ra,
+                    "dec_deg": dec,
+                    "catalogs": catalogs,
+                },
+            ) as response:
+                return await response.json()
+
+    async def _cone_search_many_async(
+        self,
+        method: Literal["any", "nearest", "all"],
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[Any]:
+        return await asyncio.gather(
+            *(self._cone_search_async(method, ra, dec, catalogs) for ra, dec in positions)
+        )
+
+    async def cone_search_any_many_async(
+        self,
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[list[bool]]:
+        return await self._cone_search_many_async("any", positions, catalogs)
+
+    async def cone_search_nearest_many_async(
+        self,
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[list[None | CatalogItem]]:
+        return await self._cone_search_many_async("nearest", positions, catalogs)
+
+    async def cone_search_all_many_async(
+        self,
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[list[None | list[CatalogItem]]]:
+        return await self._cone_search_many_async("all", positions, catalogs)
+
+    async def _run_cone_search_many(
+        self,
+        method: Literal["any", "nearest", "all"],
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[Any]:
+        async with self.cone_search_session():
+            return await self._cone_search_many_async(method, positions, catalogs)
+
+    def _query_cone_search_many(
+        self,
+        method: Literal["any", "nearest", "all"],
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[Any]:
+        # single positions are not worth setting up a connection pool for
+        if len(positions) < 2:
+            return super()._query_cone_search_many(method, positions, catalogs)
+        # Patch event loop to be reentrant if it is already running, e.g.
+        # within a notebook
+        try:
+            if asyncio.get_event_loop().is_running():
+                nest_asyncio.apply()
+        except RuntimeError:
+            ...
+        return asyncio.run(self._run_cone_search_many(method, positions, catalogs))
 
 
 class CatalogMatchUnit(CatalogMatchUnitBase, LogicalUnit):
@@ -174,6 +497,17 @@ class CatalogMatchUnit(CatalogMatchUnitBase, LogicalUnit):
 
     require = ("ampel-ztf/catalogmatch",)
 
+    #: Maximum number of cone searches in flight (see :class:`CatalogMatchUnitBase`)
+    max_concurrent_cone_searches: int = 8
+    #: Number of positions submitted at once (see :class:`CatalogMatchUnitBase`)
+    cone_search_chunk_size: int = 100
+    #: Cache results of cone searches (disabled if None)
+    cone_search_cache: None | ConeSearchCacheConfig = None
+    #: Directory of local catalog copies (see :class:`CatalogMatchUnitBase`)
+    local_catalogs: None | str = None
+    #: Deadline, hedging and circuit breaker for requests (disabled if None)
+    cone_search_guard: None | ConeSearchGuardConfig = None
+
     @cached_property
     def session(self) -> BaseUrlSession:
         assert self.resource is not None
@@ -185,6 +519,17 @@ class CatalogMatchContextUnit(CatalogMatchUnitBase, ContextUnit):
     Catalog matching for ContextUnits
     """
 
+    #: Maximum number of cone searches in flight (see :class:`CatalogMatchUnitBase`)
+    max_concurrent_cone_searches: int = 8
+    #: Number of positions submitted at once (see :class:`CatalogMatchUnitBase`)
+    cone_search_chunk_size: int = 100
+    #: Cache results of cone searches (disabled if None)
+    cone_search_cache: None | ConeSearchCacheConfig = None
+    #: Directory of local catalog copies (see :class:`CatalogMatchUnitBase`)
+    local_catalogs: None | str = None
+    #: Deadline, hedging and circuit breaker for requests (disabled if None)
+    cone_search_guard: None | ConeSearchGuardConfig = None
+
     @cached_property
     def session(self) -> BaseUrlSession:
         return BaseUrlSession(
@@ -192,3 +537,21 @@ class CatalogMatchContextUnit(CatalogMatchUnitBase, ContextUnit):
                 "resource.ampel-ztf/catalogmatch", str, raise_exc=True
             )
         )
+
+
+class AsyncCatalogMatchUnit(AsyncCatalogMatchUnitBase, CatalogMatchUnit):
+    """
+    Catalog matching over aiohttp for LogicalUnits
+    """
+
+    #: Maximum number of cone searches in flight
+    max_parallel_cone_searches: int = 100
+
+
+class AsyncCatalogMatchContextUnit(AsyncCatalogMatchUnitBase, CatalogMatchContextUnit):
+    """
+    Catalog matching over aiohttp for ContextUnits
+    """
+
+    #: Maximum number of cone searches in flight
+    max_parallel_cone_searches: int = 100
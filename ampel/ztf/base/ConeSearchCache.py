@@ -0,0 +1,100 @@
+import json, math, time
+from collections import OrderedDict
+from collections.abc import Hashable, Sequence
+from threading import Lock
+from typing import Any
+
+from ampel.base.AmpelBaseModel import AmpelBaseModel
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+
+stat_lookups = AmpelMetricsRegistry.counter(
+    "cache_lookups",
+    "Number of cone search cache lookups",
+    subsystem="catalogmatch",
+    labelnames=("method", "outcome"),
+)
+
+
+class ConeSearchCacheConfig(AmpelBaseModel):
+    #: Maximum number of cached results
+    max_size: int = 100_000
+    #: Lifetime of cached matches, in seconds
+    ttl: float = 86400.0
+    #: Lifetime of cached results without any match, in seconds (0: do not cache)
+    negative_ttl: float = 86400.0
+    #: Size of the sky cells positions are quantized to, in arcsec
+    cell_arcsec: float = 0.1
+
+
+class ConeSearchCache:
+    """
+    LRU cache of cone search results, keyed on method, catalog requests and
+    position quantized to cells of cell_arcsec. Positions within the same
+    cell share the result of the first query made in that cell.
+
+    Entries expire after ttl seconds, or negative_ttl seconds if no catalog
+    returned a match.
+    """
+
+    _shared: dict[str, "ConeSearchCache"] = {}
+    _shared_lock = Lock()
+
+    @classmethod
+    def shared(cls, config: ConeSearchCacheConfig) -> "ConeSearchCache":
+        """
+        :returns: a cache shared by all units of the process using the same config
+        """
+        key = json.dumps(config.dict(), sort_keys=True)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(config)
+            return cls._shared[key]
+
+    def __init__(self, config: ConeSearchCacheConfig) -> None:
+        self.max_size = config.max_size
+        self.ttl = config.ttl
+        self.negative_ttl = config.negative_ttl
+        self.cell_deg = config.cell_arcsec / 3600.0
+        self._lock = Lock()
+        # key -> (expiry, result)
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def key(
+        self, method: str, ra: float, dec: float, catalogs: Sequence[Any]
+    ) -> Hashable:
+        dec_cell = round(dec / self.cell_deg)
+        # keep cells approximately square away from the equator
+        ra_width = self.cell_deg / max(math.cos(math.radians(dec_cell * self.cell_deg)), 1e-6)
+        return (
+            method,
+            round((ra % 360.0) / ra_width),
+            dec_cell,
+            json.dumps(catalogs, sort_keys=True),
+        )
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        """
+        :returns: (found, result)
+        """
+        with self._lock:
+            if (entry := self._entries.get(key)) is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    stat_lookups.labels(key[0], "hit").inc()  # type: ignore[index]
+                    return True, entry[1]
+                del self._entries[key]
+            stat_lookups.labels(key[0], "miss").inc()  # type: ignore[index]
+            return False, None
+
+    def put(self, key: Hashable, result: Any) -> None:
+        ttl = self.ttl if any(result) else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
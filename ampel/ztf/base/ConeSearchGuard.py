@@ -0,0 +1,236 @@
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from threading import Lock
+from typing import Any
+
+import requests
+
+from ampel.base.AmpelBaseModel import AmpelBaseModel
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+
+stat_events = AmpelMetricsRegistry.counter(
+    "guard_events",
+    "Number of deadlines, hedged requests, retries and circuit breaker actions in guarded cone searches",
+    subsystem="catalogmatch",
+    labelnames=("event",),
+)
+
+#: HTTP status codes worth retrying
+RETRY_STATUS = {503, 504, 429, 408}
+
+
+class ConeSearchUnavailable(RuntimeError):
+    """
+    Raised by a guarded cone search that failed, missed its deadline, or was
+    short-circuited by an open circuit breaker, unless the guard fails open
+    """
+
+
+class FallbackResult(list):
+    """
+    Stand-in result of a cone search that failed open: no match in any
+    catalog, as the actual answer is unknown. Not to be cached or memoized,
+    so that matches are found again once the service is back.
+    """
+
+
+class ConeSearchGuardConfig(AmpelBaseModel):
+    #: Time budget of a cone search, including retries and hedged requests, in seconds
+    deadline: float = 2.0
+    #: Send a second request if the first one is still pending after this
+    #: quantile of recent latencies (disabled if None)
+    hedge_quantile: None | float = 0.95
+    #: Number of latency samples required before requests are hedged
+    hedge_min_samples: int = 20
+    #: Number of consecutive failed cone searches that opens the circuit
+    failure_threshold: int = 5
+    #: Time after which an open circuit lets a trial request through, in seconds
+    reset_timeout: float = 30.0
+    #: When a cone search fails or the circuit is open, return results without
+    #: any match if True, otherwise raise ConeSearchUnavailable
+    fail_open: bool = False
+
+
+class ConeSearchGuard:
+    """
+    Bounds the latency of cone searches:
+
+    - every cone search, retries included, completes or fails within `deadline`
+    - a request still pending after the `hedge_quantile` of recent latencies
+      is duplicated, and the first response wins
+    - after `failure_threshold` consecutive failures the circuit opens and
+      cone searches fail immediately, until a trial request succeeds after
+      `reset_timeout`
+
+    Failures either raise ConeSearchUnavailable or are replaced by a
+    fallback result, depending on `fail_open`.
+    """
+
+    def __init__(self, config: ConeSearchGuardConfig, max_workers: int = 8) -> None:
+        """
+        :param max_workers: maximum number of requests in flight, hedged ones included
+        """
+        self.config = config
+        self._lock = Lock()
+        self._latencies: deque[float] = deque(maxlen=1000)
+        self._failures = 0
+        self._opened_at: None | float = None
+        self._trial = False
+        # requests abandoned at their deadline keep a worker until they time out
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="cone_search_guard"
+        )
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def hedge_delay(self) -> None | float:
+        """
+        :returns: time after which a pending request is hedged, or None
+        """
+        if self.config.hedge_quantile is None:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.config.hedge_min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(self.config.hedge_quantile * (len(latencies) - 1))]
+
+    def _allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if (
+                not self._trial
+                and time.monotonic() - self._opened_at >= self.config.reset_timeout
+            ):
+                self._trial = True
+                return True
+            return False
+
+    def _record(self, success: bool, latency: None | float = None) -> None:
+        with self._lock:
+            self._trial = False
+            if success:
+                if latency is not None:
+                    self._latencies.append(latency)
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.config.failure_threshold:
+                if self._opened_at is None:
+                    stat_events.labels("circuit_open").inc()
+                self._opened_at = time.monotonic()
+
+    @staticmethod
+    def _is_retriable(exc: BaseException) -> bool:
+        if isinstance(exc, requests.HTTPError):
+            return exc.response is not None and exc.response.status_code in RETRY_STATUS
+        return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+    def _fail(self, fallback: Callable[[], Any], reason: str) -> Any:
+        if self.config.fail_open:
+            stat_events.labels("fallback").inc()
+            return fallback()
+        raise ConeSearchUnavailable(reason)
+
+    def call(
+        self, request: Callable[[float], Any], fallback: Callable[[], Any]
+    ) -> Any:
+        """
+        :param request: function performing a single request, with the
+          remaining time budget in seconds as argument
+        :param fallback: function returning the result to use when failing open
+        """
+        if not self._allow():
+            stat_events.labels("short_circuit").inc()
+            return self._fail(fallback, "circuit open")
+
+        start = time.monotonic()
+        deadline = start + self.config.deadline
+        delay = self.hedge_delay()
+        hedge_at = None if delay is None else start + delay
+        hedges: set[Future] = set()
+        pending: set[Future] = set()
+        attempt = 0
+        error: None | BaseException = None
+
+        def timed() -> tuple[Any, float]:
+            # NB: the budget is what remains when a worker picks the request up
+            t0 = time.monotonic()
+            if (budget := deadline - t0) <= 0:
+                raise requests.Timeout("deadline passed before the request started")
+            result = request(budget)
+            return result, time.monotonic() - t0
+
+        def submit() -> Future:
+            future = self._executor.submit(timed)
+            pending.add(future)
+            return future
+
+        def abandon() -> None:
+            # requests that already started run until their budget is exhausted
+            for future in pending:
+                future.cancel()
+
+        submit()
+        while (now := time.monotonic()) < deadline:
+            if hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                if pending:
+                    stat_events.labels("hedge").inc()
+                    hedges.add(submit())
+            done, pending = wait(
+                pending,
+                timeout=min(deadline, hedge_at or deadline) - now,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                try:
+                    result, latency = future.result()
+                except Exception as exc:
+                    if not self._is_retriable(exc):
+                        # the service answered; let the caller deal with the error
+                        self._record(True)
+                        abandon()
+                        raise
+                    error = exc
+                    continue
+                if future in hedges:
+                    stat_events.labels("hedge_win").inc()
+                self._record(True, latency)
+                abandon()
+                return result
+            if done and not pending:
+                # every attempt failed: back off and retry within the deadline
+                hedge_at = None
+                attempt += 1
+                pause = min(0.1 * 2**attempt, deadline - time.monotonic())
+                if pause <= 0:
+                    break
+                time.sleep(pause)
+                if time.monotonic() >= deadline:
+                    break
+                stat_events.labels("retry").inc()
+                submit()
+
+        abandon()
+        self._record(False)
+        if not pending and error is not None and not isinstance(error, requests.Timeout):
+            # every attempt was refused or failed, and there is no time left for another
+            stat_events.labels("retries_exhausted").inc()
+            return self._fail(
+                fallback,
+                f"{attempt + 1} attempts failed within {self.config.deadline} s"
+                f" (last error: {error!r})",
+            )
+        stat_events.labels("deadline").inc()
+        return self._fail(
+            fallback,
+            f"no response within {self.config.deadline} s"
+            + (f" (last error: {error!r})" if error else ""),
+        )
@@ -0,0 +1,285 @@
+import json, os
+from collections.abc import Mapping, Sequence
+from typing import Any, Literal
+
+import numpy as np
+
+#: Version of the on-disk layout written by build_local_catalog
+FORMAT_VERSION = 1
+
+_index_dtype = np.dtype(
+    [
+        ("pixel", "<i8"),
+        ("start", "<i8"),
+        ("stop", "<i8"),
+        ("ra_min", "<f8"),
+        ("ra_max", "<f8"),
+        ("dec_min", "<f8"),
+        ("dec_max", "<f8"),
+    ]
+)
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    """
+    Interleave the bits of v with zeros (bit i moves to bit 2i)
+    """
+    v = v.astype(np.int64) & 0xFFFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+def healpix_nest(order: int, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """
+    HEALPix pixel index in the NESTED scheme, equivalent to
+    ``healpy.ang2pix(2**order, ra, dec, nest=True, lonlat=True)``.
+
+    :param order: log2 of nside
+    :param ra: right ascension in degrees
+    :param dec: declination in degrees
+    """
+    nside = 1 << order
+    z = np.sin(np.radians(dec))
+    za = np.abs(z)
+    tt = np.mod(np.radians(ra), 2 * np.pi) * (2 / np.pi)
+    # guard against ra = 360 - epsilon rounding to tt = 4
+    tt = np.where(tt >= 4, 0, tt)
+
+    face = np.empty(z.shape, dtype=np.int64)
+    ix = np.empty(z.shape, dtype=np.int64)
+    iy = np.empty(z.shape, dtype=np.int64)
+
+    # equatorial region
+    eq = za <= 2 / 3
+    temp1 = nside * (0.5 + tt[eq])
+    temp2 = nside * (0.75 * z[eq])
+    jp = (temp1 - temp2).astype(np.int64)  # index of ascending edge line
+    jm = (temp1 + temp2).astype(np.int64)  # index of descending edge line
+    ifp = jp >> order
+    ifm = jm >> order
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+
+    # polar caps
+    pol = ~eq
+    ntt = np.minimum(tt[pol].astype(np.int64), 3)
+    tp = tt[pol] - ntt
+    tmp = nside * np.sqrt(3 * (1 - za[pol]))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z[pol] >= 0
+    face[pol] = np.where(north, ntt, ntt + 8)
+    ix[pol] = np.where(north, nside - jm - 1, jp)
+    iy[pol] = np.where(north, nside - jp - 1, jm)
+
+    return (face << (2 * order)) + _spread_bits(ix) + (_spread_bits(iy) << 1)
+
+
+def angular_distance_arcsec(
+    ra1: float, dec1: float, ra2: np.ndarray, dec2: np.ndarray
+) -> np.ndarray:
+    """
+    Great-circle distance (haversine), in arcsec
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(v) for v in (ra1, dec1, ra2, dec2))
+    a = (
+        np.sin((dec2 - dec1) / 2) ** 2
+        + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    )
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))) * 3600
+
+
+class LocalCatalog:
+    """
+    Read-only local copy of a catalog, built with :func:`build_local_catalog`.
+
+    Rows are partitioned by HEALPix pixel (nested scheme) and sorted by
+    declination within each pixel. Each column is stored in a separate .npy
+    file that is memory-mapped, so only the pages touched by a cone search
+    are read from disk. The spatial index holds the row range and the bounding
+    box of each pixel; a cone search visits the pixels whose bounding box
+    overlaps the cone, bisects their declination range, and computes exact
+    distances for the remaining candidates.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: directory written by :func:`build_local_catalog`
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(
+                f"{path}: unsupported local catalog version {meta.get('version')}"
+            )
+        self.path = path
+        self.name: str = meta["name"]
+        self.order: int = meta["order"]
+        self.columns: list[str] = meta["columns"]
+        self.index = np.load(os.path.join(path, "index.npy"))
+        self._ra = np.load(os.path.join(path, "_ra.npy"), mmap_mode="r")
+        self._dec = np.load(os.path.join(path, "_dec.npy"), mmap_mode="r")
+        self._data = {
+            col: np.load(os.path.join(path, f"{col}.npy"), mmap_mode="r")
+            for col in self.columns
+        }
+
+    def __len__(self) -> int:
+        return len(self._ra)
+
+    def search(
+        self, ra: float, dec: float, rs_arcsec: float
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :returns: (rows, distances in arcsec) of the sources within rs_arcsec
+          of (ra, dec), sorted by distance
+        """
+        rs = rs_arcsec / 3600
+        dec_lo, dec_hi = dec - rs, dec + rs
+        index = self.index
+        mask = (index["dec_max"] >= dec_lo) & (index["dec_min"] <= dec_hi)
+        if max(abs(dec_lo), abs(dec_hi)) < 90:
+            half_width = rs / np.cos(np.radians(max(abs(dec_lo), abs(dec_hi))))
+            if half_width < 180:
+                ra = ra % 360
+                overlap = np.zeros(len(index), dtype=bool)
+                for shift in (-360, 0, 360):
+                    overlap |= (index["ra_max"] >= ra - half_width + shift) & (
+                        index["ra_min"] <= ra + half_width + shift
+                    )
+                mask &= overlap
+
+        rows: list[np.ndarray] = []
+        for start, stop in zip(index["start"][mask], index["stop"][mask]):
+            decs = self._dec[start:stop]
+            lo = start + np.searchsorted(decs, dec_lo, side="left")
+            hi = start + np.searchsorted(decs, dec_hi, side="right")
+            if hi > lo:
+                rows.append(np.arange(lo, hi))
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        candidates = np.concatenate(rows)
+        dist = angular_distance_arcsec(
+            ra, dec, self._ra[candidates], self._dec[candidates]
+        )
+        inside = dist <= rs_arcsec
+        candidates, dist = candidates[inside], dist[inside]
+        order = np.argsort(dist, kind="stable")
+        return candidates[order], dist[order]
+
+    def body(self, row: int, keys: None | Sequence[str] = None) -> dict[str, Any]:
+        """
+        :returns: the given columns (all if None) of a row, with NaN as None
+        """
+        body = {}
+        for key in self.columns if keys is None else keys:
+            value = self._data[key][row].item()
+            body[key] = None if isinstance(value, float) and value != value else value
+        return body
+
+    def cone_search(
+        self,
+        method: Literal["any", "nearest", "all"],
+        ra: float,
+        dec: float,
+        rs_arcsec: float,
+        keys: None | Sequence[str] = None,
+    ) -> Any:
+        """
+        Cone search with the same result structure as the corresponding
+        endpoint of catalogmatch-service
+        """
+        rows, dist = self.search(ra, dec, rs_arcsec)
+        if method == "any":
+            return len(rows) > 0
+        if not len(rows):
+            return None
+        if method == "nearest":
+            return {"body": self.body(rows[0], keys), "dist_arcsec": float(dist[0])}
+        return [
+            {"body": self.body(row, keys), "dist_arcsec": float(d)}
+            for row, d in zip(rows, dist)
+        ]
+
+
+def open_local_catalogs(path: str) -> dict[str, LocalCatalog]:
+    """
+    :returns: the local catalogs found in the subdirectories of path, by name
+    """
+    catalogs = {}
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.is_dir() and os.path.isfile(os.path.join(entry.path, "meta.json")):
+            catalog = LocalCatalog(entry.path)
+            catalogs[catalog.name] = catalog
+    return catalogs
+
+
+def build_local_catalog(
+    data: Mapping[str, Any],
+    path: str,
+    name: str,
+    ra_key: str = "ra",
+    dec_key: str = "dec",
+    columns: None | Sequence[str] = None,
+    order: int = 5,
+) -> LocalCatalog:
+    """
+    Write a catalog in the layout read by :class:`LocalCatalog`.
+
+    :param data: column name -> array-like of values, e.g. an astropy Table
+    :param path: output directory (created if needed)
+    :param name: catalog name, as used in ConeSearchRequest
+    :param ra_key: column holding the right ascension, in degrees
+    :param dec_key: column holding the declination, in degrees
+    :param columns: columns to store (default: all)
+    :param order: HEALPix order of the partitions (nside = 2**order)
+    """
+    ra = np.asarray(data[ra_key], dtype=np.float64) % 360
+    dec = np.asarray(data[dec_key], dtype=np.float64)
+    if columns is None:
+        columns = list(data.keys()) if hasattr(data, "keys") else list(data)
+    pixels = healpix_nest(order, ra, dec)
+    perm = np.lexsort((dec, pixels))
+    pixels = pixels[perm]
+
+    os.makedirs(path, exist_ok=True)
+    for col, values in [("_ra", ra), ("_dec", dec)] + [
+        (col, data[col]) for col in columns
+    ]:
+        values = np.asarray(values)
+        if values.dtype.kind == "O":
+            values = values.astype(str)
+        np.save(os.path.join(path, f"{col}.npy"), np.ascontiguousarray(values[perm]))
+
+    ra, dec = ra[perm], dec[perm]
+    uniq, starts = np.unique(pixels, return_index=True)
+    stops = np.append(starts[1:], len(pixels))
+    index = np.empty(len(uniq), dtype=_index_dtype)
+    index["pixel"] = uniq
+    index["start"] = starts
+    index["stop"] = stops
+    if len(uniq):
+        index["ra_min"] = np.minimum.reduceat(ra, starts)
+        index["ra_max"] = np.maximum.reduceat(ra, starts)
+        index["dec_min"] = np.minimum.reduceat(dec, starts)
+        index["dec_max"] = np.maximum.reduceat(dec, starts)
+    np.save(os.path.join(path, "index.npy"), index)
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": FORMAT_VERSION,
+                "name": name,
+                "order": order,
+                "columns": list(columns),
+                "rows": len(ra),
+            },
+            f,
+        )
+    return LocalCatalog(path)
@@ -0,0 +1,91 @@
+import json, math
+from collections import OrderedDict
+from collections.abc import Hashable
+from threading import Lock
+from typing import Any
+
+from ampel.base.AmpelBaseModel import AmpelBaseModel
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+from ampel.types import StockId
+
+stat_lookups = AmpelMetricsRegistry.counter(
+    "position_memo_lookups",
+    "Number of lookups of memoized position-derived results",
+    subsystem="alertfilter",
+    labelnames=("outcome",),
+)
+
+
+class PositionMemoConfig(AmpelBaseModel):
+    #: Maximum number of memoized stocks
+    max_size: int = 100_000
+    #: Maximum distance of an alert from the position the memoized results
+    #: of its stock were computed for, in arcsec. Alerts further away (moving
+    #: or offset sources) are evaluated again.
+    tolerance_arcsec: float = 0.5
+
+
+class PositionMemo:
+    """
+    LRU memo of results that depend only on the position of a source (and
+    on static catalogs), keyed on stock. Each stock has an anchor position,
+    that of the first alert results were stored for; results are reused
+    for alerts within tolerance_arcsec of it. A stored result for an alert
+    beyond the tolerance replaces the anchor and drops the other results.
+    """
+
+    _shared: dict[str, "PositionMemo"] = {}
+    _shared_lock = Lock()
+
+    @classmethod
+    def shared(cls, config: PositionMemoConfig) -> "PositionMemo":
+        """
+        :returns: a memo shared by all units of the process using the same config
+        """
+        key = json.dumps(config.dict(), sort_keys=True)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(config)
+            return cls._shared[key]
+
+    def __init__(self, config: PositionMemoConfig) -> None:
+        self.max_size = config.max_size
+        self.tolerance_deg = config.tolerance_arcsec / 3600.0
+        self._lock = Lock()
+        # stock -> (ra, dec, key -> result)
+        self._entries: OrderedDict[StockId, tuple[float, float, dict[Hashable, Any]]] = OrderedDict()
+
+    def _within_tolerance(self, ra0: float, dec0: float, ra: float, dec: float) -> bool:
+        # small-angle distance, with ra differences wrapped to [-180, 180)
+        dra = (ra - ra0 + 180.0) % 360.0 - 180.0
+        return math.hypot(
+            dra * math.cos(math.radians(dec0)), dec - dec0
+        ) <= self.tolerance_deg
+
+    def get(self, stock: StockId, ra: float, dec: float, key: Hashable) -> tuple[bool, Any]:
+        """
+        :returns: (found, result)
+        """
+        with self._lock:
+            if (entry := self._entries.get(stock)) is not None and key in entry[2]:
+                if self._within_tolerance(entry[0], entry[1], ra, dec):
+                    self._entries.move_to_end(stock)
+                    stat_lookups.labels("hit").inc()
+                    return True, entry[2][key]
+                stat_lookups.labels("moved").inc()
+                return False, None
+            stat_lookups.labels("miss").inc()
+            return False, None
+
+    def put(self, stock: StockId, ra: float, dec: float, key: Hashable, result: Any) -> None:
+        with self._lock:
+            entry = self._entries.get(stock)
+            if entry is None or not self._within_tolerance(entry[0], entry[1], ra, dec):
+                entry = self._entries[stock] = (ra, dec, {})
+            entry[2][key] = result
+            self._entries.move_to_end(stock)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
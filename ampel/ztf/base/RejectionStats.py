@@ -0,0 +1,162 @@
+import atexit, time
+from bisect import bisect_left
+from collections.abc import Callable
+from functools import partial
+from threading import Lock, Thread
+from typing import Any
+from weakref import ref
+
+from ampel.log.AmpelLogger import AmpelLogger
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+from ampel.protocol.LoggerProtocol import LoggerProtocol
+
+stat_rejections = AmpelMetricsRegistry.counter(
+    "rejections",
+    "Number of alerts rejected by alert filters",
+    subsystem="alertfilter",
+    labelnames=("unit", "reason"),
+)
+
+#: upper edges of the value histogram bins, the last bin collecting larger values
+BINS = (0, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class RejectionStats:
+    """
+    Aggregated rejection accounting of an alert filter.
+
+    Rejections are recorded with the `extra` dict a filter would log for the
+    rejected alert (reason -> value). Counts per reason, and histograms of
+    numerical values over :data:`BINS`, are accumulated in memory and
+    published by :meth:`flush` as the ampel_alertfilter_rejections counter
+    and a single summary log record, instead of one log record per rejected
+    alert. If `log_each` is set, every rejection is logged as well, with the
+    logger of the filter.
+
+    Summaries are not about the alert being filtered, so they go to
+    `summary_logger` (by default :func:`stats_logger`) rather than to the
+    logger of the filter, whose records AlertConsumer buffers and attributes
+    to the current alert.
+
+    Filters call :meth:`flush` every so many alerts, and when they are closed.
+    If `flush_seconds` is set, a background thread also flushes at that
+    interval, so that the statistics of a quiet stream are published. This
+    is opt-in: the thread logs concurrently with the filter, so
+    `summary_logger` must tolerate that.
+    """
+
+    def __init__(
+        self,
+        unit: str,
+        logger: LoggerProtocol,
+        log_each: bool = False,
+        flush_seconds: None | float = None,
+        summary_logger: None | LoggerProtocol = None,
+    ) -> None:
+        self.unit = unit
+        self.logger = logger
+        self.summary_logger = summary_logger or stats_logger(unit)
+        self.log_each = log_each
+        self.alerts = 0
+        self._counts: dict[str, int] = {}
+        self._histograms: dict[str, list[int]] = {}
+        self._totals: dict[str, int] = {}
+        self._lock = Lock()
+        if flush_seconds:
+            Thread(
+                target=_flush_periodically,
+                args=(ref(self), flush_seconds),
+                name=f"{unit}RejectionStats",
+                daemon=True,
+            ).start()
+
+    def count(self, alerts: int = 1) -> None:
+        """
+        count alerts about to be filtered
+        """
+        with self._lock:
+            self.alerts += alerts
+
+    def reject(self, extra: dict[str, Any]) -> None:
+        if self.log_each:
+            self.logger.info(None, extra=extra)
+        with self._lock:
+            for reason, value in extra.items():
+                self._counts[reason] = self._counts.get(reason, 0) + 1
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and value == value:
+                    if (histogram := self._histograms.get(reason)) is None:
+                        histogram = self._histograms[reason] = [0] * (len(BINS) + 1)
+                    histogram[bisect_left(BINS, value)] += 1
+
+    def summary(self) -> dict[str, Any]:
+        with self._lock:
+            return self._summary()
+
+    def _summary(self) -> dict[str, Any]:
+        return {
+            "alerts": self.alerts,
+            "rejected": dict(self._counts),
+            "histograms": {reason: list(h) for reason, h in self._histograms.items()},
+        }
+
+    def totals(self) -> dict[str, int]:
+        """
+        :returns: number of rejections per reason since instantiation
+        """
+        with self._lock:
+            return {
+                reason: self._totals.get(reason, 0) + self._counts.get(reason, 0)
+                for reason in self._totals.keys() | self._counts.keys()
+            }
+
+    def flush(self) -> None:
+        """
+        publish and reset the statistics accumulated since the last call
+        """
+        with self._lock:
+            if not self.alerts and not self._counts:
+                return
+            summary = self._summary()
+            for reason, count in self._counts.items():
+                self._totals[reason] = self._totals.get(reason, 0) + count
+            self.alerts = 0
+            self._counts = {}
+            self._histograms = {}
+        for reason, count in summary["rejected"].items():
+            stat_rejections.labels(self.unit, reason).inc(count)
+        self.summary_logger.info("Rejection summary", extra=summary)
+
+
+def stats_logger(unit: str) -> AmpelLogger:
+    """
+    :returns: the process-wide logger of the statistics of unit, which unlike
+      the logger of a filter instance is not buffered per alert
+    """
+    return AmpelLogger.get_logger(f"{unit}Stats")
+
+
+def close_at_exit(unit: Any) -> Callable[[], None]:
+    """
+    Call unit.close() when the interpreter exits, as AlertConsumer never closes
+    its filters. Only holds a weak reference to unit.
+
+    :returns: the registered function, to be passed to atexit.unregister by close()
+    """
+    func = partial(_close_at_exit, ref(unit))
+    atexit.register(func)
+    return func
+
+
+def _close_at_exit(unit: "ref[Any]") -> None:
+    if (u := unit()) is not None:
+        u.close()
+
+
+def _flush_periodically(stats: "ref[RejectionStats]", seconds: float) -> None:
+    # NB: only holds a weak reference, so that the thread ends once the stats are collected
+    while True:
+        time.sleep(seconds)
+        if (s := stats()) is None:
+            return
+        s.flush()
+        del s
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/dev/FilterBacktest.py
+# License:             BSD-3-Clause
+
+import os, tarfile, time, fastavro # type: ignore[import]
+from collections.abc import Iterator, Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from importlib import import_module
+from typing import Any, TypedDict
+from ampel.abstract.AbsAlertFilter import AbsAlertFilter
+from ampel.alert.AmpelAlert import AmpelAlert
+from ampel.log.AmpelLogger import AmpelLogger
+from ampel.ztf.alert.ZiAlertSupplier import ZiAlertSupplier
+
+
+class BacktestReport(TypedDict):
+	#: number of alerts filtered
+	alerts: int
+	#: number of alert packets that could not be decoded to the end (truncated
+	#: or corrupt); the alerts decoded before the error are filtered
+	truncated: int
+	#: number of accepted alerts
+	accepted: int
+	#: candids of the accepted alerts
+	candids: list[int]
+	#: time spent in the filter, summed over all worker processes [s]
+	seconds: float
+	#: alerts per second of filter time
+	rate: float
+	#: wall-clock time of the backtest, including decoding, shared by all parameter sets [s]
+	elapsed: float
+	#: number of rejections per reason, for filters implementing rejection_totals()
+	rejected: dict[str, int]
+	#: number of alerts evaluated and rejected, and acceptance, per cut, for
+	#: filters implementing cut_totals()
+	cuts: dict[str, dict[str, Any]]
+
+
+class OfflineCatalogSession:
+	"""
+	Stands in for the catalogmatch-service session of CatalogMatchUnit:
+	no catalog ever matches
+	"""
+
+	class Response:
+
+		def __init__(self, result: list[Any]) -> None:
+			self.result = result
+
+		def raise_for_status(self) -> None:
+			...
+
+		def json(self) -> list[Any]:
+			return self.result
+
+
+	def post(self, url: str, json: dict[str, Any], **kwargs) -> "OfflineCatalogSession.Response":
+		no_match = False if url.endswith("any") else None
+		return self.Response([no_match] * len(json["catalogs"]))
+
+
+def load_unit_class(unit: str | type[AbsAlertFilter]) -> type[AbsAlertFilter]:
+	"""
+	:param unit: filter class, or its fully qualified name following the ampel
+	  convention of one unit per module named after it (e.g. ampel.ztf.t0.DecentFilter)
+	"""
+	if isinstance(unit, str):
+		return getattr(import_module(unit), unit.rsplit(".", 1)[-1])
+	return unit
+
+
+def iter_alerts(
+	source: str, shard: int = 0, nshards: int = 1, truncated: None | list[str] = None
+) -> Iterator[AmpelAlert]:
+	"""
+	Decode the alerts of a tarball, an avro file or a directory of avro
+	files, keeping every nshards-th alert starting from the shard-th one.
+
+	:param truncated: list the names of packets that could not be decoded
+	  to the end are appended to
+	"""
+	if os.path.isdir(source):
+		files = sorted(
+			os.path.join(source, f) for f in os.listdir(source) if f.endswith(".avro")
+		)
+		for i, path in enumerate(files):
+			if i % nshards == shard:
+				with open(path, "rb") as f:
+					yield from _decode(f, path, truncated)
+		return
+
+	if source.endswith(".avro"):
+		# NB: records are sharded, so every shard reads the whole file
+		with open(source, "rb") as f:
+			yield from _decode(f, source, truncated, shard, nshards)
+		return
+
+	with tarfile.open(source, mode="r:*") as tar:
+		i = 0
+		for member in tar:
+			if not member.isfile():
+				continue
+			if i % nshards == shard and (f := tar.extractfile(member)) is not None:
+				yield from _decode(f, f"{source}:{member.name}", truncated)
+			i += 1
+			# free memory, see TarAlertLoader
+			tar.members.clear() # type: ignore[attr-defined]
+
+
+def _decode(
+	f, name: str, truncated: None | list[str], shard: int = 0, nshards: int = 1
+) -> Iterator[AmpelAlert]:
+	"""
+	:param shard: keep every nshards-th record of f starting from the shard-th one
+	"""
+	try:
+		for i, record in enumerate(fastavro.reader(f)):
+			if i % nshards == shard:
+				yield ZiAlertSupplier.shape_alert_dict(record)
+	except (IndexError, EOFError, ValueError):
+		# truncated or corrupt packet, reported by a single shard
+		if truncated is not None and shard == 0:
+			truncated.append(name)
+
+
+def _run_shard(
+	unit: str | type[AbsAlertFilter],
+	configs: Sequence[dict[str, Any]],
+	source: str,
+	shard: int,
+	nshards: int,
+	resource: None | dict[str, Any],
+	offline: bool,
+	batch_size: int,
+) -> list[BacktestReport]:
+	"""
+	Decode the alerts of one shard once, and run a filter instance for each config on them
+	"""
+
+	truncated: list[str] = []
+	alerts = list(iter_alerts(source, shard, nshards, truncated))
+	unit_class = load_unit_class(unit)
+	logger = AmpelLogger(console=False)
+
+	reports: list[BacktestReport] = []
+	for config in configs:
+		flt = unit_class(**config, logger=logger, resource=resource or {})
+		flt.post_init()
+		if offline and hasattr(type(flt), "session"):
+			# pre-populate the cached session property
+			flt.__dict__["session"] = OfflineCatalogSession()
+
+		start = time.perf_counter()
+		if batch_size > 1 and hasattr(flt, "process_many"):
+			results: list[Any] = []
+			for i in range(0, len(alerts), batch_size):
+				results += flt.process_many(alerts[i : i + batch_size]) # type: ignore[attr-defined]
+		else:
+			results = [flt.process(alert) for alert in alerts]
+		seconds = time.perf_counter() - start
+
+		candids = [
+			alert.datapoints[0]["candid"]
+			for alert, result in zip(alerts, results)
+			if result is not None and result is not False and result >= 0
+		]
+		reports.append({
+			"alerts": len(alerts),
+			"truncated": len(truncated),
+			"accepted": len(candids),
+			"candids": candids,
+			"seconds": seconds,
+			"rate": 0.,
+			"elapsed": 0.,
+			"rejected": flt.rejection_totals() if hasattr(flt, "rejection_totals") else {},
+			"cuts": flt.cut_totals() if hasattr(flt, "cut_totals") else {},
+		})
+
+	return reports
+
+
+def _merge(reports: Sequence[BacktestReport]) -> BacktestReport:
+
+	merged: BacktestReport = {
+		"alerts": 0, "truncated": 0, "accepted": 0, "candids": [], "seconds": 0.,
+		"rate": 0., "elapsed": 0., "rejected": {}, "cuts": {}
+	}
+	for report in reports:
+		merged["alerts"] += report["alerts"]
+		merged["truncated"] += report["truncated"]
+		merged["accepted"] += report["accepted"]
+		merged["candids"] += report["candids"]
+		merged["seconds"] += report["seconds"]
+		for reason, count in report["rejected"].items():
+			merged["rejected"][reason] = merged["rejected"].get(reason, 0) + count
+		for name, stats in report["cuts"].items():
+			cut = merged["cuts"].setdefault(name, {"evaluated": 0, "rejected": 0, "seconds": 0.})
+			for k in ("evaluated", "rejected", "seconds"):
+				cut[k] += stats[k]
+
+	merged["candids"].sort()
+	if merged["seconds"] > 0:
+		merged["rate"] = merged["alerts"] / merged["seconds"]
+	for cut in merged["cuts"].values():
+		cut["acceptance"] = 1 - cut["rejected"] / cut["evaluated"] if cut["evaluated"] else None
+	return merged
+
+
+def run_backtest(
+	unit: str | type[AbsAlertFilter],
+	configs: Mapping[str, dict[str, Any]],
+	sources: Sequence[str],
+	processes: None | int = None,
+	shards_per_source: int = 1,
+	resource: None | dict[str, Any] = None,
+	offline: bool = False,
+	batch_size: int = 0,
+) -> dict[str, BacktestReport]:
+	"""
+	Run an alert filter with several parameter sets over archived alerts.
+
+	Each source (tarball, avro file or directory of avro files) is split into
+	shards_per_source shards that are processed in parallel by a pool of
+	processes. Every shard is decoded once and filtered with each parameter
+	set, so that adding parameter sets does not add decoding time.
+
+	:param unit: filter class or fully qualified name (e.g. ampel.ztf.t0.DecentFilter)
+	:param configs: parameter set name -> unit config
+	:param processes: size of the process pool (default: number of CPUs),
+	  0 to run in the calling process
+	:param resource: resources of the filter (e.g. {"ampel-ztf/catalogmatch": url});
+	  set local_catalogs in the configs to use local catalog copies instead
+	:param offline: answer cone searches with no match instead of querying catalogmatch-service
+	:param batch_size: pass alerts to process_many in batches of this size
+	  if the filter implements it (default: process alerts one by one)
+
+	:returns: parameter set name -> report
+	"""
+
+	names = list(configs)
+	tasks = [
+		(unit, [configs[name] for name in names], source, shard, shards_per_source, resource, offline, batch_size)
+		for source in sources for shard in range(shards_per_source)
+	]
+
+	start = time.perf_counter()
+	if processes == 0:
+		shard_reports = [_run_shard(*task) for task in tasks]
+	else:
+		with ProcessPoolExecutor(max_workers=processes) as executor:
+			shard_reports = list(executor.map(_run_shard, *zip(*tasks)))
+
+	elapsed = time.perf_counter() - start
+
+	results = {}
+	for i, name in enumerate(names):
+		results[name] = _merge([reports[i] for reports in shard_reports])
+		results[name]["elapsed"] = elapsed
+	return results
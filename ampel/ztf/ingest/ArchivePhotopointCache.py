@@ -0,0 +1,203 @@
+import json, sqlite3, time
+from threading import Lock
+from typing import Any
+from collections.abc import Callable
+
+
+class ArchivePhotopointCache:
+    """
+    On-disk cache of photopoints and upper limits returned by the ZTF archive
+    service (object/{name}/photopoints), keyed by object and jd interval.
+
+    Requests for an interval that is partially covered only fetch the missing
+    parts, and the covered intervals of an object are merged as they grow.
+    Archived photometry is assumed not to change once it is older than the
+    archive's ingestion lag: coverage (including that of empty responses) is
+    only recorded up to ingest_lag days before now, so that more recent
+    parts of an interval are requested again.
+
+    When the stored points exceed max_size bytes, the objects accessed least
+    recently are evicted until the cache is below 90% of max_size.
+    """
+
+    def __init__(self, path: str, max_size: int = 2**30, ingest_lag: float = 2.) -> None:
+        """
+        :param path: path of the SQLite database file (created if needed)
+        :param max_size: maximum size of the stored (JSON-serialized) points, in bytes
+        :param ingest_lag: time after which alerts are assumed to be in the archive, in days
+        """
+        self.max_size = max_size
+        self.ingest_lag = ingest_lag
+        self._lock = Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS objects (
+                name TEXT PRIMARY KEY, accessed REAL NOT NULL, size INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS coverage (
+                name TEXT NOT NULL, jd_start REAL NOT NULL, jd_end REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS coverage_name ON coverage (name);
+            CREATE TABLE IF NOT EXISTS points (
+                name TEXT NOT NULL, jd REAL NOT NULL, pid INTEGER NOT NULL, candid INTEGER NOT NULL,
+                doc TEXT NOT NULL, PRIMARY KEY (name, jd, pid, candid)
+            );
+            CREATE INDEX IF NOT EXISTS objects_accessed ON objects (accessed);
+            """
+        )
+
+    def close(self) -> None:
+        self._con.close()
+
+    def get(
+        self,
+        name: str,
+        jd_start: float,
+        jd_end: float,
+        fetch: Callable[[float, float], None | dict[str, Any]],
+    ) -> None | dict[str, Any]:
+        """
+        :param name: ZTF object name
+        :param fetch: function requesting the photopoints of the object between
+          two jds from the archive service (returning an alert dict or None)
+        :returns: an alert dict similar to the ones returned by the archive
+          service, or None if there are no detections in the interval
+        """
+        with self._lock:
+            missing = self._missing(name, jd_start, jd_end)
+
+        # NB: request missing parts without holding the lock
+        fetched = [(start, end, fetch(start, end)) for start, end in missing]
+
+        with self._lock, self._con:
+            horizon = self._now_jd() - self.ingest_lag
+            for start, end, alert in fetched:
+                self._add(name, start, end, alert, horizon)
+            if fetched:
+                self._merge_coverage(name)
+            self._con.execute(
+                "INSERT INTO objects (name, accessed) VALUES (?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET accessed = excluded.accessed",
+                (name, time.time()),
+            )
+            docs = [
+                json.loads(doc)
+                for doc, in self._con.execute(
+                    "SELECT doc FROM points WHERE name = ? AND jd >= ? AND jd <= ? ORDER BY jd DESC, pid DESC",
+                    (name, jd_start, jd_end),
+                )
+            ]
+            if fetched:
+                self._evict()
+
+        return self._to_alert(name, docs)
+
+    def _missing(
+        self, name: str, jd_start: float, jd_end: float
+    ) -> list[tuple[float, float]]:
+        """
+        :returns: the parts of [jd_start, jd_end] not covered by the cache
+        """
+        missing = []
+        start = jd_start
+        for cov_start, cov_end in self._con.execute(
+            "SELECT jd_start, jd_end FROM coverage WHERE name = ? AND jd_end >= ? AND jd_start <= ? ORDER BY jd_start",
+            (name, jd_start, jd_end),
+        ):
+            if cov_start > start:
+                missing.append((start, cov_start))
+            start = max(start, cov_end)
+        if start < jd_end:
+            missing.append((start, jd_end))
+        return missing
+
+    @staticmethod
+    def _now_jd() -> float:
+        return time.time() / 86400. + 2440587.5
+
+    def _add(
+        self,
+        name: str,
+        jd_start: float,
+        jd_end: float,
+        alert: None | dict[str, Any],
+        horizon: float,
+    ) -> None:
+        """
+        Store the points of alert, and record [jd_start, jd_end] as covered up to horizon
+        """
+        rows = [
+            (name, pp["jd"], pp["pid"], pp.get("candid") or 0, json.dumps(pp))
+            for pp in (
+                [alert["candidate"], *alert["prv_candidates"]] if alert else []
+            )
+            if jd_start <= pp["jd"] <= jd_end
+        ]
+        self._con.executemany("INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?)", rows)
+        if jd_start < (jd_end := min(jd_end, horizon)):
+            self._con.execute(
+                "INSERT INTO coverage VALUES (?, ?, ?)", (name, jd_start, jd_end)
+            )
+        self._con.execute(
+            "INSERT INTO objects (name, accessed, size) VALUES (?, ?, 0)"
+            " ON CONFLICT (name) DO NOTHING",
+            (name, time.time()),
+        )
+        self._con.execute(
+            "UPDATE objects SET size = (SELECT COALESCE(SUM(LENGTH(doc)), 0) FROM points WHERE name = ?) WHERE name = ?",
+            (name, name),
+        )
+
+    def _merge_coverage(self, name: str) -> None:
+        intervals: list[list[float]] = []
+        for start, end in self._con.execute(
+            "SELECT jd_start, jd_end FROM coverage WHERE name = ? ORDER BY jd_start",
+            (name,),
+        ):
+            if intervals and start <= intervals[-1][1]:
+                intervals[-1][1] = max(intervals[-1][1], end)
+            else:
+                intervals.append([start, end])
+        self._con.execute("DELETE FROM coverage WHERE name = ?", (name,))
+        self._con.executemany(
+            "INSERT INTO coverage VALUES (?, ?, ?)",
+            [(name, start, end) for start, end in intervals],
+        )
+
+    def _evict(self) -> None:
+        size = self._con.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        if size <= self.max_size:
+            return
+        evict = []
+        for name, obj_size in self._con.execute(
+            "SELECT name, size FROM objects ORDER BY accessed"
+        ).fetchall():
+            if size <= 0.9 * self.max_size:
+                break
+            evict.append((name,))
+            size -= obj_size
+        for table in ("points", "coverage", "objects"):
+            self._con.executemany(f"DELETE FROM {table} WHERE name = ?", evict)
+
+    @staticmethod
+    def _to_alert(name: str, docs: list[dict[str, Any]]) -> None | dict[str, Any]:
+        """
+        Build an alert dict with the latest detection as candidate
+        """
+        if (
+            candidate := max(
+                (doc for doc in docs if doc.get("candid")),
+                key=lambda doc: (doc["jd"], doc["candid"]),
+                default=None,
+            )
+        ) is None:
+            return None
+        return {
+            "objectId": name,
+            "candid": candidate["candid"],
+            "programid": candidate["programid"],
+            "candidate": candidate,
+            "prv_candidates": [doc for doc in docs if doc is not candidate],
+        }
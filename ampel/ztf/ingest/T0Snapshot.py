@@ -0,0 +1,33 @@
+from typing import Any
+from pymongo.collection import Collection
+from ampel.types import StockId
+from ampel.content.DataPoint import DataPoint
+
+
+class T0Snapshot:
+	"""
+	The t0 documents of the stock of the alert being ingested, read at most
+	once and shared by chained muxers (see ZiChainedT0Muxer).
+	Documents may be modified in place by the muxers, for example when
+	ZiMongoMuxer marks them as superseded.
+	"""
+
+	def __init__(self, col: Collection, projection: dict[str, Any]) -> None:
+		self._col = col
+		self._projection = projection
+		self._stock: None | StockId = None
+		self._dps: None | list[DataPoint] = None
+
+
+	def get(self, stock_id: None | StockId) -> list[DataPoint]:
+		""" :returns: the t0 documents of the stock, reading them if needed """
+		if self._dps is None or self._stock != stock_id:
+			self._stock = stock_id
+			self._dps = list(self._col.find({'stock': stock_id}, self._projection))
+		return self._dps
+
+
+	def reset(self) -> None:
+		""" Discard the documents, e.g. at the end of an alert or when t0 was updated concurrently """
+		self._stock = None
+		self._dps = None
@@ -1,8 +1,10 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import cached_property
 from typing import Any
-from collections.abc import Sequence
+from collections.abc import Iterable, Sequence
 
 import backoff, requests # type: ignore
+from pymongo import UpdateOne
 from requests_toolbelt.sessions import BaseUrlSession
 
 from ampel.types import StockId
@@ -12,6 +14,10 @@ from ampel.content.DataPoint import DataPoint
 from ampel.secret.NamedSecret import NamedSecret
 from ampel.model.UnitModel import UnitModel
 from ampel.ztf.alert.ZiAlertSupplier import ZiAlertSupplier
+from ampel.ztf.ingest.ArchivePhotopointCache import ArchivePhotopointCache
+from ampel.ztf.ingest.buffer_hooks import on_stop
+from ampel.ztf.ingest.indexes import t0_stock_jd_id
+from ampel.ztf.ingest.T0Snapshot import T0Snapshot
 from ampel.ztf.util.ZTFIdMapper import to_ztf_id
 
 
@@ -36,6 +42,36 @@ class ZiArchiveMuxer(AbsT0Muxer):
     shaper: UnitModel | str = "ZiDataPointShaper"
     archive_token: NamedSecret[str] = NamedSecret(label="ztf/archive/token")
 
+    #: Find the earliest jd in t0 by walking the index (stock, body.jd, id) in
+    #: jd order and stopping at the first match, instead of aggregating over
+    #: all datapoints of the stock. Requires the index to exist, see
+    #: :mod:`ampel.ztf.ingest.indexes`.
+    walk_jd_index: bool = False
+
+    #: Record the archival interval added for each stock in its stock document
+    #: (field ztf_archive), and skip the t0 lookup and the archive request
+    #: when the interval needed for an alert is already covered. As skipped
+    #: points are not returned for combination, this is only appropriate
+    #: when chained after ZiMongoMuxer, which draws them from t0.
+    track_coverage: bool = False
+
+    #: Maximum number of archive requests in flight when prefetching
+    max_concurrent_requests: int = 4
+
+    #: Maximum number of prefetched histories held before the oldest are dropped
+    max_prefetched: int = 100
+
+    #: Path of an on-disk cache of archive responses (disabled if None),
+    #: see :class:`~ampel.ztf.ingest.ArchivePhotopointCache.ArchivePhotopointCache`
+    cache_path: None | str = None
+
+    #: Maximum size of the on-disk cache, in bytes
+    cache_max_size: int = 2**30
+
+    #: Time after which alerts are assumed to be in the archive, in days.
+    #: The cache requests more recent parts of an interval again.
+    cache_ingest_lag: float = 2.
+
     # Standard projection used when checking DB for existing PPS/ULS
     projection: dict[str, int] = {
         "_id": 1,
@@ -58,6 +94,19 @@ class ZiArchiveMuxer(AbsT0Muxer):
         )
 
         self._t0_col = self.context.db.get_collection("t0", "w")
+        self._stock_col = self.context.db.get_collection("stock")
+        self._t0_snapshot: None | T0Snapshot = None
+
+        # (stock, jd_start, jd_end) -> (pending archive response, number of alerts expecting it)
+        self._prefetched: dict[tuple[StockId, float, float], tuple[Future, int]] = {}
+
+        self._cache = (
+            ArchivePhotopointCache(self.cache_path, self.cache_max_size, self.cache_ingest_lag)
+            if self.cache_path
+            else None
+        )
+        # shut the prefetch threads down at the end of the run
+        on_stop(self.updates_buffer, self.close)
 
     # NB: init lazily, as Secret properties are not resolved until after __init__()
     @cached_property
@@ -76,6 +125,37 @@ class ZiArchiveMuxer(AbsT0Muxer):
         session.auth = BearerAuth(self.archive_token.get())
         return session
 
+    def share_t0_snapshot(self, snapshot: None | T0Snapshot) -> None:
+        """Read t0 documents through a snapshot shared with other muxers"""
+        self._t0_snapshot = snapshot
+
+    @cached_property
+    def executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.max_concurrent_requests,
+            thread_name_prefix=self.__class__.__name__,
+        )
+
+    def close(self) -> None:
+        """Drop pending prefetches and shut the prefetch threads down"""
+        self._prefetched.clear()
+        if "executor" in self.__dict__:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            del self.__dict__["executor"]
+
+    @staticmethod
+    def get_earliest_alert_jd(datapoints: Sequence[DataPoint]) -> float:
+        """
+        return the smallest jd of any photopoint in datapoints
+        """
+        return min(
+            (
+                dp["body"]["jd"]
+                for dp in datapoints
+                if dp["id"] > 0 and "ZTF" in dp["tag"]
+            )
+        )
+
     def get_earliest_jd(
         self, stock_id: StockId, datapoints: Sequence[DataPoint]
     ) -> float:
@@ -84,31 +164,48 @@ class ZiArchiveMuxer(AbsT0Muxer):
           - the smallest jd of any photopoint in datapoints
           - the smallest jd of any photopoint in t0 from the same stock
         """
-        from_alert = min(
-            (
-                dp["body"]["jd"]
-                for dp in datapoints
-                if dp["id"] > 0 and "ZTF" in dp["tag"]
+        from_alert = self.get_earliest_alert_jd(datapoints)
+        match = {
+            "id": {"$gt": 0},
+            "stock": stock_id,
+            "body.jd": {"$lt": from_alert},
+            "tag": "ZTF",
+        }
+        if self._t0_snapshot:
+            from_db = min(
+                (
+                    dp["body"]["jd"]
+                    for dp in self._t0_snapshot.get(stock_id)
+                    if dp["id"] > 0
+                    and dp["body"]["jd"] < from_alert
+                    and "ZTF" in dp["tag"]
+                ),
+                default=None,
             )
-        )
-        if (
-            from_db := next(
+        elif self.walk_jd_index:
+            # NB: documents are still fetched to check the tag, but only
+            # until the first match in jd order
+            from_db = next(
+                (
+                    doc["body"]["jd"]
+                    for doc in self._t0_col.find(match, {"_id": 0, "body.jd": 1})
+                    .hint(t0_stock_jd_id)
+                    .sort("body.jd", 1)
+                    .limit(1)
+                ),
+                None,
+            )
+        else:
+            from_db = next(
                 self._t0_col.aggregate(
                     [
-                        {
-                            "$match": {
-                                "id": {"$gt": 0},
-                                "stock": stock_id,
-                                "body.jd": {"$lt": from_alert},
-                                "tag": "ZTF",
-                            }
-                        },
+                        {"$match": match},
                         {"$group": {"_id": None, "jd": {"$min": "$body.jd"}}},
                     ]
                 ),
                 {"jd": None},
             )["jd"]
-        ) is None:
+        if from_db is None:
             return from_alert
         else:
             return min((from_alert, from_db))
@@ -119,14 +216,106 @@ class ZiArchiveMuxer(AbsT0Muxer):
         giveup=lambda e: e.response.status_code not in {503, 504, 429, 408},
         max_time=600,
     )
-    def get_photopoints(self, ztf_name: str, before_jd: float) -> list[dict[str, Any]]:
+    def request_photopoints(
+        self, ztf_name: str, jd_start: float, jd_end: float
+    ) -> dict[str, Any]:
         response = self.session.get(
             f"object/{ztf_name}/photopoints",
-            params={"jd_end": before_jd, "jd_start": before_jd - self.history_days},
+            params={"jd_end": jd_end, "jd_start": jd_start},
         )
         response.raise_for_status()
         return response.json()
 
+    def get_photopoints(
+        self, ztf_name: str, before_jd: float, jd_start: None | float = None
+    ) -> dict[str, Any]:
+        """
+        :param jd_start: start of the requested interval (default: before_jd - history_days)
+        """
+        if jd_start is None:
+            jd_start = before_jd - self.history_days
+        if self._cache:
+            return self._cache.get(
+                ztf_name,
+                jd_start,
+                before_jd,
+                lambda start, end: self.request_photopoints(ztf_name, start, end),
+            )
+        return self.request_photopoints(ztf_name, jd_start, before_jd)
+
+    def get_coverage(self, stock_id: StockId) -> None | dict[str, float]:
+        """
+        :returns: the archival interval already added for this stock, as
+          {"start": jd, "end": jd, "earliest": earliest detection jd}
+        """
+        return (
+            self._stock_col.find_one({"stock": stock_id}, {"_id": 0, "ztf_archive": 1})
+            or {}
+        ).get("ztf_archive")
+
+    def get_interval(
+        self, stock_id: StockId, dps: Sequence[DataPoint]
+    ) -> None | tuple[float, float]:
+        """
+        :returns: the (jd_start, jd_end) interval to request from the archive,
+          or None if it was already covered by a previous alert
+        """
+        if not self.track_coverage or not (coverage := self.get_coverage(stock_id)):
+            before_jd = self.get_earliest_jd(stock_id, dps)
+            return before_jd - self.history_days, before_jd
+
+        before_jd = min(self.get_earliest_alert_jd(dps), coverage["earliest"])
+        jd_start = before_jd - self.history_days
+        if jd_start >= coverage["start"] and before_jd <= coverage["end"]:
+            return None
+        # request only the part preceding the covered interval
+        if coverage["start"] <= before_jd <= coverage["end"]:
+            return jd_start, coverage["start"]
+        return jd_start, before_jd
+
+    def prefetch(
+        self, alerts: Iterable[tuple[list[DataPoint], None | StockId]]
+    ) -> None:
+        """
+        Request the archival history of upcoming alerts in the background
+        (at most max_concurrent_requests at a time), so that :meth:`process`
+        does not have to wait on the archive service when they arrive.
+        Only pass alerts that will be ingested, e.g. accepted by the filters,
+        as every prefetch costs a t0 read and an archive request
+        (see ZiChainedT0Muxer, which prefetches the alert being ingested
+        while the preceding muxers of its chain work on it).
+
+        :param alerts: (datapoints, stock id) pairs of the alerts to be processed next
+        """
+        for dps, stock_id in alerts:
+            if stock_id is None or (interval := self.get_interval(stock_id, dps)) is None:
+                continue
+            if (prefetched := self._prefetched.get(key := (stock_id, *interval))):
+                self._prefetched[key] = prefetched[0], prefetched[1] + 1
+                continue
+            self._prefetched[key] = self.executor.submit(
+                self.get_photopoints, to_ztf_id(stock_id), interval[1], interval[0]
+            ), 1
+            while len(self._prefetched) > self.max_prefetched:
+                self._prefetched.pop(next(iter(self._prefetched)))[0].cancel()
+
+    def fetch_photopoints(
+        self, stock_id: StockId, interval: tuple[float, float]
+    ) -> Any:
+        """
+        Same as :meth:`get_photopoints`, but use the prefetched response if one
+        was requested for the same interval. NB: t0 may have changed since the
+        request was submitted; prefetched intervals that are no longer needed
+        are dropped once max_prefetched is exceeded.
+        """
+        if (prefetched := self._prefetched.pop(key := (stock_id, *interval), None)) is not None:
+            if prefetched[1] > 1:
+                self._prefetched[key] = prefetched[0], prefetched[1] - 1
+            return prefetched[0].result()
+        return self.get_photopoints(
+            to_ztf_id(stock_id), before_jd=interval[1], jd_start=interval[0]
+        )
+
     def process(
         self, dps: list[DataPoint], stock_id: None | StockId = None
     ) -> tuple[None | list[DataPoint], None | list[DataPoint]]:
@@ -136,19 +325,39 @@ class ZiArchiveMuxer(AbsT0Muxer):
         Attempt to determine which pps/uls should be inserted into the t0 collection,
         and which one should be marked as superseded.
         """
+        if stock_id is None or (interval := self.get_interval(stock_id, dps)) is None:
+            return dps, dps
+
         # Find photopoints from earlier alerts
-        if stock_id is None or not (
-            history := self.get_photopoints(
-                to_ztf_id(stock_id),
-                before_jd=self.get_earliest_jd(to_ztf_id(stock_id), dps),
+        history = self.fetch_photopoints(stock_id, interval)
+
+        if not history:
+            dps_to_insert = []
+        else:
+            alert = ZiAlertSupplier.shape_alert_dict(history)
+            dps_to_insert = self._shaper.process(alert.datapoints, stock_id)
+
+        if self.track_coverage:
+            self.updates_buffer.add_stock_update(
+                UpdateOne(
+                    {"stock": stock_id},
+                    {
+                        "$min": {
+                            "ztf_archive.start": interval[0],
+                            "ztf_archive.earliest": self.get_earliest_alert_jd(
+                                dps + dps_to_insert
+                            ),
+                        },
+                        "$max": {"ztf_archive.end": interval[1]},
+                    },
+                    upsert=True,
+                )
             )
-        ):
+
+        if not dps_to_insert:
             # no new points to add; use input points for combination
             return dps, dps
 
-        alert = ZiAlertSupplier.shape_alert_dict(history)
-        dps_to_insert = self._shaper.process(alert.datapoints, stock_id)
-
         extended_dps = sorted(dps_to_insert + dps, key=lambda d: d["body"]["jd"])
 
         return extended_dps, extended_dps
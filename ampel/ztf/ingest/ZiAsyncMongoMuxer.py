@@ -0,0 +1,102 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from collections.abc import Sequence
+from ampel.types import StockId
+from ampel.content.DataPoint import DataPoint
+from ampel.ztf.ingest.ZiMongoMuxer import ZiMongoMuxer
+
+
+class ZiAsyncMongoMuxer(ZiMongoMuxer):
+	"""
+	ZiMongoMuxer that can keep the t0 reads and supersession writes of several
+	alerts in flight at once. The (blocking) pymongo calls are offloaded to a
+	thread pool, as pymongo releases the GIL while waiting on the network.
+
+	Alerts of the same stock are processed strictly in the order they were
+	submitted, one at a time, so that the detection of concurrent updates
+	(see :class:`ConcurrentUpdateError`) works as in the synchronous case.
+
+	NB: this class is not registered as a unit. The ingestion handler of
+	AlertConsumer calls :meth:`process` one alert at a time, so configured
+	in its place the concurrent path would never be reached. It is meant to
+	be instantiated by a consumer that batches alerts and awaits
+	:meth:`process_many` itself.
+
+	A t0 snapshot shared with other muxers (see ZiChainedT0Muxer) holds the
+	documents of a single stock, so alerts are processed one at a time while
+	a snapshot is shared.
+	"""
+
+	#: Maximum number of alerts processed concurrently
+	max_concurrency: int = 8
+
+
+	def __init__(self, **kwargs) -> None:
+
+		super().__init__(**kwargs)
+		self._executor = ThreadPoolExecutor(
+			max_workers=self.max_concurrency,
+			thread_name_prefix=self.__class__.__name__
+		)
+		# stock -> (lock, number of pending alerts)
+		self._stock_locks: dict[None | StockId, tuple[asyncio.Lock, int]] = {}
+		self._snapshot_lock = Lock()
+
+
+	def close(self) -> None:
+		""" Shut down the worker threads, waiting for pending alerts """
+		self._executor.shutdown(wait=True)
+		super().close()
+
+
+	def __del__(self) -> None:
+		if hasattr(self, '_executor'):
+			self._executor.shutdown(wait=False)
+
+
+	def _process_confined(self,
+		dps: list[DataPoint],
+		stock_id: None | StockId = None
+	) -> tuple[None | list[DataPoint], None | list[DataPoint]]:
+		if self._t0_snapshot:
+			with self._snapshot_lock:
+				return self.process(dps, stock_id)
+		return self.process(dps, stock_id)
+
+
+	async def process_async(self,
+		dps: list[DataPoint],
+		stock_id: None | StockId = None
+	) -> tuple[None | list[DataPoint], None | list[DataPoint]]:
+		"""
+		Same as :meth:`process`, but runs in a worker thread. Calls for the same
+		stock are serialized in submission order.
+		"""
+
+		lock, pending = self._stock_locks.get(stock_id) or (asyncio.Lock(), 0)
+		self._stock_locks[stock_id] = lock, pending + 1
+
+		try:
+			async with lock:
+				return await asyncio.get_running_loop().run_in_executor(
+					self._executor, self._process_confined, dps, stock_id
+				)
+		finally:
+			lock, pending = self._stock_locks[stock_id]
+			if pending > 1:
+				self._stock_locks[stock_id] = lock, pending - 1
+			else:
+				del self._stock_locks[stock_id]
+
+
+	async def process_many(self,
+		alerts: Sequence[tuple[list[DataPoint], None | StockId]]
+	) -> list[tuple[None | list[DataPoint], None | list[DataPoint]]]:
+		"""
+		:param alerts: sequence of (datapoints, stock id) pairs, in the order the alerts were received
+		:returns: the results of :meth:`process` for each alert, in input order
+		"""
+		return await asyncio.gather(
+			*(self.process_async(dps, stock_id) for dps, stock_id in alerts)
+		)
@@ -0,0 +1,47 @@
+from ampel.types import StockId
+from ampel.content.DataPoint import DataPoint
+from ampel.ingest.ChainedT0Muxer import ChainedT0Muxer
+from ampel.ztf.ingest.T0Snapshot import T0Snapshot
+from ampel.ztf.ingest.ZiMongoMuxer import ZiMongoMuxer
+from ampel.ztf.ingest.ZiArchiveMuxer import ZiArchiveMuxer
+
+
+class ZiChainedT0Muxer(ChainedT0Muxer):
+	"""
+	ChainedT0Muxer that lets the ZTF muxers of the chain share a single read
+	of the stock's t0 documents per alert. The archival history requested by
+	a ZiArchiveMuxer of the chain is prefetched when the alert arrives, so
+	that the request overlaps the work of the preceding muxers.
+	"""
+
+	def __init__(self, **kwargs) -> None:
+
+		super().__init__(**kwargs)
+
+		self._t0_snapshot = T0Snapshot(
+			self.context.db.get_collection("t0"), ZiMongoMuxer.projection
+		)
+		for muxer in self._muxers:
+			if isinstance(muxer, (ZiMongoMuxer, ZiArchiveMuxer)):
+				muxer.share_t0_snapshot(self._t0_snapshot)
+		# archive muxers preceded by other muxers
+		self._prefetching = [
+			muxer for muxer in self._muxers[1:] if isinstance(muxer, ZiArchiveMuxer)
+		]
+
+
+	def process(self,
+		dps: list[DataPoint],
+		stock_id: None | StockId = None
+	) -> tuple[None | list[DataPoint], None | list[DataPoint]]:
+		# NB: the snapshot may have been read outside of an alert, e.g. by
+		# ZiArchiveMuxer.prefetch(), before t0 was updated
+		self._t0_snapshot.reset()
+		try:
+			# NB: the interval is determined from the same t0 snapshot, and the
+			# datapoints of t0 added to dps by preceding muxers do not change it
+			for muxer in self._prefetching:
+				muxer.prefetch([(dps, stock_id)])
+			return super().process(dps, stock_id)
+		finally:
+			self._t0_snapshot.reset()
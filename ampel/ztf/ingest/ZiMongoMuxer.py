@@ -7,7 +7,13 @@
 # Last Modified Date:  25.05.2021
 # Last Modified By:    valery brinnel <firstname.lastname@gmail.com>
 
+from time import time
+from threading import Lock
+from collections import defaultdict
+from collections.abc import Callable
 from typing import Any, Tuple
+import numpy as np
+from schedule import Job
 from bisect import bisect_right
 from pymongo import UpdateOne
 from ampel.types import DataPointId, StockId
@@ -15,6 +21,33 @@ from ampel.content.DataPoint import DataPoint
 from ampel.content.MetaRecord import MetaRecord
 from ampel.util.mappings import unflatten_dict
 from ampel.abstract.AbsT0Muxer import AbsT0Muxer
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+from ampel.ztf.ingest.buffer_hooks import on_stop
+from ampel.ztf.ingest.T0Snapshot import T0Snapshot
+
+stat_time = AmpelMetricsRegistry.histogram(
+	"time",
+	"Duration of ZiMongoMuxer processing phases",
+	unit="seconds",
+	subsystem="ztf_mongomuxer",
+	labelnames=("phase",)
+)
+stat_retries = AmpelMetricsRegistry.counter(
+	"retries",
+	"Number of alerts reprocessed due to concurrent t0 updates",
+	subsystem="ztf_mongomuxer",
+)
+stat_superseded = AmpelMetricsRegistry.counter(
+	"superseded",
+	"Number of datapoints marked as superseded",
+	subsystem="ztf_mongomuxer",
+)
+stat_dps_read = AmpelMetricsRegistry.gauge(
+	"datapoints",
+	"Number of datapoints read from t0 for the last processed stock",
+	subsystem="ztf_mongomuxer",
+	multiprocess_mode="liveall",
+)
 
 class ConcurrentUpdateError(Exception):
 	"""
@@ -38,6 +71,22 @@ class ZiMongoMuxer(AbsT0Muxer):
 	check_reprocessing: bool = True
 	alert_history_length: int = 30
 
+	#: Number of datapoints (db + alert) from which on supersessions are resolved
+	#: by sorting arrays rather than by per-datapoint insertion
+	sorted_supersession_threshold: int = 2000
+
+	#: Collect the SUPERSEDED updates of several alerts and write them with a
+	#: single unordered bulk write once supersession_flush_size updates are
+	#: pending or supersession_flush_interval seconds have passed (checked by a
+	#: job of the scheduler of the updates buffer), and when the updates buffer
+	#: is stopped at the end of a run.
+	#: Concurrent ingestion of the same stock is then detected at flush time
+	#: rather than per alert, and resolved by re-evaluating supersessions from
+	#: the db. NB: t1 states created from the affected alerts are not revised.
+	defer_supersession: bool = False
+	supersession_flush_size: int = 1000
+	supersession_flush_interval: float = 30.
+
 	# Be idempotent for the sake it (not required for prod)
 	idempotent: bool = False
 
@@ -59,9 +108,37 @@ class ZiMongoMuxer(AbsT0Muxer):
 		# used to check potentially already inserted pps
 		self._photo_col = self.context.db.get_collection("t0")
 		self._projection_spec = unflatten_dict(self.projection)
+		self._t0_snapshot: None | T0Snapshot = None
 
 		self._run_id = self.updates_buffer.run_id[0] if isinstance(self.updates_buffer.run_id, list) else self.updates_buffer.run_id
 
+		# deferred supersession updates (keyed by repr for deduplication),
+		# and stock -> datapoint ids seen when the updates were computed
+		self._deferred_ops: dict[str, UpdateOne] = {}
+		self._deferred_ids: dict[None | StockId, set[DataPointId]] = defaultdict(set)
+		self._deferred_since = 0.
+		self._deferred_lock = Lock()
+
+		if self.defer_supersession:
+			# flush pending updates every supersession_flush_interval seconds from
+			# the scheduler thread of the updates buffer, also when no alerts arrive
+			self._flush_job: None | Job = self.updates_buffer.get_scheduler() \
+				.every(self.supersession_flush_interval) \
+				.seconds \
+				.do(self.flush_supersessions)
+			# and a last time when the buffer is stopped, before its final push
+			on_stop(self.updates_buffer, self.close)
+		else:
+			self._flush_job = None
+
+
+	def close(self) -> None:
+		""" Write pending deferred supersession updates and stop the periodic flush """
+		if self._flush_job:
+			self.updates_buffer.get_scheduler().cancel_job(self._flush_job)
+			self._flush_job = None
+		self.flush_supersessions()
+
 
 	def process(self,
 		dps: list[DataPoint],
@@ -80,15 +157,29 @@ class ZiMongoMuxer(AbsT0Muxer):
 			try:
 				return self._process(dps, stock_id)
 			except ConcurrentUpdateError:
+				stat_retries.inc()
+				if self._t0_snapshot:
+					self._t0_snapshot.reset()
 				continue
 		else:
 			raise ConcurrentUpdateError(f"More than 10 iterations ingesting alert {dps[0]['id']}")
 
 
+	def share_t0_snapshot(self, snapshot: None | T0Snapshot) -> None:
+		""" Read t0 documents through a snapshot shared with other muxers """
+		self._t0_snapshot = snapshot
+
+
 	# NB: this 1-liner is a separate method to provide a patch point for race condition testing
 	def _get_dps(self, stock_id: None | StockId) -> list[DataPoint]:
 		return list(self._photo_col.find({'stock': stock_id}, self.projection))
 
+	def _get_dps_ids(self, stock_id: None | StockId) -> set[DataPointId]:
+		return {
+			doc['id']
+			for doc in self._photo_col.find({'stock': stock_id}, {'id': 1})
+		}
+
 	def _process(self,
 		dps: list[DataPoint],
 		stock_id: None | StockId = None
@@ -104,7 +195,9 @@ class ZiMongoMuxer(AbsT0Muxer):
 		#######################################
 
 		# New pps/uls lists for db loaded datapoints
-		dps_db = self._get_dps(stock_id)
+		with stat_time.labels("read").time():
+			dps_db = self._t0_snapshot.get(stock_id) if self._t0_snapshot else self._get_dps(stock_id)
+		stat_dps_read.set(len(dps_db))
 
 		ops = []
 		if self.check_reprocessing:
@@ -120,36 +213,12 @@ class ZiMongoMuxer(AbsT0Muxer):
 
 		# uniquify photopoints by jd, rcid. For duplicate points,
 		# choose the one with the larger id
-		# (jd, rcid) -> ids
-		unique_dps_ids: dict[tuple[float, int], list[DataPointId]] = {}
-		# id -> superseding ids
-		ids_dps_superseded: dict[DataPointId, list[DataPointId]] = {}
-		# id -> final datapoint
-		unique_dps: dict[DataPointId, DataPoint] = {}
-
-		for dp in dps_db + dps:
-
-			# jd alone is actually enough for matching pps reproc, but an upper limit can
-			# be associated with multiple stocks at the same jd. here, match also by rcid
-			key = (dp['body']['jd'], dp['body']['rcid'])
-
-			# print(dp['id'], key, key in unique_dps)
-
-			if target := unique_dps_ids.get(key):
-				# insert id in order
-				idx = bisect_right(target, dp['id'])
-				if idx == 0 or target[idx - 1] != dp['id']:
-					target.insert(idx, dp['id'])
-			else:
-				unique_dps_ids[key] = [dp['id']]
+		with stat_time.labels("supersession").time():
+			ids_dps_superseded, final_dps_set = self._get_supersessions(dps_db + dps)
 
-		# build set of supersessions
-		for simultaneous_dps in unique_dps_ids.values():
-			for i in range(len(simultaneous_dps) - 1):
-				ids_dps_superseded[simultaneous_dps[i]] = simultaneous_dps[i + 1:]
-		
 		# build final set of datapoints, preferring entries loaded from the db
-		final_dps_set = {v[-1] for v in unique_dps_ids.values()}
+		# id -> final datapoint
+		unique_dps: dict[DataPointId, DataPoint] = {}
 		for dp in dps_db + dps:
 			if dp['id'] in final_dps_set and not dp['id'] in unique_dps:
 				unique_dps[dp['id']] = dp
@@ -173,17 +242,16 @@ class ZiMongoMuxer(AbsT0Muxer):
 
 				# point is newly superseded
 				if 'SUPERSEDED' not in dp['tag']:
+					stat_superseded.inc()
 					# mutate a copy, as the default tag list may be shared between all datapoints
 					dp['tag'] = list(dp['tag'])
 					dp['tag'].append('SUPERSEDED') # type: ignore[attr-defined]
 				
 				# point may be superseded by more than one new datapoint
 				meta: list[MetaRecord] = list(dp.get("meta", []))
+				known_ids = self._superseding_ids(meta)
 				for newId in ids_dps_superseded[dp['id']]:
-					if not any(
-						m.get('extra', {}).get('newId') == newId
-						for m in meta if m.get('tag') == 'SUPERSEDED'
-					):
+					if newId not in known_ids:
 						meta.append({
 							"run": self._run_id,
 							"traceid": {"muxer": self._trace_id},
@@ -196,78 +264,22 @@ class ZiMongoMuxer(AbsT0Muxer):
 		####################################################
 
 		if self.check_reprocessing:
-			for dp in dps_db or []:
-				if dp['id'] in ids_dps_superseded:
-
-					self.logger.info(
-						f'Marking datapoint {dp["id"]} '
-						f'as superseded by {ids_dps_superseded[dp["id"]]}'
-					)
-
-					# point is newly superseded
-					if 'SUPERSEDED' not in dp['tag']:
-						dp['tag'].append('SUPERSEDED') # type: ignore[attr-defined]
-						add_update(
-							UpdateOne(
-								{
-									'id': dp['id'],
-								},
-								{
-									'$addToSet': {'tag': 'SUPERSEDED'}
-								}
-							)
-						)
-					
-					# point may be superseded by more than one new datapoint
-					meta = list(dp.get("meta", []))
-					for newId in ids_dps_superseded[dp['id']]:
-						if not any(
-							m.get('extra', {}).get('newId') == newId
-							for m in meta if m.get('tag') == 'SUPERSEDED'
-						):
-							entry: MetaRecord = {
-								"run": self._run_id,
-								"traceid": {"muxer": self._trace_id},
-								"tag": "SUPERSEDED",
-								"extra": {"newId": newId}
-							}
-							meta.append(entry)
-							# issue idempotent update
-							add_update(
-								UpdateOne(
-									{
-										'id': dp['id'],
-										'meta': {
-											'$not': {
-												'$elemMatch': {
-													'tag': 'SUPERSEDED',
-													'extra.newId': newId
-												}
-											}
-										}
-									},
-									{
-										'$push': {'meta': entry}
-									}
-								)
-							)
-					dp['meta'] = meta
+			self._supersede_db_dps(dps_db, ids_dps_superseded, add_update)
 
 		# Part 4: commit ops and check for conflicts
 		############################################
-		if self.check_reprocessing:
+		if self.check_reprocessing and self.defer_supersession:
+			self._defer(stock_id, ids_dps_db | ids_dps_alert, ops)
+		elif self.check_reprocessing:
 			# Commit ops, retrying on upsert races
 			if ops:
-				self.updates_buffer.call_bulk_write('t0', ops)
+				with stat_time.labels("write").time():
+					self.updates_buffer.call_bulk_write('t0', ops)
 			# If another query returns docs not present in the first query, the
 			# set of superseded photopoints may be incomplete.
-			if concurrent_updates := (
-				{
-					doc['id']
-					for doc in self._photo_col.find({'stock': stock_id}, {'id': 1})
-				} \
-				- (ids_dps_db | ids_dps_alert)
-			):
+			with stat_time.labels("recheck").time():
+				ids_dps_now = self._get_dps_ids(stock_id)
+			if concurrent_updates := (ids_dps_now - (ids_dps_db | ids_dps_alert)):
 				raise ConcurrentUpdateError(f"t0 collection contains {len(concurrent_updates)} extra photopoints: {concurrent_updates}")
 
 		# The union of the datapoints drawn from the db and
@@ -293,6 +305,235 @@ class ZiMongoMuxer(AbsT0Muxer):
 		return [dp for dp in dps if dp['id'] in ids_dps_to_insert], dps_combine
 
 
+	def _defer(self,
+		stock_id: None | StockId,
+		ids: set[DataPointId],
+		ops: list[UpdateOne]
+	) -> None:
+		with self._deferred_lock:
+			if not self._deferred_ids:
+				self._deferred_since = time()
+			self._deferred_ids[stock_id] |= ids
+			for op in ops:
+				self._deferred_ops[repr(op)] = op
+			flush = (
+				len(self._deferred_ops) >= self.supersession_flush_size or
+				time() - self._deferred_since >= self.supersession_flush_interval
+			)
+		if flush:
+			self.flush_supersessions()
+
+
+	def flush_supersessions(self) -> None:
+		"""
+		Write deferred SUPERSEDED updates, then check the affected stocks for
+		datapoints that were ingested concurrently and unknown at the time the
+		updates were computed. Supersessions of such stocks are re-evaluated
+		from the db.
+		"""
+		with self._deferred_lock:
+			ops, known_ids = list(self._deferred_ops.values()), self._deferred_ids
+			self._deferred_ops, self._deferred_ids = {}, defaultdict(set)
+
+		if not known_ids:
+			return
+
+		if ops:
+			with stat_time.labels("write").time():
+				self.updates_buffer.call_bulk_write('t0', ops)
+
+		# Re-read the datapoint ids of all affected stocks at once
+		db_ids: dict[None | StockId, set[DataPointId]] = defaultdict(set)
+		with stat_time.labels("recheck").time():
+			for doc in self._photo_col.find({'stock': {'$in': list(known_ids)}}, {'_id': 0, 'id': 1, 'stock': 1}):
+				for stock_id in (doc['stock'] if isinstance(doc['stock'], list) else [doc['stock']]):
+					if stock_id in known_ids:
+						db_ids[stock_id].add(doc['id'])
+
+		for stock_id, ids in known_ids.items():
+			if concurrent_updates := db_ids[stock_id] - ids:
+				self.logger.info(
+					f"t0 collection contains {len(concurrent_updates)} extra photopoints "
+					f"for stock {stock_id}, re-evaluating supersessions"
+				)
+				dps_db = self._get_dps(stock_id)
+				ids_dps_superseded, _ = self._get_supersessions(dps_db)
+				ops = []
+				self._supersede_db_dps(dps_db, ids_dps_superseded, ops.append)
+				if ops:
+					self.updates_buffer.call_bulk_write('t0', ops)
+
+
+	def _supersede_db_dps(self,
+		dps_db: list[DataPoint],
+		ids_dps_superseded: dict[DataPointId, list[DataPointId]],
+		add_update: Callable[[UpdateOne], Any]
+	) -> None:
+		"""
+		Tag datapoints loaded from the db as superseded (in place), passing
+		the corresponding idempotent updates to add_update
+		"""
+		for dp in dps_db or []:
+			if dp['id'] in ids_dps_superseded:
+
+				self.logger.info(
+					f'Marking datapoint {dp["id"]} '
+					f'as superseded by {ids_dps_superseded[dp["id"]]}'
+				)
+
+				# point is newly superseded
+				if 'SUPERSEDED' not in dp['tag']:
+					stat_superseded.inc()
+					dp['tag'].append('SUPERSEDED') # type: ignore[attr-defined]
+					add_update(
+						UpdateOne(
+							{
+								'id': dp['id'],
+							},
+							{
+								'$addToSet': {'tag': 'SUPERSEDED'}
+							}
+						)
+					)
+				
+				# point may be superseded by more than one new datapoint
+				meta = list(dp.get("meta", []))
+				known_ids = self._superseding_ids(meta)
+				for newId in ids_dps_superseded[dp['id']]:
+					if newId not in known_ids:
+						entry: MetaRecord = {
+							"run": self._run_id,
+							"traceid": {"muxer": self._trace_id},
+							"tag": "SUPERSEDED",
+							"extra": {"newId": newId}
+						}
+						meta.append(entry)
+						# issue idempotent update
+						add_update(
+							UpdateOne(
+								{
+									'id': dp['id'],
+									'meta': {
+										'$not': {
+											'$elemMatch': {
+												'tag': 'SUPERSEDED',
+												'extra.newId': newId
+											}
+										}
+									}
+								},
+								{
+									'$push': {'meta': entry}
+								}
+							)
+						)
+				dp['meta'] = meta
+
+
+	def _get_supersessions(self,
+		dps: list[DataPoint]
+	) -> tuple[dict[DataPointId, list[DataPointId]], set[DataPointId]]:
+		if len(dps) < self.sorted_supersession_threshold:
+			return self._resolve_supersessions(dps)
+		return self._resolve_supersessions_sorted(dps)
+
+
+	@staticmethod
+	def _resolve_supersessions(
+		dps: list[DataPoint]
+	) -> tuple[dict[DataPointId, list[DataPointId]], set[DataPointId]]:
+		"""
+		Group datapoints by (jd, rcid), inserting ids in order.
+
+		:returns: mapping of superseded id -> superseding ids, and the set of
+		  ids that are not superseded
+		"""
+
+		# (jd, rcid) -> ids
+		unique_dps_ids: dict[tuple[float, int], list[DataPointId]] = {}
+		# id -> superseding ids
+		ids_dps_superseded: dict[DataPointId, list[DataPointId]] = {}
+
+		for dp in dps:
+
+			# jd alone is actually enough for matching pps reproc, but an upper limit can
+			# be associated with multiple stocks at the same jd. here, match also by rcid
+			key = (dp['body']['jd'], dp['body']['rcid'])
+
+			if target := unique_dps_ids.get(key):
+				# insert id in order
+				idx = bisect_right(target, dp['id'])
+				if idx == 0 or target[idx - 1] != dp['id']:
+					target.insert(idx, dp['id'])
+			else:
+				unique_dps_ids[key] = [dp['id']]
+
+		# build set of supersessions
+		for simultaneous_dps in unique_dps_ids.values():
+			for i in range(len(simultaneous_dps) - 1):
+				ids_dps_superseded[simultaneous_dps[i]] = simultaneous_dps[i + 1:]
+
+		return ids_dps_superseded, {v[-1] for v in unique_dps_ids.values()}
+
+
+	@classmethod
+	def _resolve_supersessions_sorted(cls,
+		dps: list[DataPoint]
+	) -> tuple[dict[DataPointId, list[DataPointId]], set[DataPointId]]:
+		"""
+		Same as :meth:`_resolve_supersessions`, but groups datapoints by
+		sorting arrays of (jd, rcid, id) rather than by incremental insertion.
+		Scales better for stocks with very long histories.
+		"""
+
+		if not (count := len(dps)):
+			return {}, set()
+		try:
+			ids = np.fromiter((dp['id'] for dp in dps), dtype=np.int64, count=count)
+		except OverflowError:
+			# ids that do not fit into int64 (non-ZTF datapoints)
+			return cls._resolve_supersessions(dps)
+		jds = np.fromiter((dp['body']['jd'] for dp in dps), dtype=np.float64, count=count)
+		rcids = np.fromiter((dp['body']['rcid'] for dp in dps), dtype=np.int64, count=count)
+
+		# sort by jd, then rcid, then id
+		order = np.lexsort((ids, rcids, jds))
+		ids, jds, rcids = ids[order], jds[order], rcids[order]
+
+		# boundaries between (jd, rcid) groups
+		new_key = np.ones(count, dtype=bool)
+		new_key[1:] = (jds[1:] != jds[:-1]) | (rcids[1:] != rcids[:-1])
+
+		# drop repeated ids within a group (points present in both db and alert)
+		keep = new_key.copy()
+		keep[1:] |= ids[1:] != ids[:-1]
+		ids, new_key = ids[keep], new_key[keep]
+
+		starts = np.flatnonzero(new_key)
+		ends = np.append(starts[1:], len(ids))
+		multiple = ends - starts > 1
+
+		# id -> superseding ids
+		ids_dps_superseded: dict[DataPointId, list[DataPointId]] = {}
+		for start, end in zip(starts[multiple].tolist(), ends[multiple].tolist()):
+			group = ids[start:end].tolist()
+			for i in range(len(group) - 1):
+				ids_dps_superseded[group[i]] = group[i + 1:]
+
+		return ids_dps_superseded, set(ids[ends - 1].tolist())
+
+
+	@staticmethod
+	def _superseding_ids(meta: list[MetaRecord]) -> set[DataPointId]:
+		"""
+		:returns: ids of the datapoints referenced by SUPERSEDED meta records
+		"""
+		return {
+			m['extra']['newId'] for m in meta
+			if m.get('tag') == 'SUPERSEDED' and 'newId' in m.get('extra', {})
+		}
+
+
 	def _project(self, doc, projection):
 
 		out: dict[str, Any] = {}
@@ -0,0 +1,17 @@
+from collections.abc import Callable
+from ampel.mongo.update.DBUpdatesBuffer import DBUpdatesBuffer
+
+
+def on_stop(updates_buffer: DBUpdatesBuffer, callback: Callable[[], None]) -> None:
+	"""
+	Call callback when updates_buffer is stopped, which AlertConsumer does at
+	the end of every run, interrupted or not. Schedulable.stop() runs its stop
+	callback once the scheduler thread has joined, and DBUpdatesBuffer.stop()
+	then pushes the remaining updates. Callbacks registered earlier run last.
+	"""
+	prev_callback = updates_buffer._stop_callback
+	def stop_callback() -> None:
+		callback()
+		if prev_callback:
+			prev_callback()
+	updates_buffer._stop_callback = stop_callback
@@ -0,0 +1,65 @@
+from typing import Any
+from pymongo.collection import Collection
+from ampel.log.AmpelLogger import AmpelLogger
+
+# Index walked in jd order by ZiArchiveMuxer (walk_jd_index), so that
+# {'stock': x, 'id': {'$gt': 0}, 'body.jd': {'$lt': y}} sorted by jd stops at
+# the first match instead of reading every datapoint of the stock.
+# NB: 'stock' is an array in t0 ($addToSet), which makes this index multikey:
+# MongoDB can not answer queries from it alone, documents are always fetched.
+t0_stock_jd_id: list[tuple[str, int]] = [("stock", 1), ("body.jd", 1), ("id", 1)]
+
+# Indexes the ZTF t0 access patterns rely on. The first two are also
+# declared by ampel-core (conf/ampel-core/mongo/data.yaml) and listed here
+# so that they can be verified along with the ZTF-specific ones.
+t0_indexes: list[dict[str, Any]] = [
+	# upserts by MongoT0Ingester, supersession updates
+	{"index": [("id", 1)], "args": {"unique": True}},
+	# ZiMongoMuxer._get_dps
+	{"index": [("stock", 1)], "args": {"sparse": True}},
+	# ZiArchiveMuxer.get_earliest_jd
+	{"index": t0_stock_jd_id},
+]
+
+
+def get_index_id(index: list[tuple[str, int]]) -> str:
+	"""
+	Returns an index id similar to what pymongo index_information outputs.
+	Ex: [('stock', 1), ('body.jd', 1)] -> stock_1_body.jd_1
+	"""
+	return "_".join(f"{field}_{direction}" for field, direction in index)
+
+
+def check_t0_indexes(col: Collection) -> list[dict[str, Any]]:
+	"""
+	:returns: entries of `t0_indexes` that are not present in the collection
+	"""
+	# NB: directions are compared as stored, as they are not necessarily
+	# numeric (e.g. 'text' or '2dsphere'); 1 == 1.0 hashes identically
+	existing = {
+		tuple((k, d) for k, d in info["key"])
+		for info in col.index_information().values()
+	}
+	return [
+		idx for idx in t0_indexes
+		if tuple(idx["index"]) not in existing
+	]
+
+
+def ensure_t0_indexes(col: Collection, logger: AmpelLogger, create: bool = False) -> list[dict[str, Any]]:
+	"""
+	Verify that the indexes required by ZTF muxers exist, creating them if requested.
+
+	:returns: indexes still missing after the operation
+	"""
+	missing = check_t0_indexes(col)
+	for idx in t0_indexes:
+		if idx in missing:
+			if create:
+				logger.info(f"Creating index {get_index_id(idx['index'])} on {col.full_name}")
+				col.create_index(idx["index"], **idx.get("args", {}))
+			else:
+				logger.warn(f"Index {get_index_id(idx['index'])} missing on {col.full_name}")
+		else:
+			logger.info(f"Index {get_index_id(idx['index'])} present on {col.full_name}")
+	return check_t0_indexes(col) if create else missing
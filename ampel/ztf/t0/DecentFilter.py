@@ -7,14 +7,73 @@
 # Last Modified Date:  10.03.2021
 # Last Modified By:    Jakob van Santen <jakob.van.santen@desy.de>
 
+import atexit, json
 import numpy as np
+from functools import cache
+from time import monotonic, perf_counter
 from typing import Any
-from astropy.table import Table
+from collections.abc import Callable, Sequence
 from astropy.coordinates import SkyCoord
 
 from ampel.abstract.AbsAlertFilter import AbsAlertFilter
-from ampel.ztf.base.CatalogMatchUnit import CatalogMatchUnit
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+from ampel.ztf.base.AlertCache import alert_cache
+from ampel.ztf.base.CatalogMatchUnit import CatalogItem, CatalogMatchUnit, ConeSearchRequest
+from ampel.ztf.base.ConeSearchGuard import ConeSearchUnavailable, FallbackResult
+from ampel.ztf.base.PositionMemo import PositionMemo, PositionMemoConfig
+from ampel.ztf.base.RejectionStats import RejectionStats, close_at_exit, stats_logger
 from ampel.protocol.AmpelAlertProtocol import AmpelAlertProtocol
+from ampel.types import StockId
+
+#: columns of GAIA DR2 matches used by DecentFilter.has_gaia_star
+GAIA_KEYS = (
+    "Mag_G",
+    "PMRA",
+    "ErrPMRA",
+    "PMDec",
+    "ErrPMDec",
+    "Plx",
+    "ErrPlx",
+    "ExcessNoiseSig",
+)
+
+#: cuts on the latest photopoint that are cheap and independent of each
+#: other, in default order
+CHEAP_CUTS = (
+    "isdiffpos",
+    "rb",
+    "drb",
+    "fwhm",
+    "elong",
+    "magdiff",
+    "archive_tspan",
+    "ssdistnr",
+    "ps1_star",
+    "ps1_confusion",
+)
+#: cuts that always run last, in this order
+EXPENSIVE_CUTS = ("gal_lat", "gaia")
+
+stat_cuts = AmpelMetricsRegistry.counter(
+    "cuts",
+    "Number of alerts evaluated and rejected by each cut",
+    subsystem="decentfilter",
+    labelnames=("cut", "outcome"),
+)
+stat_cut_time = AmpelMetricsRegistry.counter(
+    "cut_time",
+    "Time spent evaluating each cut",
+    unit="seconds",
+    subsystem="decentfilter",
+    labelnames=("cut",),
+)
+stat_cut_position = AmpelMetricsRegistry.gauge(
+    "cut_position",
+    "Position of each cut in the evaluation order",
+    subsystem="decentfilter",
+    labelnames=("cut",),
+    multiprocess_mode="liveall",
+)
 
 
 class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
@@ -65,6 +124,21 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
     gaia_veto_gmag_max: float  # max gmag for normalized distance cut of GAIA counterparts [mag]
     gaia_excessnoise_sig_max: float  # maximum allowed noise (expressed as significance) for Gaia match to be trusted.
 
+    # Cut and rejection statistics
+    cut_stats_interval: int = 1000  # number of alerts between updates of the cut metrics, order and rejection summary
+    cut_stats_seconds: float = 60.0  # maximum time between updates, checked when an alert arrives (pending ones are published by close() and at exit)
+    adaptive_cut_order: bool = False  # reorder the cheap cuts by rejections per second of evaluation time
+    log_rejections: bool = False  # log every rejected alert, in addition to the periodic rejection summary
+    rejection_stats_seconds: None | float = None  # maximum time between rejection summaries, also without alerts, flushed from a background thread. Disabled if None
+
+    # Memo of the galactic latitude and GAIA verdicts of each stock, shared by the
+    # instances of the process with the same memo config. Disabled if None.
+    position_memo: None | PositionMemoConfig = None
+
+    # Share the galactic latitude and GAIA matches of an alert with the other filters
+    # of the process (e.g. of merged channels) processing the same alert. Not used by process_many
+    use_alert_cache: bool = False
+
     def post_init(self):
 
         # feedback
@@ -91,16 +165,45 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
             "ssdistnr",
         )
 
+        self._cut_stats: dict[str, list] = {
+            name: [0, 0, 0.0] for name in ("history",) + CHEAP_CUTS + EXPENSIVE_CUTS
+        }
+        self._cut_scores: dict[str, list[float]] = {}
+        self._cut_totals: dict[str, list] = {name: [0, 0, 0.0] for name in self._cut_stats}
+        self._gaia_request_key = json.dumps(self.gaia_request, sort_keys=True)
+        self._memo = PositionMemo.shared(self.position_memo) if self.position_memo else None
+        # memo keys of the expensive cuts depending only on the position, including their
+        # parameters. NB: the PS1 cuts read the alert's own distpsnr/sgscore fields, which
+        # are cheaper to check than to look up, and differ between alerts at the same position
+        self._memo_keys: dict[str, tuple] = {
+            "gal_lat": ("gal_lat", self.min_gal_lat),
+            "gaia": (
+                "gaia", self.gaia_rs, self.gaia_pm_signif, self.gaia_plx_signif, self.gaia_veto_gmag_min,
+                self.gaia_veto_gmag_max, self.gaia_excessnoise_sig_max,
+            ),
+        }
+        self._rejections = RejectionStats(
+            self.__class__.__name__, self.logger, self.log_rejections, self.rejection_stats_seconds
+        )
+        self._alerts_since_flush = 0
+        self._last_flush = monotonic()
+        # summaries and cut orders are not about the alert being filtered
+        self._stats_logger = stats_logger(self.__class__.__name__)
+        # publish what is pending when the interpreter exits
+        self._close_at_exit = close_at_exit(self)
+        # the drb cut is disabled unless min_drb > 0
+        self._set_cut_order([name for name in CHEAP_CUTS if name != "drb" or self.min_drb > 0.0])
+
     def _alert_has_keys(self, photop) -> bool:
         """
         check that given photopoint contains all the keys needed to filter
         """
         for el in self.keys_to_check:
             if el not in photop:
-                self.logger.info(None, extra={"missing": el})
+                self._rejections.reject({"missing": el})
                 return False
             if photop[el] is None:
-                self.logger.info(None, extra={"isNone": el})
+                self._rejections.reject({"isNone": el})
                 return False
         return True
 
@@ -108,8 +211,12 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
         """
         compute galactic latitude of the transient
         """
-        coordinates = SkyCoord(transient["ra"], transient["dec"], unit="deg")
-        return coordinates.galactic.b.deg
+        if self.use_alert_cache:
+            return alert_cache.get(
+                ("galactic_latitude", transient["ra"], transient["dec"]),
+                lambda: float(galactic_latitude(transient["ra"], transient["dec"])),
+            )
+        return float(galactic_latitude(transient["ra"], transient["dec"]))
 
     def is_star_in_PS1(self, transient) -> bool:
         """
@@ -154,6 +261,15 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
 
         return sg_confused and very_close
 
+    @property
+    def gaia_request(self) -> ConeSearchRequest:
+        return {
+            "name": "GAIADR2",
+            "use": "catsHTM",
+            "rs_arcsec": self.gaia_rs,
+            "keys_to_append": list(GAIA_KEYS),
+        }
+
     def is_star_in_gaia(self, transient: dict[str, Any]) -> bool:
         """
         match tranient position with GAIA DR2 and uses parallax
@@ -161,79 +277,280 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
         returns: True (is a star) or False otehrwise.
         """
 
-        srcs = self.cone_search_all(
-            transient["ra"],
-            transient["dec"],
+        return self.has_gaia_star(self._gaia_matches(transient)[0])
+
+    def _gaia_matches(self, transient: dict[str, Any]) -> list[None | list[CatalogItem]]:
+        """
+        result of the GAIA cone search, a FallbackResult if the cone search guard failed open
+        """
+        if self.use_alert_cache:
+            return alert_cache.get(
+                ("cone_search_all", transient["ra"], transient["dec"], self._gaia_request_key),
+                lambda: self.cone_search_all(transient["ra"], transient["dec"], [self.gaia_request]),
+            )
+        return self.cone_search_all(transient["ra"], transient["dec"], [self.gaia_request])
+
+    def has_gaia_star(self, srcs: None | list[CatalogItem]) -> bool:
+        """
+        use parallax and proper motion of GAIA DR2 matches to evaluate star-likeliness
+        returns: True (is a star) or False otehrwise.
+        """
+        if not srcs:
+            return False
+
+        # NB: plain arrays rather than an astropy Table, whose overhead
+        # dominates for the few sources of a cone search
+        mag_g, pmra, err_pmra, pmdec, err_pmdec, plx, err_plx, excess_noise_sig = np.array(
             [
-                {
-                    "name": "GAIADR2",
-                    "use": "catsHTM",
-                    "rs_arcsec": self.gaia_rs,
-                    "keys_to_append": [
-                        "Mag_G",
-                        "PMRA",
-                        "ErrPMRA",
-                        "PMDec",
-                        "ErrPMDec",
-                        "Plx",
-                        "ErrPlx",
-                        "ExcessNoiseSig",
-                    ],
-                }
+                [np.nan if (v := src["body"].get(k)) is None else v for k in GAIA_KEYS]
+                for src in srcs
             ],
-        )[0]
-
-        if srcs:
+            dtype=float,
+        ).T
+        distance = np.array([src["dist_arcsec"] for src in srcs], dtype=float)
 
-            gaia_tab = Table(
-                [
-                    {k: np.nan if v is None else v for k, v in src["body"].items()}
-                    for src in srcs
-                ]
-            )
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
 
-            # compute distance
-            gaia_tab["DISTANCE"] = [src["dist_arcsec"] for src in srcs]
-            gaia_tab["DISTANCE_NORM"] = (
-                1.8 + 0.6 * np.exp((20 - gaia_tab["Mag_G"]) / 2.05)
-                > gaia_tab["DISTANCE"]
+            # select just the sources that are close enough and that are not noisy
+            flag_prox = (
+                (1.8 + 0.6 * np.exp((20 - mag_g) / 2.05) > distance)
+                & (self.gaia_veto_gmag_min <= mag_g)
+                & (mag_g <= self.gaia_veto_gmag_max)
             )
-            gaia_tab["FLAG_PROX"] = [
-                x["DISTANCE_NORM"]
-                and self.gaia_veto_gmag_min <= x["Mag_G"] <= self.gaia_veto_gmag_max
-                for x in gaia_tab
-            ]
+            # take into account precison of the astrometric solution via the ExcessNoise key
+            flag_clean = excess_noise_sig < self.gaia_excessnoise_sig_max
 
             # check for proper motion and parallax conditioned to distance
-            gaia_tab["FLAG_PMRA"] = (
-                abs(gaia_tab["PMRA"] / gaia_tab["ErrPMRA"]) > self.gaia_pm_signif
-            )
-            gaia_tab["FLAG_PMDec"] = (
-                abs(gaia_tab["PMDec"] / gaia_tab["ErrPMDec"]) > self.gaia_pm_signif
-            )
-            gaia_tab["FLAG_Plx"] = (
-                abs(gaia_tab["Plx"] / gaia_tab["ErrPlx"]) > self.gaia_plx_signif
+            flag_moving = (
+                (np.abs(pmra / err_pmra) > self.gaia_pm_signif)
+                | (np.abs(pmdec / err_pmdec) > self.gaia_pm_signif)
+                | (np.abs(plx / err_plx) > self.gaia_plx_signif)
             )
 
-            # take into account precison of the astrometric solution via the ExcessNoise key
-            gaia_tab["FLAG_Clean"] = (
-                gaia_tab["ExcessNoiseSig"] < self.gaia_excessnoise_sig_max
+        # among the remaining sources there is anything with
+        # significant proper motion or parallax measurement
+        return bool((flag_prox & flag_clean & flag_moving).any())
+
+    # CUTS ON THE LATEST PHOTOPOINT
+    # each returns None if the photopoint passes, the rejection log extra otherwise
+    ###############################################################################
+
+    def _cut_isdiffpos(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        if latest["isdiffpos"] == "f" or latest["isdiffpos"] == "0":
+            return {"isdiffpos": latest["isdiffpos"]}
+        return None
+
+    def _cut_rb(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        if latest["rb"] < self.min_rb:
+            return {"rb": latest["rb"]}
+        return None
+
+    def _cut_drb(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        if latest["drb"] < self.min_drb:
+            return {"drb": latest["drb"]}
+        return None
+
+    def _cut_fwhm(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        if latest["fwhm"] > self.max_fwhm:
+            return {"fwhm": latest["fwhm"]}
+        return None
+
+    def _cut_elong(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        if latest["elong"] > self.max_elong:
+            return {"elong": latest["elong"]}
+        return None
+
+    def _cut_magdiff(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        if abs(latest["magdiff"]) > self.max_magdiff:
+            return {"magdiff": latest["magdiff"]}
+        return None
+
+    def _cut_archive_tspan(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        if 'jdendhist' in latest.keys() and 'jdstarthist' in latest.keys():
+            archive_tspan = latest['jdendhist'] - latest['jdstarthist']
+            if not (self.min_archive_tspan < archive_tspan < self.max_archive_tspan):
+                return {'archive_tspan': archive_tspan}
+        return None
+
+    def _cut_ssdistnr(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        # check for closeby ss objects
+        if 0 <= latest["ssdistnr"] < self.min_sso_dist:
+            return {"ssdistnr": latest["ssdistnr"]}
+        return None
+
+    def _cut_ps1_star(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        if self.is_star_in_PS1(latest):
+            return {"distpsnr1": latest["distpsnr1"]}
+        return None
+
+    def _cut_ps1_confusion(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        if self.is_confused_in_PS1(latest):
+            return {"ps1Confusion": True}
+        return None
+
+    def _cut_gal_lat(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        b = self.get_galactic_latitude(latest)
+        if abs(b) < self.min_gal_lat:
+            return {"galPlane": abs(b)}
+        return None
+
+    def _cut_gaia(self, latest: dict[str, Any]) -> None | dict[str, Any]:
+        return self._verdict_gaia(latest)[0]
+
+    # verdicts of the memoized cuts: rejection reason, and whether it may be memoized
+
+    def _verdict_gal_lat(self, latest: dict[str, Any]) -> tuple[None | dict[str, Any], bool]:
+        return self._cut_gal_lat(latest), True
+
+    def _verdict_gaia(self, latest: dict[str, Any]) -> tuple[None | dict[str, Any], bool]:
+        if self.gaia_rs <= 0:
+            return None, True
+        try:
+            matches = self._gaia_matches(latest)
+        except ConeSearchUnavailable:
+            # fail closed: reject, but check again once the service is back
+            return {"gaiaUnavailable": True}, False
+        # NB: a fallback only stands in for the unknown matches until the service is back
+        return (
+            {"gaiaIsStar": True} if self.has_gaia_star(matches[0]) else None,
+            not isinstance(matches, FallbackResult),
+        )
+
+    # MEMOIZED POSITION-DERIVED CUTS
+    ################################
+
+    def _memoized(self, name: str, stock: StockId, latest: dict[str, Any]) -> None | dict[str, Any]:
+        assert self._memo is not None
+        found, reason = self._memo.get(stock, latest["ra"], latest["dec"], self._memo_keys[name])
+        if not found:
+            reason, memoizable = getattr(self, f"_verdict_{name}")(latest)
+            if memoizable:
+                self._memo.put(stock, latest["ra"], latest["dec"], self._memo_keys[name], reason)
+        return reason
+
+    def _memoized_many(
+        self,
+        name: str,
+        evaluate: Callable[[list[dict[str, Any]]], list[tuple[None | dict[str, Any], bool]]],
+        stocks: Sequence[StockId],
+        pps: list[dict[str, Any]],
+    ) -> list[None | dict[str, Any]]:
+        """
+        reasons of the verdicts evaluate(pps), evaluating only the photopoints
+        whose reason is not memoized
+        """
+        if self._memo is None or name not in self._memo_keys:
+            return [reason for reason, _ in evaluate(pps)]
+        key = self._memo_keys[name]
+        reasons: list[None | dict[str, Any]] = [None] * len(pps)
+        missing: list[int] = []
+        for j, (stock, pp) in enumerate(zip(stocks, pps)):
+            found, reasons[j] = self._memo.get(stock, pp["ra"], pp["dec"], key)
+            if not found:
+                missing.append(j)
+        if missing:
+            for j, (reason, memoizable) in zip(missing, evaluate([pps[j] for j in missing])):
+                reasons[j] = reason
+                if memoizable:
+                    self._memo.put(stocks[j], pps[j]["ra"], pps[j]["dec"], key, reason)
+        return reasons
+
+    # CUT STATISTICS
+    ################
+
+    def _record_cut(self, name: str, evaluated: int, rejected: int, seconds: float) -> None:
+        stats = self._cut_stats[name]
+        stats[0] += evaluated
+        stats[1] += rejected
+        stats[2] += seconds
+
+    def _count_alerts(self, n: int) -> None:
+        """
+        count the alerts about to be filtered, after flushing the statistics
+        if the previous ones complete an interval
+        """
+        if self._alerts_since_flush and (
+            self._alerts_since_flush >= self.cut_stats_interval
+            or monotonic() - self._last_flush >= self.cut_stats_seconds
+        ):
+            self.flush_cut_stats()
+        self._alerts_since_flush += n
+        self._rejections.count(n)
+
+    def flush_cut_stats(self) -> None:
+        """
+        publish the cut statistics accumulated since the last call as metrics,
+        and reorder the cheap cuts if adaptive_cut_order is set.
+        Also flushes the rejection statistics.
+        """
+        self._rejections.flush()
+        for name, (evaluated, rejected, seconds) in self._cut_stats.items():
+            totals = self._cut_totals[name]
+            totals[0] += evaluated
+            totals[1] += rejected
+            totals[2] += seconds
+            if evaluated:
+                stat_cuts.labels(name, "evaluated").inc(evaluated)
+                stat_cuts.labels(name, "rejected").inc(rejected)
+                stat_cut_time.labels(name).inc(seconds)
+            # exponentially decaying totals, so that the order follows changes
+            # of rejection rates (e.g. with season or sky area)
+            score = self._cut_scores.setdefault(name, [0.0, 0.0])
+            score[0] = score[0] / 2 + rejected
+            score[1] = score[1] / 2 + seconds
+        self._cut_stats = {name: [0, 0, 0.0] for name in self._cut_stats}
+        self._alerts_since_flush = 0
+        self._last_flush = monotonic()
+        if self.adaptive_cut_order:
+            self._set_cut_order(
+                sorted(
+                    self._cut_order,
+                    key=lambda name: -self._cut_scores[name][0] / self._cut_scores[name][1]
+                    if self._cut_scores[name][1] > 0 else 0.0
+                )
             )
 
-            # select just the sources that are close enough and that are not noisy
-            gaia_tab = gaia_tab[gaia_tab["FLAG_PROX"]]
-            gaia_tab = gaia_tab[gaia_tab["FLAG_Clean"]]
+    def close(self) -> None:
+        """
+        publish the pending cut and rejection statistics, e.g. at shutdown
+        """
+        atexit.unregister(self._close_at_exit)
+        if self._alerts_since_flush:
+            self.flush_cut_stats()
+        else:
+            self._rejections.flush()
 
-            # among the remaining sources there is anything with
-            # significant proper motion or parallax measurement
-            if (
-                any(gaia_tab["FLAG_PMRA"] == True) # noqa
-                or any(gaia_tab["FLAG_PMDec"] == True)
-                or any(gaia_tab["FLAG_Plx"] == True)
-            ):
-                return True
+    def cut_totals(self) -> dict[str, dict[str, Any]]:
+        """
+        number of alerts evaluated and rejected by each cut, and time spent
+        evaluating it, since instantiation
+        """
+        return {
+            name: {
+                "evaluated": totals[0] + window[0],
+                "rejected": totals[1] + window[1],
+                "seconds": totals[2] + window[2],
+            }
+            for (name, totals), window in zip(self._cut_totals.items(), self._cut_stats.values())
+        }
+
+    def rejection_totals(self) -> dict[str, int]:
+        """
+        number of rejections per reason since instantiation
+        """
+        return self._rejections.totals()
 
-        return False
+    def _set_cut_order(self, order: list[str]) -> None:
+        """
+        set the order of the cheap cuts; galactic latitude and GAIA always come last
+        """
+        if order == getattr(self, "_cut_order", None):
+            return
+        self._cut_order = order
+        self._cuts = [(name, getattr(self, f"_cut_{name}")) for name in order + list(EXPENSIVE_CUTS)]
+        for i, name in enumerate(order + list(EXPENSIVE_CUTS)):
+            stat_cut_position.labels(name).set(i)
+        self._stats_logger.info("Cut order", extra={"cuts": order + list(EXPENSIVE_CUTS)})
 
     # Override
     def process(self, alert: AmpelAlertProtocol) -> None | bool | int:
@@ -245,13 +562,50 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
         * or a custom combination of T2 unit names
         """
 
+        self._count_alerts(1)
+        if self.use_alert_cache:
+            alert_cache.enter(alert)
+
         # CUT ON THE HISTORY OF THE ALERT
         #################################
 
+        t0 = perf_counter()
+        latest = self._check_history(alert)
+        self._record_cut("history", 1, latest is None, perf_counter() - t0)
+        if latest is None:
+            return None
+
+        # IMAGE QUALITY, ARCHIVE, SOLAR SYSTEM AND PS1 CUTS, THEN GALACTIC LATITUDE AND GAIA
+        ####################################################################################
+
+        for name, cut in self._cuts:
+            t0 = perf_counter()
+            if self._memo is not None and name in self._memo_keys:
+                reason = self._memoized(name, alert.stock, latest)
+            else:
+                reason = cut(latest)
+            self._record_cut(name, 1, reason is not None, perf_counter() - t0)
+            if reason is not None:
+                self._rejections.reject(reason)
+                return None
+
+        # self.logger.debug("Alert %s accepted. Latest pp ID: %d"%(alert.tran_id, latest['candid']))
+        self.logger.debug("Alert accepted", extra={"latestPpId": latest["candid"]})
+
+        # for key in self.keys_to_check:
+        # 	self.logger.debug("{}: {}".format(key, latest[key]))
+
+        return True
+
+    def _check_history(self, alert: AmpelAlertProtocol) -> None | dict[str, Any]:
+        """
+        apply the cuts on the detection history and on the presence of the keys to check
+        returns: the latest photopoint if the alert passes, None otherwise
+        """
         pps = [el for el in alert.datapoints if el.get("candid") is not None]
         if len(pps) < self.min_ndet:
             # self.logger.debug("rejected: %d photopoints in alert (minimum required %d)"% (npp, self.min_ndet))
-            self.logger.info(None, extra={"nDet": len(pps)})
+            self._rejections.reject({"nDet": len(pps)})
             return None
 
         # cut on length of detection history
@@ -260,91 +614,189 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
         if not (self.min_tspan <= det_tspan <= self.max_tspan):
             # self.logger.debug("rejected: detection history is %.3f d long, \
             # requested between %.3f and %.3f d"% (det_tspan, self.min_tspan, self.max_tspan))
-            self.logger.info(None, extra={"tSpan": det_tspan})
+            self._rejections.reject({"tSpan": det_tspan})
             return None
 
-        # IMAGE QUALITY CUTS
-        ####################
-
         latest = alert.datapoints[0]
         if not self._alert_has_keys(latest):
             return None
+        return latest
 
-        if latest["isdiffpos"] == "f" or latest["isdiffpos"] == "0":
-            # self.logger.debug("rejected: 'isdiffpos' is %s", latest['isdiffpos'])
-            self.logger.info(None, extra={"isdiffpos": latest["isdiffpos"]})
-            return None
-
-        if latest["rb"] < self.min_rb:
-            # self.logger.debug("rejected: RB score %.2f below threshod (%.2f)"% (latest['rb'], self.min_rb))
-            self.logger.info(None, extra={"rb": latest["rb"]})
-            return None
-
-        if self.min_drb > 0.0 and latest["drb"] < self.min_drb:
-            # self.logger.debug("rejected: RB score %.2f below threshod (%.2f)"% (latest['rb'], self.min_rb))
-            self.logger.info(None, extra={"drb": latest["drb"]})
-            return None
-
-        if latest["fwhm"] > self.max_fwhm:
-            # self.logger.debug("rejected: fwhm %.2f above threshod (%.2f)"% (latest['fwhm'], self.max_fwhm))
-            self.logger.info(None, extra={"fwhm": latest["fwhm"]})
-            return None
-
-        if latest["elong"] > self.max_elong:
-            # self.logger.debug("rejected: elongation %.2f above threshod (%.2f)"% (latest['elong'], self.max_elong))
-            self.logger.info(None, extra={"elong": latest["elong"]})
-            return None
-
-        if abs(latest["magdiff"]) > self.max_magdiff:
-            # self.logger.debug("rejected: magdiff (AP-PSF) %.2f above threshod (%.2f)"% (latest['magdiff'], self.max_magdiff))
-            self.logger.info(None, extra={"magdiff": latest["magdiff"]})
-            return None
-
-        # cut on archive length
-        if 'jdendhist' in latest.keys() and 'jdstarthist' in latest.keys():
-            archive_tspan = latest['jdendhist'] - latest['jdstarthist']
-            if not (self.min_archive_tspan < archive_tspan < self.max_archive_tspan):
-                self.logger.info(None, extra={'archive_tspan': archive_tspan})
-                return None
+    def process_many(self, alerts: Sequence[AmpelAlertProtocol]) -> list[None | bool | int]:
+        """
+        Filter a micro-batch of alerts, with the same decisions as :meth:`process`.
+
+        The history cuts are applied while collecting the latest photopoint of
+        each alert. The image quality, archive, solar system and PS1 cuts are
+        then evaluated in the current cut order as NumPy masks over the
+        remaining alerts. Galactic latitude and GAIA are only checked for the
+        survivors, the latter with a single batched cone search. The alert
+        cache (use_alert_cache) holds the values of a single alert and is not
+        used for batches; the position memo is.
+        """
 
+        self._count_alerts(len(alerts))
+        results: list[None | bool | int] = [None] * len(alerts)
+
+        t0 = perf_counter()
+        indexes: list[int] = []
+        latest_pps: list[dict[str, Any]] = []
+        for idx, alert in enumerate(alerts):
+            if (latest := self._check_history(alert)) is not None:
+                indexes.append(idx)
+                latest_pps.append(latest)
+        self._record_cut("history", len(alerts), len(alerts) - len(indexes), perf_counter() - t0)
+        if not indexes:
+            return results
+
+        def col(pps: list[dict[str, Any]], key: str) -> np.ndarray:
+            return np.array([pp[key] for pp in pps], dtype=float)
+
+        def archive_tspan(pps: list[dict[str, Any]]) -> tuple[np.ndarray, str, list[Any]]:
+            has_archive = np.array(
+                ['jdendhist' in pp.keys() and 'jdstarthist' in pp.keys() for pp in pps]
+            )
+            tspan = np.array(
+                [pp['jdendhist'] - pp['jdstarthist'] if has else np.nan for pp, has in zip(pps, has_archive)],
+                dtype=float
+            )
+            reject = has_archive & ~((self.min_archive_tspan < tspan) & (tspan < self.max_archive_tspan))
+            return reject, "archive_tspan", tspan.tolist()
+
+        def ps1_star(pps: list[dict[str, Any]]) -> tuple[np.ndarray, str, list[Any]]:
+            distpsnr1 = col(pps, "distpsnr1")
+            reject = (distpsnr1 < self.ps1_sgveto_rad) & (col(pps, "sgscore1") > self.ps1_sgveto_th)
+            return reject, "distpsnr1", distpsnr1.tolist()
+
+        def ps1_confusion(pps: list[dict[str, Any]]) -> tuple[np.ndarray, str, list[Any]]:
+            reject = (
+                (_pymax([col(pps, f"distpsnr{i}") for i in (1, 2, 3)]) < self.ps1_confusion_rad)
+                & (_pymax([np.abs(col(pps, f"sgscore{i}") - 0.5) for i in (1, 2, 3)]) < self.ps1_confusion_sg_tol)
+            )
+            return reject, "ps1Confusion", [True] * len(pps)
+
+        def upper(key: str, threshold: float, transform: Callable = lambda v: v):
+            def reject(pps: list[dict[str, Any]]) -> tuple[np.ndarray, str, list[Any]]:
+                values = col(pps, key)
+                return transform(values) > threshold, key, values.tolist()
+            return reject
+
+        # name -> function of the latest photopoints returning the rejection mask,
+        # and the key and values to log for rejected alerts
+        masks: dict[str, Callable[[list[dict[str, Any]]], tuple[np.ndarray, str, list[Any]]]] = {
+            "isdiffpos": lambda pps: (
+                np.array([pp["isdiffpos"] == "f" or pp["isdiffpos"] == "0" for pp in pps], dtype=bool),
+                "isdiffpos", [pp["isdiffpos"] for pp in pps]
+            ),
+            "rb": lambda pps: ((rb := col(pps, "rb")) < self.min_rb, "rb", rb.tolist()),
+            "drb": lambda pps: ((drb := col(pps, "drb")) < self.min_drb, "drb", drb.tolist()),
+            "fwhm": upper("fwhm", self.max_fwhm),
+            "elong": upper("elong", self.max_elong),
+            "magdiff": upper("magdiff", self.max_magdiff, np.abs),
+            "archive_tspan": archive_tspan,
+            "ssdistnr": lambda pps: (
+                ((ss := col(pps, "ssdistnr")) >= 0) & (ss < self.min_sso_dist), "ssdistnr", ss.tolist()
+            ),
+            "ps1_star": ps1_star,
+            "ps1_confusion": ps1_confusion,
+        }
+
+        keep = np.ones(len(latest_pps), dtype=bool)
+        for name in self._cut_order:
+            survivors = np.flatnonzero(keep)
+            if not len(survivors):
+                break
+            t0 = perf_counter()
+            reject, key, values = masks[name]([latest_pps[i] for i in survivors])
+            for i in np.flatnonzero(reject):
+                self._rejections.reject({key: values[i]})
+            keep[survivors[reject]] = False
+            self._record_cut(name, len(survivors), int(reject.sum()), perf_counter() - t0)
+
+        # verdicts as in process: rejection reason, and whether it may be memoized
+        def gal_lat(pps: list[dict[str, Any]]) -> list[tuple[None | dict[str, Any], bool]]:
+            abs_b = np.abs(galactic_latitude(col(pps, "ra"), col(pps, "dec")))
+            return [({"galPlane": b} if b < self.min_gal_lat else None, True) for b in abs_b.tolist()]
+
+        def gaia(pps: list[dict[str, Any]]) -> list[tuple[None | dict[str, Any], bool]]:
+            if self.gaia_rs <= 0:
+                return [(None, True)] * len(pps)
+            try:
+                batch = self.cone_search_all_many(
+                    [(pp["ra"], pp["dec"]) for pp in pps], [self.gaia_request]
+                )
+            except ConeSearchUnavailable:
+                # NB: the batched search fails as a whole
+                return [({"gaiaUnavailable": True}, False)] * len(pps)
+            return [
+                (
+                    {"gaiaIsStar": True} if self.has_gaia_star(matches[0]) else None,
+                    not isinstance(matches, FallbackResult),
+                )
+                for matches in batch
+            ]
 
-        # ASTRONOMY
-        ###########
+        # expensive checks, for the survivors only
+        for name, evaluate in (("gal_lat", gal_lat), ("gaia", gaia)):
+            survivors = np.flatnonzero(keep)
+            if not len(survivors):
+                break
+            t0 = perf_counter()
+            reasons = self._memoized_many(
+                name,
+                evaluate,
+                [alerts[indexes[i]].stock for i in survivors],
+                [latest_pps[i] for i in survivors],
+            )
+            rejected = 0
+            for i, reason in zip(survivors, reasons):
+                if reason is not None:
+                    self._rejections.reject(reason)
+                    keep[i] = False
+                    rejected += 1
+            self._record_cut(name, len(survivors), rejected, perf_counter() - t0)
 
-        # check for closeby ss objects
-        if 0 <= latest["ssdistnr"] < self.min_sso_dist:
-            # self.logger.debug("rejected: solar-system object close to transient (max allowed: %d)."% (self.min_sso_dist))
-            self.logger.info(None, extra={"ssdistnr": latest["ssdistnr"]})
-            return None
+        for i in np.flatnonzero(keep):
+            self.logger.debug("Alert accepted", extra={"latestPpId": latest_pps[i]["candid"]})
+            results[indexes[i]] = True
 
-        # cut on galactic latitude
-        b = self.get_galactic_latitude(latest)
-        if abs(b) < self.min_gal_lat:
-            # self.logger.debug("rejected: b=%.4f, too close to Galactic plane (max allowed: %f)."% (b, self.min_gal_lat))
-            self.logger.info(None, extra={"galPlane": abs(b)})
-            return None
+        return results
 
-        # check ps1 star-galaxy score
-        if self.is_star_in_PS1(latest):
-            # self.logger.debug("rejected: closest PS1 source %.2f arcsec away with sgscore of %.2f"% (latest['distpsnr1'], latest['sgscore1']))
-            self.logger.info(None, extra={"distpsnr1": latest["distpsnr1"]})
-            return None
 
-        if self.is_confused_in_PS1(latest):
-            # self.logger.debug("rejected: three confused PS1 sources within %.2f arcsec from alert."% (self.ps1_confusion_rad))
-            self.logger.info(None, extra={"ps1Confusion": True})
-            return None
+@cache
+def _icrs_to_galactic() -> np.ndarray:
+    """
+    the (constant) ICRS to Galactic rotation matrix, as used by astropy
+    """
+    return np.array(
+        SkyCoord(
+            x=[1, 0, 0], y=[0, 1, 0], z=[0, 0, 1],
+            representation_type="cartesian", frame="icrs"
+        ).galactic.cartesian.xyz
+    )
 
-        # check with gaia
-        if self.gaia_rs > 0 and self.is_star_in_gaia(latest):
-            # self.logger.debug("rejected: within %.2f arcsec from a GAIA start (PM of PLX)" % (self.gaia_rs))
-            self.logger.info(None, extra={"gaiaIsStar": True})
-            return None
 
-        # self.logger.debug("Alert %s accepted. Latest pp ID: %d"%(alert.tran_id, latest['candid']))
-        self.logger.debug("Alert accepted", extra={"latestPpId": latest["candid"]})
+def galactic_latitude(ra: Any, dec: Any) -> Any:
+    """
+    galactic latitude in degrees of ICRS positions in degrees (scalars or arrays),
+    equivalent to SkyCoord(ra, dec, unit="deg").galactic.b.deg but without
+    building a coordinate frame for each position
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    cos_dec = np.cos(dec)
+    x, y, z = _icrs_to_galactic() @ np.array(
+        [cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)]
+    )
+    # arctan2 rather than arcsin(z), which loses precision near the poles
+    return np.degrees(np.arctan2(z, np.hypot(x, y)))
 
-        # for key in self.keys_to_check:
-        # 	self.logger.debug("{}: {}".format(key, latest[key]))
 
-        return True
+def _pymax(values: Sequence[np.ndarray]) -> np.ndarray:
+    """
+    elementwise equivalent of the builtin max(), which unlike np.maximum
+    keeps the first value when compared with NaN
+    """
+    result = values[0]
+    for v in values[1:]:
+        result = np.where(v > result, v, result)
+    return result
@@ -47,6 +47,14 @@ class ZTFAlertStreamController(AbsProcessController):
 
     @staticmethod
     def merge_processes(processes: list[ProcessModel]) -> ProcessModel:
+        """
+        Merge AlertConsumer processes into one that runs the directives of
+        all of them. The filters of the merged channels can share what they
+        compute from each alert through AlertCache. Sharing is opt-in per
+        filter: merging leaves the filter configs untouched, so only filters
+        configured with use_alert_cache (DecentFilter, CatalogMatchFilter)
+        take part.
+        """
         assert len(processes) > 0
         process = copy.deepcopy(processes[0])
 
@@ -0,0 +1,126 @@
+from typing import Any
+from collections.abc import Sequence
+from ampel.types import UBson
+from ampel.struct.UnitResult import UnitResult
+from ampel.enum.DocumentCode import DocumentCode
+from ampel.content.DataPoint import DataPoint
+from ampel.content.T2Document import T2Document
+from ampel.log import AmpelLogger
+from ampel.log.utils import report_exception
+from ampel.abstract.AbsPointT2Unit import AbsPointT2Unit
+from ampel.mongo.update.MongoStockUpdater import MongoStockUpdater
+from ampel.t2.T2Worker import T2Worker, AbsT2
+
+
+class T2BatchWorker(T2Worker):
+	"""
+	T2Worker that runs point T2 units implementing
+	``process_many(datapoints: Sequence[DataPoint]) -> list[UBson | UnitResult]``
+	(e.g. T2CatalogMatch) on batches of pending documents.
+
+	When such a unit is encountered, up to batch_size - 1 further pending
+	documents with the same unit and config are claimed, their datapoints
+	are loaded with a single query and passed to one process_many call.
+	Results are then committed per T2 document exactly as by T2Worker.
+	Documents of other units are processed one by one.
+	"""
+
+	#: maximum number of T2 documents processed by a single process_many call
+	batch_size: int = 500
+
+
+	def __init__(self, **kwargs) -> None:
+		super().__init__(**kwargs)
+		# T2 doc id -> result computed by process_many
+		self._batch_results: dict[Any, UBson | UnitResult] = {}
+
+
+	def process_doc(self,
+		doc: T2Document,
+		stock_updr: MongoStockUpdater,
+		logger: AmpelLogger
+	) -> tuple[UBson, int]:
+
+		t2_unit = self.get_unit_instance(doc, logger)
+		if not self._is_batchable(t2_unit):
+			return super().process_doc(doc, stock_updr, logger)
+
+		docs = [doc] + self._claim(doc)
+		self._run_batch(t2_unit, docs, logger)
+
+		ret: tuple[UBson, int] = (None, 0)
+		for d in docs:
+			ret = super().process_doc(d, stock_updr, logger)
+		return ret
+
+
+	@staticmethod
+	def _is_batchable(t2_unit: Any) -> bool:
+		return isinstance(t2_unit, AbsPointT2Unit) and callable(getattr(t2_unit, 'process_many', None))
+
+
+	def _claim(self, doc: T2Document) -> list[T2Document]:
+		""" Mark further pending docs of the same unit and config as running """
+
+		n = self.batch_size - 1
+		if self.doc_limit:
+			n = min(n, self.doc_limit - self._doc_counter - 1)
+
+		query = self.query | {'unit': doc['unit'], 'config': doc['config']}
+		update = {'$set': {'code': DocumentCode.RUNNING}}
+		docs: list[T2Document] = []
+		while len(docs) < n and self._run:
+			if (d := self.col.find_one_and_update(query, update)) is None:
+				break
+			docs.append(d)
+		return docs
+
+
+	def _run_batch(self, t2_unit: Any, docs: Sequence[T2Document], logger: AmpelLogger) -> None:
+
+		# datapoints of docs that will be processed (see max_try in T2Worker.process_doc)
+		links = [
+			d['link'] for d in docs
+			if len([el for el in d['meta'] if el['tier'] == 2]) <= self.max_try
+		]
+		if not links:
+			return
+
+		dps: dict[Any, DataPoint] = {
+			dp['id']: dp for dp in self.col_t0.find({'id': {'$in': links}})
+		}
+
+		# docs with missing datapoints are left to T2Worker for error reporting
+		batch = [d for d in docs if d['link'] in dps]
+		if not batch:
+			return
+
+		try:
+			results = t2_unit.process_many([dps[d['link']] for d in batch])
+		except Exception as e:
+			if self.raise_exc:
+				raise e
+			# fall back to processing docs one by one
+			report_exception(
+				self._ampel_db, logger, exc=e,
+				info={'unit': batch[0]['unit'], 'config': batch[0]['config'], 'batch': len(batch)}
+			)
+			return
+
+		for d, result in zip(batch, results):
+			self._batch_results[d['_id']] = result # type: ignore[typeddict-item]
+
+
+	def run_t2_unit(self,
+		t2_unit: AbsT2, t2_doc: T2Document, logger: AmpelLogger, stock_updr: MongoStockUpdater,
+	) -> UBson | UnitResult:
+
+		if t2_doc['_id'] not in self._batch_results: # type: ignore[typeddict-item]
+			return super().run_t2_unit(t2_unit, t2_doc, logger, stock_updr)
+
+		ret = self._batch_results.pop(t2_doc['_id']) # type: ignore[typeddict-item]
+		if t2_unit._buf_hdlr.buffer: # type: ignore[union-attr]
+			t2_unit._buf_hdlr.forward( # type: ignore[union-attr]
+				logger, stock=t2_doc['stock']
+			)
+		return ret
@@ -8,13 +8,16 @@
 # Last Modified By:    Jakob van Santen <jakob.van.santen@desy.de>
 
 from typing import Any, Literal, ClassVar
-from collections.abc import Sequence
+from collections import defaultdict
+from collections.abc import Hashable, Sequence
 from ampel.types import UBson
 from ampel.abstract.AbsPointT2Unit import AbsPointT2Unit
 from ampel.content.DataPoint import DataPoint
 from ampel.base.AmpelBaseModel import AmpelBaseModel
 from ampel.struct.UnitResult import UnitResult
-from ampel.ztf.base.CatalogMatchUnit import CatalogMatchUnit
+from ampel.ztf.base.CatalogMatchUnit import CatalogItem, CatalogMatchUnit, ConeSearchRequest
+from ampel.ztf.base.ConeSearchCache import ConeSearchCache, ConeSearchCacheConfig
+from ampel.ztf.base.ConeSearchGuard import FallbackResult
 from ampel.enum.DocumentCode import DocumentCode
 from ampel.model.DPSelection import DPSelection
 
@@ -73,6 +76,12 @@ class T2CatalogMatch(CatalogMatchUnit, AbsPointT2Unit):
     # Each value specifies a catalog in extcats or catsHTM format and the query parameters
     catalogs: dict[str, CatalogModel]
 
+    #: Share the matches of each catalog with the other T2CatalogMatch
+    #: instances of the process using the same store configuration, so that
+    #: configurations with overlapping catalogs only query the catalogs
+    #: missing from the store (disabled if None)
+    result_store: None | ConeSearchCacheConfig = None
+
 
     def process(self, datapoint: DataPoint) -> UBson | UnitResult:
         """
@@ -92,32 +101,90 @@ class T2CatalogMatch(CatalogMatchUnit, AbsPointT2Unit):
         to the catalog counterpart is also returned as the 'dist2transient' key.
         """
 
-        try:
-            transient_ra = datapoint["body"]["ra"]
-            transient_dec = datapoint["body"]["dec"]
-        except KeyError:
-            return UnitResult(code=DocumentCode.T2_MISSING_INFO)
-
-        matches = self.cone_search_nearest(
-            ra=transient_ra,
-            dec=transient_dec,
-            catalogs=[
-                {
-                    "name": catalog,
-                    "use": cat_opts.use,
-                    "rs_arcsec": cat_opts.rs_arcsec,
-                    "keys_to_append": cat_opts.keys_to_append,
-                    "pre_filter": cat_opts.pre_filter,
-                    "post_filter": cat_opts.post_filter,
-                }
-                for catalog, cat_opts in self.catalogs.items()
-            ],
-        )
-
-        # return the info as dictionary
-        return {
-            catalog: {
-                "dist2transient": match["dist_arcsec"], **match["body"]
-            } if match is not None else None
-            for catalog, match in zip(self.catalogs, matches)
-        }
+        return self.process_many([datapoint])[0]
+
+    def process_many(self, datapoints: Sequence[DataPoint]) -> list[UBson | UnitResult]:
+        """
+        Match the positions of many datapoints at once (see :meth:`process`),
+        for use by T2BatchWorker.
+
+        :returns: results of :meth:`process`, in the order of datapoints
+        """
+
+        results: list[UBson | UnitResult] = [
+            UnitResult(code=DocumentCode.T2_MISSING_INFO)
+        ] * len(datapoints)
+        positions: list[tuple[float, float]] = []
+        indexes: list[int] = []
+        for idx, datapoint in enumerate(datapoints):
+            try:
+                positions.append((datapoint["body"]["ra"], datapoint["body"]["dec"]))
+            except KeyError:
+                continue
+            indexes.append(idx)
+
+        catalogs: list[ConeSearchRequest] = [
+            {
+                "name": catalog,
+                "use": cat_opts.use,
+                "rs_arcsec": cat_opts.rs_arcsec,
+                "keys_to_append": cat_opts.keys_to_append,
+                "pre_filter": cat_opts.pre_filter,
+                "post_filter": cat_opts.post_filter,
+            }
+            for catalog, cat_opts in self.catalogs.items()
+        ]
+        for idx, matches in zip(indexes, self._match_nearest(positions, catalogs)):
+            # return the info as dictionary
+            results[idx] = {
+                catalog: {
+                    "dist2transient": match["dist_arcsec"], **match["body"]
+                } if match is not None else None
+                for catalog, match in zip(self.catalogs, matches)
+            }
+        return results
+
+    def _match_nearest(
+        self,
+        positions: Sequence[tuple[float, float]],
+        catalogs: Sequence[ConeSearchRequest],
+    ) -> list[list[None | CatalogItem]]:
+        """
+        Nearest match in each catalog for each position, taken from the result
+        store where possible. Results are stored per position and catalog
+        request (name, radius, keys and filters).
+        """
+        if not positions:
+            return []
+        if self.result_store is None:
+            return self.cone_search_nearest_many(positions, catalogs)
+
+        store = ConeSearchCache.shared(self.result_store)
+        matches: list[list[None | CatalogItem]] = [[None] * len(catalogs) for _ in positions]
+        keys: list[list[Hashable]] = []
+        # indexes of missing catalogs -> indexes of positions
+        missing: dict[tuple[int, ...], list[int]] = defaultdict(list)
+        for i, (ra, dec) in enumerate(positions):
+            keys.append([store.key("nearest", ra, dec, [catalog]) for catalog in catalogs])
+            todo = []
+            for j, key in enumerate(keys[i]):
+                found, result = store.get(key)
+                if found:
+                    matches[i][j] = result[0]
+                else:
+                    todo.append(j)
+            if todo:
+                missing[tuple(todo)].append(i)
+
+        for todo, indexes in missing.items():
+            for i, result in zip(
+                indexes,
+                self.cone_search_nearest_many(
+                    [positions[i] for i in indexes], [catalogs[j] for j in todo]
+                ),
+            ):
+                for j, match in zip(todo, result):
+                    matches[i][j] = match
+                    if not isinstance(result, FallbackResult):
+                        store.put(keys[i][j], [match])
+        return matches
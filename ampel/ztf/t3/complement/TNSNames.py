@@ -13,12 +13,12 @@ from collections.abc import Iterable
 
 from ampel.struct.AmpelBuffer import AmpelBuffer
 from ampel.abstract.AbsBufferComplement import AbsBufferComplement
-from ampel.ztf.base.CatalogMatchUnit import CatalogMatchContextUnit
+from ampel.ztf.base.CatalogMatchUnit import AsyncCatalogMatchContextUnit
 from ampel.enum.DocumentCode import DocumentCode
 from ampel.view.T3Store import T3Store
 
 
-class TNSNames(CatalogMatchContextUnit, AbsBufferComplement):
+class TNSNames(AsyncCatalogMatchContextUnit, AbsBufferComplement):
     """
     Add TNS names to transients.
     """
@@ -28,7 +28,9 @@ class TNSNames(CatalogMatchContextUnit, AbsBufferComplement):
     include_report: bool = False
 
     def complement(self, records: Iterable[AmpelBuffer], t3s: T3Store) -> None:
-        for record in records:
+        record_list = list(records)
+        positions = []
+        for record in record_list:
 
             # find the latest T2LightCurveSummary result
             if (summary := self._get_t2_result(record, "T2LightCurveSummary")) is None:
@@ -43,22 +45,28 @@ class TNSNames(CatalogMatchContextUnit, AbsBufferComplement):
                 raise ValueError(
                     f"No T2LightCurveSummary contains no declination for stock {str(record['id'])}"
                 )
-            if not (
-                matches := self.cone_search_all(
-                    ra,
-                    dec,
-                    [
-                        {
-                            "name": "TNS",
-                            "use": "extcats",
-                            "rs_arcsec": self.search_radius,
-                            "keys_to_append": None
-                            if self.include_report
-                            else ["objname"],
-                        }
-                    ],
-                )[0]
-            ):
+            positions.append((ra, dec))
+
+        if not record_list:
+            return
+
+        results = self.cone_search_all_many(
+            positions,
+            [
+                {
+                    "name": "TNS",
+                    "use": "extcats",
+                    "rs_arcsec": self.search_radius,
+                    "keys_to_append": None
+                    if self.include_report
+                    else ["objname"],
+                }
+            ],
+        )
+
+        for record, result in zip(record_list, results):
+
+            if not (matches := result[0]):
                 continue
 
             if (stock := record.get("stock", None)) is not None:
@@ -12,3 +12,22 @@ def pytest_addoption(parser):
         default=False,
         help="run docker-based integration tests",
     )
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        default=False,
+        help="run tests that assert on wall-clock timings",
+    )
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: asserts on wall-clock timings, run with --benchmark"
+    )
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="timing assertions require --benchmark")
+    for item in items:
+        if item.get_closest_marker("benchmark"):
+            item.add_marker(skip)
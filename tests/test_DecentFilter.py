@@ -0,0 +1,593 @@
+from pathlib import Path
+
+import fastavro
+import pytest
+import yaml
+
+from ampel.alert.load.TarAlertLoader import TarAlertLoader
+from ampel.log.AmpelLogger import AmpelLogger
+from ampel.ztf.alert.ZiAlertSupplier import ZiAlertSupplier
+from ampel.ztf.t0.DecentFilter import DecentFilter
+
+ROOT = Path(__file__).parent.parent
+
+
+@pytest.fixture(scope="module")
+def archived_alerts():
+    """
+    Alerts from alerts/ and the test data tarballs
+    """
+    alerts = []
+    for path in [
+        ROOT / "alerts" / "recent_alerts.tar.gz",
+        ROOT / "alerts" / "tar.tst.gz",
+        *sorted((ROOT / "tests" / "test-data").glob("*.tar.gz")),
+    ]:
+        for f in TarAlertLoader(file_path=str(path)):
+            alerts.append(ZiAlertSupplier.shape_alert_dict(next(fastavro.reader(f))))
+    for path in sorted((ROOT / "alerts" / "ztf_public_20180601").glob("*.avro")):
+        with open(path, "rb") as f:
+            try:
+                alerts.append(ZiAlertSupplier.shape_alert_dict(next(fastavro.reader(f))))
+            except IndexError:
+                # some of these packets are truncated
+                continue
+    return alerts
+
+
+@pytest.fixture
+def decentfilter_config():
+    with open(ROOT / "tests" / "test-data" / "decentfilter_config.yaml") as f:
+        return yaml.safe_load(f)
+
+
+class _GaiaSession:
+    """
+    Returns GAIA matches derived from the position, significant proper motion
+    for roughly half of the positions and missing values for some
+    """
+
+    def __init__(self):
+        self.requests = 0
+
+    def post(self, url, json, **kwargs):
+        from .test_T2CatalogMatch import _FakeResponse
+
+        self.requests += 1
+        seed = int(json["ra_deg"] * 1e4) + int(abs(json["dec_deg"]) * 1e4)
+        srcs = [
+            {
+                "body": {
+                    "Mag_G": 15.0 + (seed + i) % 7,
+                    "PMRA": float((seed + i) % 5),
+                    "ErrPMRA": 1.0,
+                    "PMDec": 0.1,
+                    "ErrPMDec": 1.0,
+                    "Plx": None if (seed + i) % 3 == 0 else 0.5,
+                    "ErrPlx": 1.0,
+                    "ExcessNoiseSig": None if (seed + i) % 4 == 0 else 1.0,
+                },
+                "dist_arcsec": ((seed + i) % 30) / 10,
+            }
+            for i in range(seed % 3)
+        ]
+        return _FakeResponse([srcs or None])
+
+
+def _make_filter(config) -> DecentFilter:
+    unit = DecentFilter(
+        **config,
+        logger=AmpelLogger.get_logger(),
+        resource={"ampel-ztf/catalogmatch": "http://localhost/"},
+    )
+    unit.post_init()
+    unit.__dict__["session"] = _GaiaSession()
+    return unit
+
+
+PERMISSIVE = {
+    "min_ndet": 1,
+    "min_tspan": -1,
+    "max_tspan": 1e5,
+    "min_rb": 0,
+    "max_fwhm": 1e3,
+    "max_elong": 1e3,
+    "max_magdiff": 1e3,
+    "min_sso_dist": -1,
+    "min_gal_lat": -1,
+    "ps1_sgveto_th": 2,
+    "ps1_confusion_rad": -1,
+}
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {},
+        PERMISSIVE,
+        PERMISSIVE | {"min_rb": 0.5, "max_fwhm": 3, "gaia_rs": 0},
+        PERMISSIVE | {"max_elong": 1.2, "max_magdiff": 0.2, "min_gal_lat": 20},
+        PERMISSIVE | {"min_sso_dist": 20, "ps1_sgveto_th": 0.5, "ps1_sgveto_rad": 5},
+        PERMISSIVE | {"ps1_confusion_rad": 30, "ps1_confusion_sg_tol": 0.5},
+        PERMISSIVE | {"min_archive_tspan": 10, "max_archive_tspan": 100},
+    ],
+)
+def test_process_many(archived_alerts, decentfilter_config, overrides):
+    unit = _make_filter(decentfilter_config | overrides)
+    scalar = [unit.process(alert) for alert in archived_alerts]
+    batch = unit.process_many(archived_alerts)
+    assert batch == scalar
+    if overrides is PERMISSIVE:
+        assert any(batch) and not all(batch)
+
+
+def test_galactic_latitude(archived_alerts):
+    import numpy as np
+    from astropy.coordinates import SkyCoord
+    from ampel.ztf.t0.DecentFilter import galactic_latitude
+
+    rng = np.random.default_rng(0)
+    ra = np.concatenate(
+        [rng.uniform(0, 360, 10000), [0, 360, 192.85948, 266.40499]]
+        + [[a.datapoints[0]["ra"] for a in archived_alerts]]
+    )
+    dec = np.concatenate(
+        [np.degrees(np.arcsin(rng.uniform(-1, 1, 10000))), [90, -90, 27.12825, -28.93617]]
+        + [[a.datapoints[0]["dec"] for a in archived_alerts]]
+    )
+    expected = SkyCoord(ra, dec, unit="deg").galactic.b.deg
+    assert np.abs(galactic_latitude(ra, dec) - expected).max() * 3.6e6 < 1, "within 1 mas"
+    assert galactic_latitude(ra[0], dec[0]) == pytest.approx(expected[0], abs=1e-9)
+
+
+@pytest.mark.benchmark
+def test_galactic_latitude_benchmark(archived_alerts, decentfilter_config):
+    """
+    Per-alert cost of the galactic latitude, compared to building a SkyCoord
+    """
+    import timeit
+    import numpy as np
+    from astropy.coordinates import SkyCoord
+    from ampel.ztf.t0.DecentFilter import galactic_latitude
+
+    unit = _make_filter(decentfilter_config)
+    latest = [a.datapoints[0] for a in archived_alerts]
+    ra = np.array([pp["ra"] for pp in latest])
+    dec = np.array([pp["dec"] for pp in latest])
+
+    def per_alert(stmt, number=3):
+        return min(timeit.repeat(stmt, number=number, repeat=3)) / number / len(latest)
+
+    skycoord = per_alert(
+        lambda: [SkyCoord(pp["ra"], pp["dec"], unit="deg").galactic.b.deg for pp in latest], 1
+    )
+    scalar = per_alert(lambda: [unit.get_galactic_latitude(pp) for pp in latest])
+    batch = per_alert(lambda: galactic_latitude(ra, dec), 100)
+    # loose bounds: the scalar path is ~100x faster than SkyCoord
+    assert scalar < skycoord / 10
+    assert batch < scalar
+
+
+def _has_gaia_star_table(unit: DecentFilter, srcs) -> bool:
+    """
+    Previous, astropy.table-based implementation of DecentFilter.has_gaia_star
+    """
+    import numpy as np
+    from astropy.table import Table
+
+    if not srcs:
+        return False
+    gaia_tab = Table(
+        [{k: np.nan if v is None else v for k, v in src["body"].items()} for src in srcs]
+    )
+    gaia_tab["DISTANCE"] = [src["dist_arcsec"] for src in srcs]
+    gaia_tab["DISTANCE_NORM"] = (
+        1.8 + 0.6 * np.exp((20 - gaia_tab["Mag_G"]) / 2.05) > gaia_tab["DISTANCE"]
+    )
+    gaia_tab["FLAG_PROX"] = [
+        x["DISTANCE_NORM"]
+        and unit.gaia_veto_gmag_min <= x["Mag_G"] <= unit.gaia_veto_gmag_max
+        for x in gaia_tab
+    ]
+    gaia_tab["FLAG_PMRA"] = abs(gaia_tab["PMRA"] / gaia_tab["ErrPMRA"]) > unit.gaia_pm_signif
+    gaia_tab["FLAG_PMDec"] = abs(gaia_tab["PMDec"] / gaia_tab["ErrPMDec"]) > unit.gaia_pm_signif
+    gaia_tab["FLAG_Plx"] = abs(gaia_tab["Plx"] / gaia_tab["ErrPlx"]) > unit.gaia_plx_signif
+    gaia_tab["FLAG_Clean"] = gaia_tab["ExcessNoiseSig"] < unit.gaia_excessnoise_sig_max
+    gaia_tab = gaia_tab[gaia_tab["FLAG_PROX"]]
+    gaia_tab = gaia_tab[gaia_tab["FLAG_Clean"]]
+    return bool(
+        any(gaia_tab["FLAG_PMRA"]) or any(gaia_tab["FLAG_PMDec"]) or any(gaia_tab["FLAG_Plx"])
+    )
+
+
+def _random_gaia_matches(rng, n: int) -> list[list[dict]]:
+    from ampel.ztf.t0.DecentFilter import GAIA_KEYS
+
+    def value(key):
+        if rng.random() < 0.1:
+            return None
+        if key.startswith("Err"):
+            # include zero uncertainties
+            return float(rng.choice([0.0, rng.uniform(0.01, 2)]))
+        if key == "Mag_G":
+            return float(rng.uniform(8, 22))
+        return float(rng.normal(0, 5))
+
+    return [
+        [
+            {
+                "body": {k: value(k) for k in GAIA_KEYS},
+                "dist_arcsec": float(rng.uniform(0, 20)),
+            }
+            for _ in range(rng.integers(1, 6))
+        ]
+        for _ in range(n)
+    ]
+
+
+def test_has_gaia_star(decentfilter_config):
+    import numpy as np
+
+    unit = _make_filter(decentfilter_config)
+    matches = _random_gaia_matches(np.random.default_rng(0), 2000)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = [_has_gaia_star_table(unit, srcs) for srcs in matches]
+    assert [unit.has_gaia_star(srcs) for srcs in matches] == expected
+    assert 0 < sum(expected) < len(expected)
+    assert unit.has_gaia_star([]) is False
+    assert unit.has_gaia_star(None) is False
+
+
+@pytest.mark.benchmark
+def test_has_gaia_star_benchmark(decentfilter_config):
+    """
+    Per-alert cost of the GAIA veto, compared to the astropy.table implementation
+    """
+    import timeit
+    import numpy as np
+
+    unit = _make_filter(decentfilter_config)
+    matches = _random_gaia_matches(np.random.default_rng(1), 200)
+
+    def per_alert(fn, number=3):
+        stmt = lambda: [fn(srcs) for srcs in matches]
+        return min(timeit.repeat(stmt, number=number, repeat=3)) / number / len(matches)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table = per_alert(lambda srcs: _has_gaia_star_table(unit, srcs), 1)
+    arrays = per_alert(unit.has_gaia_star)
+    # loose bound, the array-based veto is ~50x faster
+    assert arrays < table / 5
+
+
+def test_adaptive_cut_order(archived_alerts, decentfilter_config):
+    from ampel.ztf.t0.DecentFilter import CHEAP_CUTS, EXPENSIVE_CUTS, stat_cut_position, stat_cuts
+
+    def rejected():
+        return sum(
+            stat_cuts.labels(cut, "rejected")._value.get()
+            for cut in ("history",) + CHEAP_CUTS + EXPENSIVE_CUTS
+        )
+
+    config = decentfilter_config | PERMISSIVE | {"max_elong": 1.5, "min_sso_dist": 20}
+    static = _make_filter(config)
+    adaptive = _make_filter(config | {"adaptive_cut_order": True, "cut_stats_interval": 10})
+    assert adaptive._cut_order == static._cut_order
+    assert "drb" not in static._cut_order
+
+    # the order changes, but not the decisions
+    before = rejected()
+    expected = [static.process(alert) for alert in archived_alerts]
+    assert [adaptive.process(alert) for alert in archived_alerts] == expected
+    assert adaptive.process_many(archived_alerts) == expected
+    static.flush_cut_stats()
+    adaptive.flush_cut_stats()
+    # one rejection per rejected alert, in each of the three passes
+    assert rejected() - before == 3 * sum(r is None for r in expected)
+
+    # cuts are sorted by rejections per second, expensive ones stay last
+    unit = _make_filter(config | {"adaptive_cut_order": True})
+    unit._cut_stats |= {
+        "ssdistnr": [100, 50, 1e-3],
+        "elong": [100, 10, 1e-3],
+        "rb": [100, 10, 1e-4],
+        "gaia": [100, 90, 1e-3],
+    }
+    unit.flush_cut_stats()
+    assert unit._cut_order[:3] == ["rb", "ssdistnr", "elong"]
+    assert [name for name, _ in unit._cuts][-len(EXPENSIVE_CUTS):] == list(EXPENSIVE_CUTS)
+    assert stat_cut_position.labels("rb")._value.get() == 0
+    assert stat_cut_position.labels("gaia")._value.get() == len(unit._cuts) - 1
+
+
+def test_cut_stats_on_close(archived_alerts, decentfilter_config):
+    import time
+    from ampel.ztf.t0.DecentFilter import stat_cuts
+
+    def evaluated():
+        return stat_cuts.labels("history", "evaluated")._value.get()
+
+    config = decentfilter_config | {"cut_stats_interval": 10 * len(archived_alerts)}
+    unit = _make_filter(config)
+    before = evaluated()
+    for alert in archived_alerts:
+        unit.process(alert)
+    assert evaluated() == before, "interval not reached"
+    unit.close()
+    assert evaluated() == before + len(archived_alerts), "published on close"
+
+    # at exit, for filters nobody closes
+    unit = _make_filter(config)
+    unit.process(archived_alerts[0])
+    unit._close_at_exit()
+    assert evaluated() == before + len(archived_alerts) + 1, "published at exit"
+
+    # and when an alert arrives after cut_stats_seconds
+    unit = _make_filter(config | {"cut_stats_seconds": 0.05})
+    unit.process(archived_alerts[0])
+    assert evaluated() == before + len(archived_alerts) + 1
+    time.sleep(0.05)
+    unit.process(archived_alerts[1])
+    assert evaluated() == before + len(archived_alerts) + 2, "published after cut_stats_seconds"
+
+
+def test_cut_order_log(decentfilter_config):
+    unit = _make_filter(decentfilter_config)
+    unit._stats_logger = _Recorder()  # type: ignore[assignment]
+    unit.logger.info = lambda *args, **kwargs: pytest.fail("logged to the per-alert buffer")
+    unit._set_cut_order(list(reversed(unit._cut_order)))
+    assert unit._stats_logger.records == [
+        ("Cut order", {"cuts": unit._cut_order + ["gal_lat", "gaia"]})
+    ]
+
+
+class _Recorder:
+    """Records the info messages of a logger"""
+
+    def __init__(self):
+        self.records = []
+
+    def info(self, msg, *args, **kwargs):
+        self.records.append((msg, kwargs.get("extra")))
+
+
+@pytest.mark.parametrize("log_rejections", [False, True])
+def test_rejection_stats(archived_alerts, decentfilter_config, log_rejections):
+    from ampel.ztf.base.RejectionStats import BINS, stat_rejections
+
+    def counters():
+        return {
+            sample.labels["reason"]: sample.value
+            for metric in stat_rejections.collect()
+            for sample in metric.samples
+            if sample.name.endswith("_total") and sample.labels["unit"] == "DecentFilter"
+        }
+
+    unit = _make_filter(decentfilter_config | {"log_rejections": log_rejections})
+    # per alert records go to the filter's logger, buffered per alert by AlertConsumer
+    per_alert: list = []
+    unit.logger.info = lambda msg, *args, **kwargs: per_alert.append((msg, kwargs.get("extra")))
+    summary_logger = _Recorder()
+    unit._rejections.summary_logger = summary_logger  # type: ignore[assignment]
+    records = summary_logger.records
+    before = counters()
+
+    results = [unit.process(alert) for alert in archived_alerts]
+    rejected = sum(r is None for r in results)
+    assert rejected
+    assert len(per_alert) == (rejected if log_rejections else 0)
+
+    unit.flush_cut_stats()
+    assert all(msg is None for msg, _ in per_alert), "summaries are not attributed to an alert"
+    (summary,) = [extra for msg, extra in records if msg == "Rejection summary"]
+    assert summary["alerts"] == len(archived_alerts)
+    assert sum(summary["rejected"].values()) == rejected
+    for reason, histogram in summary["histograms"].items():
+        assert len(histogram) == len(BINS) + 1
+        assert sum(histogram) <= summary["rejected"][reason]
+    after = counters()
+    assert {
+        reason: after[reason] - before.get(reason, 0) for reason in summary["rejected"]
+    } == summary["rejected"]
+
+    unit.flush_cut_stats()
+    assert [msg for msg, _ in records].count("Rejection summary") == 1, "nothing new to report"
+
+
+def test_rejection_stats_timer():
+    import time
+    from ampel.ztf.base.RejectionStats import RejectionStats
+
+    logger = _Recorder()
+    stats = RejectionStats(
+        "TestFilter", logger, flush_seconds=0.05, summary_logger=logger  # type: ignore[arg-type]
+    )
+    stats.count(2)
+    stats.reject({"nDet": 1})
+    deadline = time.monotonic() + 2
+    while not logger.records and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert logger.records == [
+        ("Rejection summary", {"alerts": 2, "rejected": {"nDet": 1}, "histograms": {"nDet": [0, 0, 0, 0, 1] + [0] * 10}})
+    ], "flushed without further alerts"
+    assert stats.totals() == {"nDet": 1}
+
+
+def test_position_memo():
+    import numpy as np
+    from ampel.ztf.base.PositionMemo import PositionMemo, PositionMemoConfig
+
+    memo = PositionMemo(PositionMemoConfig(max_size=2, tolerance_arcsec=1))
+    memo.put("a", 10.0, 80.0, "k", 1)
+    # 0.9 arcsec away, despite the large ra offset at high declination
+    assert memo.get("a", 10.0 + 0.9 / 3600 / np.cos(np.radians(80)), 80.0, "k") == (True, 1)
+    assert memo.get("a", 10.0, 80.0 + 1.1 / 3600, "k") == (False, None)
+    assert memo.get("a", 10.0, 80.0, "other") == (False, None)
+    # around ra = 0
+    memo.put("b", 359.9999, 0.0, "k", 2)
+    assert memo.get("b", 0.0001, 0.0, "k") == (True, 2)
+
+    # a result for a moved source replaces the anchor and drops the other results
+    memo.put("a", 10.0, 80.0, "other", 3)
+    memo.put("a", 10.0, 80.01, "k", 4)
+    assert memo.get("a", 10.0, 80.01, "k") == (True, 4)
+    assert memo.get("a", 10.0, 80.01, "other") == (False, None)
+
+    # least recently used stocks are evicted
+    memo.put("c", 1.0, 1.0, "k", 5)
+    assert len(memo) == 2
+    assert memo.get("b", 0.0, 0.0, "k") == (False, None)
+
+    config = PositionMemoConfig(max_size=7)
+    assert PositionMemo.shared(config) is PositionMemo.shared(PositionMemoConfig(max_size=7))
+    assert PositionMemo.shared(config) is not PositionMemo.shared(PositionMemoConfig())
+
+
+def test_decentfilter_position_memo(archived_alerts, decentfilter_config):
+    from ampel.alert.AmpelAlert import AmpelAlert
+    from ampel.ztf.base.PositionMemo import PositionMemo
+
+    # one alert per stock, so that memoization does not change decisions
+    alerts = list({alert.stock: alert for alert in archived_alerts}.values())
+    config = decentfilter_config | PERMISSIVE | {"min_gal_lat": 20, "ps1_sgveto_th": 0.5}
+    reference = _make_filter(config)
+    expected = [reference.process(alert) for alert in alerts]
+    assert reference.session.requests
+
+    memo_config = {"max_size": 1000, "tolerance_arcsec": 0.5}
+    PositionMemo._shared.clear()
+    first = _make_filter(config | {"position_memo": memo_config})
+    assert set(first._memo_keys) == {"gal_lat", "gaia"}, "as in process_many"
+    assert [first.process(alert) for alert in alerts] == expected
+    assert first.session.requests == reference.session.requests
+    assert first.process_many(alerts) == expected
+    assert first.session.requests == reference.session.requests, "GAIA verdicts are memoized"
+
+    # shared by instances with the same memo config, for cuts with the same parameters
+    second = _make_filter(config | {"position_memo": memo_config, "min_rb": 0.1})
+    assert second.process_many(alerts) == [
+        r if r is None or alert.datapoints[0]["rb"] >= 0.1 else None
+        for r, alert in zip(expected, alerts)
+    ]
+    assert second.session.requests == 0
+    other = _make_filter(config | {"position_memo": memo_config, "gaia_pm_signif": 2})
+    [other.process(alert) for alert in alerts]
+    assert other.session.requests > 0
+
+    # moved sources are evaluated again
+    alert = next(a for a, r in zip(alerts, expected) if r)
+    latest = alert.datapoints[0] | {"ra": alert.datapoints[0]["ra"] + 1 / 3600}
+    second.process(AmpelAlert(alert.id, alert.stock, [latest, *alert.datapoints[1:]]))
+    assert second.session.requests == 1
+
+
+def test_position_memo_fallback(archived_alerts, decentfilter_config):
+    import requests
+    from ampel.ztf.base.PositionMemo import PositionMemo
+
+    class Unavailable:
+        def post(self, url, json, **kwargs):
+            raise requests.ConnectionError()
+
+    alerts = list({alert.stock: alert for alert in archived_alerts}.values())
+    config = decentfilter_config | PERMISSIVE
+    expected = [_make_filter(config).process(alert) for alert in alerts]
+    without_gaia = [_make_filter(config | {"gaia_rs": 0}).process(alert) for alert in alerts]
+    assert expected != without_gaia
+
+    PositionMemo._shared.clear()
+    # NB: the circuit is kept closed, as searches of a failed batch may still be in flight
+    unit = _make_filter(config | {
+        "position_memo": {"max_size": 1000, "tolerance_arcsec": 0.5},
+        "cone_search_guard": {
+            "deadline": 0.02, "hedge_quantile": None, "failure_threshold": 10**6, "fail_open": True
+        },
+    })
+    session = unit.session
+    unit.__dict__["session"] = Unavailable()
+    # accepted on GAIA while it is unavailable
+    assert [unit.process(alert) for alert in alerts[:8]] == without_gaia[:8]
+    assert unit.process_many(alerts[8:]) == without_gaia[8:]
+
+    # verdicts of the fallback are not memoized
+    unit.__dict__["session"] = session
+    assert [unit.process(alert) for alert in alerts[8:]] == expected[8:]
+    assert unit.process_many(alerts[:8]) == expected[:8]
+
+
+def test_gaia_unavailable(archived_alerts, decentfilter_config):
+    import requests
+    from ampel.ztf.base.PositionMemo import PositionMemo
+
+    class Unavailable:
+        def post(self, url, json, **kwargs):
+            raise requests.ConnectionError()
+
+    alerts = list({alert.stock: alert for alert in archived_alerts}.values())
+    config = decentfilter_config | PERMISSIVE
+    reference = _make_filter(config)
+    expected = [reference.process(alert) for alert in alerts]
+    assert any(expected)
+    # alerts that get as far as the GAIA cut
+    reach_gaia = sum(1 for accepted in expected if accepted) + reference._rejections.summary()[
+        "rejected"
+    ].get("gaiaIsStar", 0)
+
+    PositionMemo._shared.clear()
+    # NB: the circuit is kept closed, as searches of a failed batch may still be in flight
+    unit = _make_filter(config | {
+        "position_memo": {"max_size": 1000, "tolerance_arcsec": 0.5},
+        "cone_search_guard": {"deadline": 0.02, "hedge_quantile": None, "failure_threshold": 10**6},
+    })
+    session = unit.session
+    unit.__dict__["session"] = Unavailable()
+    # fail closed: rejected with a reason instead of raising out of the filter
+    assert [unit.process(alert) for alert in alerts[:8]] == [None] * 8
+    assert unit.process_many(alerts[8:]) == [None] * len(alerts[8:])
+    assert unit._rejections.summary()["rejected"]["gaiaUnavailable"] == reach_gaia
+
+    # rejections for lack of an answer are not memoized
+    unit.__dict__["session"] = session
+    assert [unit.process(alert) for alert in alerts[8:]] == expected[8:]
+    assert unit.process_many(alerts[:8]) == expected[:8]
+
+
+def test_alert_cache(archived_alerts, decentfilter_config):
+    from ampel.ztf.base.AlertCache import alert_cache
+
+    # channels that differ only in the interpretation of GAIA matches
+    configs = [
+        decentfilter_config | PERMISSIVE,
+        decentfilter_config | PERMISSIVE | {"gaia_pm_signif": 1, "gaia_plx_signif": 0.1},
+    ]
+    standalone = [_make_filter(config) for config in configs]
+    expected = [[unit.process(alert) for alert in archived_alerts] for unit in standalone]
+    assert expected[0] != expected[1]
+
+    channels = [_make_filter(config | {"use_alert_cache": True}) for config in configs]
+    # as AlertConsumer does, pass each alert to the filter of each channel
+    results: list[list] = [[], []]
+    for alert in archived_alerts:
+        for unit, res in zip(channels, results):
+            res.append(unit.process(alert))
+        assert len(alert_cache) <= 2, "galactic latitude and GAIA matches of this alert only"
+    assert results == expected
+
+    assert channels[0].session.requests == standalone[0].session.requests
+    assert channels[1].session.requests == 0, "GAIA matches are shared"
+
+    # scoped per thread: a filter in another thread neither sees nor drops these values
+    from threading import Thread
+
+    cached = len(alert_cache)
+    assert cached
+    seen: list[int] = []
+    def other():
+        seen.append(len(alert_cache))
+        alert_cache.enter(archived_alerts[0])
+        alert_cache.put("key", 1)
+    thread = Thread(target=other)
+    thread.start()
+    thread.join()
+    assert seen == [0]
+    assert len(alert_cache) == cached
@@ -0,0 +1,146 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from ampel.log.AmpelLogger import AmpelLogger
+from ampel.ztf.dev.FilterBacktest import OfflineCatalogSession, iter_alerts, run_backtest
+from ampel.ztf.t0.DecentFilter import DecentFilter
+
+ROOT = Path(__file__).parent.parent
+
+SOURCES = [
+    str(ROOT / "alerts" / "recent_alerts.tar.gz"),
+    str(ROOT / "alerts" / "tar.tst.gz"),
+    str(ROOT / "alerts" / "ztf_public_20180601"),
+    *sorted(str(p) for p in (ROOT / "tests" / "test-data").glob("*.tar.gz")),
+]
+
+
+@pytest.fixture
+def params():
+    with open(ROOT / "tests" / "test-data" / "decentfilter_config.yaml") as f:
+        config = yaml.safe_load(f)
+    return {
+        "default": config,
+        "loose": config | {"min_ndet": 1, "min_tspan": -1, "min_rb": 0, "max_elong": 10},
+    }
+
+
+def test_iter_alerts_shards():
+    for source in SOURCES:
+        candids = [a.datapoints[0]["candid"] for a in iter_alerts(source)]
+        shards = [
+            [a.datapoints[0]["candid"] for a in iter_alerts(source, k, 3)] for k in range(3)
+        ]
+        assert sorted(sum(shards, [])) == sorted(candids)
+
+
+def test_iter_alerts_avro_records(tmp_path):
+    import fastavro
+
+    paths = sorted((ROOT / "alerts" / "ztf_public_20180601").glob("*.avro"))[:6]
+    with open(paths[0], "rb") as f:
+        schema = fastavro.reader(f).writer_schema
+    records = []
+    for path in paths:
+        with open(path, "rb") as f:
+            records.append(next(fastavro.reader(f)))
+    source = tmp_path / "alerts.avro"
+    with open(source, "wb") as f:
+        fastavro.writer(f, schema, records)
+
+    candids = [a.datapoints[0]["candid"] for a in iter_alerts(str(source))]
+    assert len(candids) == len(records)
+    shards = [
+        [a.datapoints[0]["candid"] for a in iter_alerts(str(source), k, 3)] for k in range(3)
+    ]
+    assert all(shards), "records of a single file are spread over the shards"
+    assert sorted(sum(shards, [])) == sorted(candids)
+
+    # a truncated file is reported once, not by every shard
+    data = source.read_bytes()
+    source.write_bytes(data[: len(data) * 2 // 3])
+    truncated: list[str] = []
+    for k in range(3):
+        list(iter_alerts(str(source), k, 3, truncated))
+    assert truncated == [str(source)]
+
+
+@pytest.mark.parametrize(["processes", "batch_size"], [(0, 0), (2, 0), (2, 16)])
+def test_run_backtest(params, processes, batch_size):
+    reports = run_backtest(
+        "ampel.ztf.t0.DecentFilter",
+        params,
+        SOURCES,
+        processes=processes,
+        shards_per_source=2,
+        offline=True,
+        batch_size=batch_size,
+    )
+    assert list(reports) == ["default", "loose"]
+
+    alerts = [alert for source in SOURCES for alert in iter_alerts(source)]
+    for name, config in params.items():
+        unit = DecentFilter(**config, logger=AmpelLogger.get_logger(), resource={})
+        unit.post_init()
+        unit.__dict__["session"] = OfflineCatalogSession()
+        expected = sorted(
+            alert.datapoints[0]["candid"] for alert in alerts if unit.process(alert)
+        )
+
+        report = reports[name]
+        assert report["alerts"] == len(alerts)
+        assert report["candids"] == expected
+        assert report["accepted"] == len(expected)
+        assert report["rate"] > 0
+        assert report["cuts"]["history"]["evaluated"] == len(alerts)
+        assert sum(report["rejected"].values()) == len(alerts) - len(expected)
+        assert sum(cut["rejected"] for cut in report["cuts"].values()) == len(alerts) - len(expected)
+    assert reports["loose"]["accepted"] > reports["default"]["accepted"]
+
+
+def test_truncated_packets(params, tmp_path):
+    avro = ROOT / "tests" / "test-data" / "ZTF20abyfpze.avro"
+    data = avro.read_bytes()
+    (tmp_path / "a.avro").write_bytes(data)
+    (tmp_path / "b.avro").write_bytes(data[: len(data) // 2])
+
+    truncated: list[str] = []
+    alerts = list(iter_alerts(str(tmp_path), truncated=truncated))
+    assert len(alerts) == len(list(iter_alerts(str(avro))))
+    assert truncated == [str(tmp_path / "b.avro")]
+
+    reports = run_backtest(
+        "ampel.ztf.t0.DecentFilter",
+        {"loose": params["loose"]},
+        [str(tmp_path)],
+        processes=0,
+        shards_per_source=2,
+        offline=True,
+    )
+    assert reports["loose"]["truncated"] == 1
+    assert reports["loose"]["alerts"] == len(alerts)
+
+
+@pytest.mark.parametrize("sets", [False, True])
+def test_backtest_command(params, tmp_path, capsys, sets):
+    from ampel.cli.ZTFCommand import ZTFCommand
+
+    path = tmp_path / "params.yaml"
+    path.write_text(yaml.dump({"sets": params} if sets else params["loose"]))
+    ZTFCommand.run_backtest({
+        "unit": "ampel.ztf.t0.DecentFilter",
+        "params": str(path),
+        "alerts": [str(ROOT / "tests" / "test-data" / "ZTF20abyfpze.avro")],
+        "processes": 0,
+        "shards": 1,
+        "catalogmatch": None,
+        "offline": True,
+        "batch_size": 0,
+        "report": str(tmp_path / "report.json"),
+    })
+    with open(tmp_path / "report.json") as f:
+        reports = yaml.safe_load(f)
+    assert list(reports) == (["default", "loose"] if sets else ["default"])
+    assert capsys.readouterr().out.startswith("default: ")
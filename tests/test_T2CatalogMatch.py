@@ -174,3 +174,635 @@ def test_tnsnames(
             }
         ]
     }
+
+
+class _FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        ...
+
+    def json(self):
+        return self.body
+
+
+class _FakeSession:
+    """Answers cone searches with the requested position"""
+
+    def __init__(self):
+        self.requests = []
+
+    def post(self, url, json, **kwargs):
+        self.requests.append((url, json["ra_deg"], json["dec_deg"]))
+        return _FakeResponse([[{"body": {"ra": json["ra_deg"], "dec": json["dec_deg"]}, "dist_arcsec": 0}]])
+
+
+def test_cone_search_many(ampel_logger):
+    from ampel.ztf.base.CatalogMatchUnit import CatalogMatchUnit
+
+    matcher = CatalogMatchUnit(
+        cone_search_chunk_size=7,
+        max_concurrent_cone_searches=3,
+        logger=ampel_logger,
+        resource={"ampel-ztf/catalogmatch": "http://localhost/"},
+    )
+    matcher.__dict__["session"] = _FakeSession()
+    assert matcher._cone_search_executor._max_workers == 3
+    positions = [(float(i), -float(i)) for i in range(50)]
+    catalogs = [{"name": "TNS", "use": "extcats", "rs_arcsec": 3}]
+    results = matcher.cone_search_all_many(positions, catalogs)
+    assert [r[0][0]["body"] for r in results] == [
+        {"ra": ra, "dec": dec} for ra, dec in positions
+    ]
+    assert len(matcher.session.requests) == len(positions)
+    assert {url for url, *_ in matcher.session.requests} == {"cone_search/all"}
+
+    assert matcher.cone_search_nearest(1.0, 2.0, catalogs) == [
+        [{"body": {"ra": 1.0, "dec": 2.0}, "dist_arcsec": 0}]
+    ]
+    assert matcher.session.requests[-1] == ("cone_search/nearest", 1.0, 2.0)
+    assert matcher.cone_search_any_many([], catalogs) == []
+
+
+@pytest.fixture
+def catalogmatch_service():
+    """
+    Local stand-in for catalogmatch-service that answers cone searches with
+    the requested position after a short delay, failing the first request
+    for ra=7 with 503
+    """
+    import asyncio
+    import threading
+    from aiohttp import web
+
+    state = {"inflight": 0, "max_inflight": 0, "requests": 0, "failed": False}
+
+    async def cone_search(request):
+        payload = await request.json()
+        state["requests"] += 1
+        if payload["ra_deg"] == 7 and not state["failed"]:
+            state["failed"] = True
+            raise web.HTTPServiceUnavailable()
+        state["inflight"] += 1
+        state["max_inflight"] = max(state["max_inflight"], state["inflight"])
+        await asyncio.sleep(0.05)
+        state["inflight"] -= 1
+        return web.json_response(
+            [
+                [{"body": {"objname": f"{payload['ra_deg']:.0f}"}, "dist_arcsec": 0}]
+                if payload["ra_deg"] % 2
+                else None
+            ]
+        )
+
+    app = web.Application()
+    app.router.add_post("/catalogmatch/cone_search/{method}", cone_search)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{port}/catalogmatch/", state
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def test_tnsnames_async(mock_context: AmpelContext, ampel_logger, catalogmatch_service):
+    from requests_toolbelt.sessions import BaseUrlSession
+
+    url, state = catalogmatch_service
+    unit: TNSNames = mock_context.loader.new_context_unit(
+        UnitModel(unit="TNSNames", config={"max_parallel_cone_searches": 20}),
+        logger=ampel_logger,
+        context=mock_context,
+        sub_type=TNSNames,
+    )
+    unit.__dict__["session"] = BaseUrlSession(base_url=url)
+
+    records = [
+        AmpelBuffer(
+            {
+                "id": i,
+                "stock": StockDocument({"stock": i, "name": []}),  # type: ignore[typeddict-item]
+                "t2": [
+                    T2Document(
+                        {
+                            "unit": "T2LightCurveSummary",
+                            "meta": [{"code": DocumentCode.OK}],
+                            "body": [{"ra": i, "dec": 0}],
+                        }
+                    )
+                ],
+            }
+        )
+        for i in range(100)
+    ]
+    unit.complement(records, T3Store())
+    for i, record in enumerate(records):
+        assert record["stock"]["name"] == ((f"TNS{i}",) if i % 2 else [])
+    assert state["requests"] == len(records) + 1, "one retry"
+    assert 1 < state["max_inflight"] <= 20
+
+
+def test_cone_search_cache(mocker):
+    from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+    from ampel.ztf.base.CatalogMatchUnit import CatalogMatchUnitBase
+    from ampel.ztf.base.ConeSearchCache import ConeSearchCacheConfig
+
+    class Matcher(CatalogMatchUnitBase):
+        session = _FakeSession()
+        cone_search_cache = ConeSearchCacheConfig(max_size=3, ttl=10, negative_ttl=0)
+
+    def hits():
+        return (
+            AmpelMetricsRegistry.registry().get_sample_value(
+                "ampel_catalogmatch_cache_lookups_total",
+                {"method": "all", "outcome": "hit"},
+            )
+            or 0
+        )
+
+    matcher = Matcher()
+    catalogs = [{"name": "TNS", "use": "extcats", "rs_arcsec": 3}]
+    requests = matcher.session.requests
+    initial_hits = hits()
+
+    first = matcher.cone_search_all(10.0, 20.0, catalogs)
+    # same cell
+    assert matcher.cone_search_all(10.0 + 1e-6, 20.0, catalogs) == first
+    assert len(requests) == 1
+    assert hits() == initial_hits + 1
+
+    # positions sharing a cell are queried once
+    results = matcher.cone_search_all_many([(30.0, 0.0), (30.0, 1e-6), (10.0, 20.0)], catalogs)
+    assert results[0] == results[1] and results[2] == first
+    assert len(requests) == 2
+
+    # LRU eviction
+    for ra in (60.0, 70.0, 80.0):
+        matcher.cone_search_any(ra, 0.0, catalogs)
+    assert len(matcher._cone_search_results) == 3
+    assert all(key[0] == "any" for key in matcher._cone_search_results._entries)
+    assert len(requests) == 5
+
+    # expiry
+    monotonic = mocker.patch("time.monotonic", return_value=1e12)
+    matcher.cone_search_any(80.0, 0.0, catalogs)
+    assert len(requests) == 6
+    monotonic.return_value += 5
+    matcher.cone_search_any(80.0, 0.0, catalogs)
+    assert len(requests) == 6
+
+    # negative results are not cached with negative_ttl=0
+    mocker.patch.object(
+        matcher.session, "post", return_value=_FakeResponse([None])
+    )
+    assert matcher.cone_search_all(50.0, 0.0, catalogs) == [None]
+    assert matcher.cone_search_all(50.0, 0.0, catalogs) == [None]
+    assert matcher.session.post.call_count == 2
+
+
+def test_local_catalog(tmp_path):
+    import numpy as np
+    from ampel.ztf.base.CatalogMatchUnit import CatalogMatchUnitBase
+    from ampel.ztf.base.LocalCatalog import angular_distance_arcsec, build_local_catalog
+
+    rng = np.random.default_rng(42)
+    # sources around query positions, including the ra wrap and the poles
+    centers = [(0.0, 0.0), (359.9999, 10.0), (120.0, 89.9995), (200.0, -89.9999), (45.0, 45.0)]
+    ra = np.concatenate([(c[0] + rng.normal(0, 2e-3, 500)) % 360 for c in centers])
+    dec = np.clip(
+        np.concatenate([c[1] + rng.normal(0, 2e-3, 500) for c in centers]), -90, 90
+    )
+    data = {"RA": ra, "Dec": dec, "Mag_G": rng.uniform(10, 20, len(ra))}
+    data["Mag_G"][0] = np.nan
+    catalog = build_local_catalog(
+        data, str(tmp_path / "GAIADR2"), "GAIADR2", ra_key="RA", dec_key="Dec", order=6
+    )
+    assert len(catalog) == len(ra)
+
+    for cra, cdec in centers:
+        for rs in (1.0, 5.0, 20.0):
+            rows, dist = catalog.search(cra, cdec, rs)
+            brute = angular_distance_arcsec(cra, cdec, ra, dec)
+            assert len(rows) == (brute <= rs).sum()
+            assert np.allclose(np.sort(brute[brute <= rs]), dist)
+            assert np.allclose(np.sort(catalog._ra[rows]), np.sort(ra[brute <= rs]))
+
+    class Matcher(CatalogMatchUnitBase):
+        session = _FakeSession()
+        local_catalogs = str(tmp_path)
+
+    matcher = Matcher()
+    catalogs = [
+        {"name": "TNS", "use": "extcats", "rs_arcsec": 3},
+        {"name": "GAIADR2", "use": "catsHTM", "rs_arcsec": 5, "keys_to_append": ["Mag_G"]},
+    ]
+    results = matcher.cone_search_nearest_many([(0.0, 0.0), (90.0, 0.0)], catalogs)
+    assert [r[0][0]["body"] for r in results] == [
+        {"ra": 0.0, "dec": 0.0},
+        {"ra": 90.0, "dec": 0.0},
+    ]
+    assert matcher.session.requests == [
+        ("cone_search/nearest", 0.0, 0.0),
+        ("cone_search/nearest", 90.0, 0.0),
+    ], "only remote catalogs sent to the service"
+    brute = angular_distance_arcsec(0.0, 0.0, ra, dec)
+    nearest = np.argmin(brute)
+    expected = data["Mag_G"][nearest]
+    assert results[0][1] == {
+        "body": {"Mag_G": None if np.isnan(expected) else expected},
+        "dist_arcsec": pytest.approx(brute[nearest]),
+    }
+    assert results[1][1] is None
+
+    assert matcher.cone_search_any(45.0, 45.0, catalogs[1:]) == [True]
+    assert matcher.cone_search_all(90.0, 0.0, catalogs[1:]) == [None]
+    assert len(matcher.session.requests) == 2
+
+
+class _SlowSession:
+    """Answers cone searches after the delays in `delays`, timing out like requests"""
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.calls = 0
+
+    def post(self, url, json, timeout=None):
+        import time
+
+        delay = self.delays[min(self.calls, len(self.delays) - 1)]
+        self.calls += 1
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise requests.Timeout()
+        time.sleep(delay)
+        return _FakeResponse([[{"body": {"call": self.calls}, "dist_arcsec": 0}]])
+
+
+def test_cone_search_guard():
+    import time
+    from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+    from ampel.ztf.base.CatalogMatchUnit import CatalogMatchUnitBase
+    from ampel.ztf.base.ConeSearchGuard import ConeSearchGuardConfig, ConeSearchUnavailable
+
+    def events(event):
+        return (
+            AmpelMetricsRegistry.registry().get_sample_value(
+                "ampel_catalogmatch_guard_events_total", {"event": event}
+            )
+            or 0
+        )
+
+    class Matcher(CatalogMatchUnitBase):
+        cone_search_guard = ConeSearchGuardConfig(
+            deadline=0.3, hedge_min_samples=5, failure_threshold=2, reset_timeout=0.2
+        )
+
+    catalogs = [{"name": "TNS", "use": "extcats", "rs_arcsec": 3}]
+    initial = {
+        event: events(event)
+        for event in ("hedge", "hedge_win", "deadline", "circuit_open", "short_circuit")
+    }
+
+    # slow requests are hedged once enough latencies are known
+    matcher = Matcher()
+    matcher.session = _SlowSession([0.01] * 5 + [1.0, 0.01])
+    for _ in range(5):
+        matcher.cone_search_all(0.0, 0.0, catalogs)
+    t0 = time.monotonic()
+    assert matcher.cone_search_all(0.0, 0.0, catalogs) == [[{"body": {"call": 7}, "dist_arcsec": 0}]]
+    assert time.monotonic() - t0 < 0.2
+    assert events("hedge") == initial["hedge"] + 1
+    assert events("hedge_win") == initial["hedge_win"] + 1
+
+    # unresponsive service: fail at the deadline, then open the circuit
+    matcher = Matcher()
+    matcher.session = _SlowSession([1.0, 1.0, 0.01])
+    for _ in range(2):
+        t0 = time.monotonic()
+        with pytest.raises(ConeSearchUnavailable):
+            matcher.cone_search_any(0.0, 0.0, catalogs)
+        assert time.monotonic() - t0 < 0.5
+    assert events("deadline") == initial["deadline"] + 2
+    assert events("circuit_open") == initial["circuit_open"] + 1
+    calls = matcher.session.calls
+    with pytest.raises(ConeSearchUnavailable, match="circuit open"):
+        matcher.cone_search_any(0.0, 0.0, catalogs)
+    assert matcher.session.calls == calls, "short-circuited"
+    assert events("short_circuit") == initial["short_circuit"] + 1
+
+    # a trial request after reset_timeout closes the circuit again
+    time.sleep(0.2)
+    assert matcher.cone_search_any(0.0, 0.0, catalogs)
+    assert not matcher._cone_search_guard.is_open
+
+    # failed attempts that use up the time budget are told apart from a missed deadline
+    class Refused:
+        def post(self, url, **kwargs):
+            raise requests.ConnectionError()
+
+    matcher = Matcher()
+    matcher.session = Refused()
+    deadlines = events("deadline")
+    exhausted = events("retries_exhausted")
+    with pytest.raises(ConeSearchUnavailable, match="attempts failed"):
+        matcher.cone_search_any(0.0, 0.0, catalogs)
+    assert events("retries_exhausted") == exhausted + 1
+    assert events("deadline") == deadlines
+
+    # failing open returns results without matches
+    matcher = Matcher()
+    matcher.cone_search_guard = ConeSearchGuardConfig(deadline=0.1, fail_open=True)
+    matcher.session = _SlowSession([1.0])
+    assert matcher.cone_search_any(0.0, 0.0, catalogs) == [False]
+    assert matcher.cone_search_nearest(0.0, 0.0, catalogs) == [None]
+
+    # fallbacks are marked, and not cached in place of the answer of the recovered service
+    from ampel.ztf.base.ConeSearchCache import ConeSearchCacheConfig
+    from ampel.ztf.base.ConeSearchGuard import FallbackResult
+
+    matcher = Matcher()
+    matcher.cone_search_guard = ConeSearchGuardConfig(deadline=0.1, fail_open=True)
+    matcher.cone_search_cache = ConeSearchCacheConfig()
+    matcher.session = _SlowSession([1.0, 0.01])
+    assert isinstance(matcher.cone_search_all(0.0, 0.0, catalogs), FallbackResult)
+    assert len(matcher._cone_search_results) == 0
+    assert matcher.cone_search_all(0.0, 0.0, catalogs) == [[{"body": {"call": 2}, "dist_arcsec": 0}]]
+    assert not isinstance(matcher.cone_search_all(0.0, 0.0, catalogs), FallbackResult)
+    assert matcher.session.calls == 2, "real answers are cached"
+
+
+def test_cone_search_guard_budget(ampel_logger):
+    import time
+    from ampel.ztf.base.CatalogMatchUnit import CatalogMatchUnit
+    from ampel.ztf.base.ConeSearchGuard import (
+        ConeSearchGuard,
+        ConeSearchGuardConfig,
+        ConeSearchUnavailable,
+    )
+
+    matcher = CatalogMatchUnit(
+        max_concurrent_cone_searches=3,
+        cone_search_guard=ConeSearchGuardConfig(),
+        logger=ampel_logger,
+        resource={"ampel-ztf/catalogmatch": "http://localhost/"},
+    )
+    assert matcher._cone_search_guard._executor._max_workers == 6
+
+    # a request still queued at the deadline is never sent
+    guard = ConeSearchGuard(ConeSearchGuardConfig(deadline=0.1, hedge_quantile=None), max_workers=1)
+    guard._executor.submit(time.sleep, 0.3)
+    budgets = []
+    with pytest.raises(ConeSearchUnavailable):
+        guard.call(budgets.append, lambda: None)
+    guard._executor.shutdown(wait=True)
+    assert budgets == []
+
+    # the budget is what remains when the request starts
+    guard = ConeSearchGuard(ConeSearchGuardConfig(deadline=0.5, hedge_quantile=None), max_workers=1)
+    guard._executor.submit(time.sleep, 0.2)
+    guard.call(budgets.append, lambda: None)
+    assert len(budgets) == 1 and budgets[0] < 0.35
+
+
+def test_catalogmatchfilter_plan(mock_context: AmpelContext, ampel_logger):
+    from ampel.alert.AmpelAlert import AmpelAlert
+    from ampel.ztf.base.CatalogMatchFilter import CatalogMatchFilter
+
+    class Session:
+        """Matches catalogs whose name is in `found`"""
+
+        def __init__(self):
+            self.requests = []
+            self.found = set()
+
+        def post(self, url, json, **kwargs):
+            self.requests.append((url, [c["name"] for c in json["catalogs"]]))
+            return _FakeResponse([c["name"] in self.found for c in json["catalogs"]])
+
+    def request(name):
+        return {"name": name, "use": "catsHTM", "rs_arcsec": 3}
+
+    unit = mock_context.loader.new_logical_unit(
+        UnitModel(
+            unit="CatalogMatchFilter",
+            config={
+                "min_ndet": 2,
+                "accept": {"any_of": [request("A"), {"all_of": [request("B"), request("C")]}]},
+                "reject": {"any_of": [request("D"), request("A")]},
+            },
+        ),
+        logger=ampel_logger,
+        sub_type=CatalogMatchFilter,
+    )
+    session = unit.__dict__["session"] = Session()
+
+    def alert(ndet=2, isdiffpos="t"):
+        return AmpelAlert(
+            0, 0, [{"id": i + 1, "isdiffpos": isdiffpos, "ra": 1.0, "dec": 2.0} for i in range(ndet)]
+        )
+
+    assert not unit.process(alert(ndet=1))
+    assert not unit.process(alert(isdiffpos="f"))
+    assert session.requests == [], "local cuts decide without a cone search"
+
+    for found, accepted in [
+        (set(), False),
+        ({"B"}, False),
+        ({"B", "C"}, True),
+        ({"B", "C", "D"}, False),
+        ({"A"}, False),
+    ]:
+        session.found = found
+        assert unit.process(alert()) == accepted, found
+    assert len(session.requests) == 5, "one cone search per alert"
+    assert session.requests[0] == ("cone_search/any", ["A", "B", "C", "D"]), "distinct requests"
+    assert unit._rejections.summary() == {
+        "alerts": 7,
+        "rejected": {"nDet": 1, "isdiffpos": 1, "accept": 2, "reject": 2},
+        "histograms": {"nDet": [0, 0, 0, 0, 1] + [0] * 10},
+    }
+    unit.close()
+    assert unit._rejections.summary()["alerts"] == 0, "published on close"
+    assert unit.rejection_totals() == {"nDet": 1, "isdiffpos": 1, "accept": 2, "reject": 2}
+
+
+def test_catalogmatchfilter_unavailable(mock_context: AmpelContext, ampel_logger):
+    from ampel.alert.AmpelAlert import AmpelAlert
+    from ampel.ztf.base.CatalogMatchFilter import CatalogMatchFilter
+
+    class Refused:
+        def post(self, url, **kwargs):
+            raise requests.ConnectionError()
+
+    unit = mock_context.loader.new_logical_unit(
+        UnitModel(
+            unit="CatalogMatchFilter",
+            config={
+                "min_ndet": 1,
+                "reject": {"name": "A", "use": "catsHTM", "rs_arcsec": 3},
+                "cone_search_guard": {"deadline": 0.05, "hedge_quantile": None},
+            },
+        ),
+        logger=ampel_logger,
+        sub_type=CatalogMatchFilter,
+    )
+    unit.__dict__["session"] = Refused()
+    alert = AmpelAlert(0, 0, [{"id": 1, "isdiffpos": "t", "ra": 1.0, "dec": 2.0}])
+    # fail closed: rejected with a reason, rather than an error of the filter
+    assert unit.process(alert) is False
+    assert unit._rejections.summary()["rejected"] == {"catalogUnavailable": 1}
+
+
+def test_catalogmatchfilter_alert_cache(mock_context: AmpelContext, ampel_logger):
+    from ampel.alert.AmpelAlert import AmpelAlert
+    from ampel.ztf.base.CatalogMatchFilter import CatalogMatchFilter
+
+    class Session:
+        def __init__(self):
+            self.requests = []
+
+        def post(self, url, json, **kwargs):
+            self.requests.append([c["name"] for c in json["catalogs"]])
+            return _FakeResponse([c["name"] == "A" for c in json["catalogs"]])
+
+    def request(name):
+        return {"name": name, "use": "catsHTM", "rs_arcsec": 3}
+
+    def channel(accept, reject):
+        unit = mock_context.loader.new_logical_unit(
+            UnitModel(
+                unit="CatalogMatchFilter",
+                config={"min_ndet": 1, "accept": accept, "reject": reject, "use_alert_cache": True},
+            ),
+            logger=ampel_logger,
+            sub_type=CatalogMatchFilter,
+        )
+        unit.__dict__["session"] = Session()
+        return unit
+
+    first = channel(request("A"), request("B"))
+    second = channel({"any_of": [request("A"), request("C")]}, request("B"))
+    for i in range(2):
+        alert = AmpelAlert(i, i, [{"id": 1, "isdiffpos": "t", "ra": 1.0 + i, "dec": 2.0}])
+        assert first.process(alert)
+        assert second.process(alert)
+    assert first.session.requests == [["A", "B"]] * 2
+    assert second.session.requests == [["C"]] * 2, "only requests not made by the first channel"
+
+
+def test_t2catalogmatch_batch(mock_context: AmpelContext, mocker):
+    from ampel.ztf.t2.T2BatchWorker import T2BatchWorker
+
+    config = {
+        "catalogs": {
+            "TNS": {"use": "extcats", "rs_arcsec": 3},
+            "NED": {"use": "catsHTM", "rs_arcsec": 10},
+        }
+    }
+    mock_context.db.add_conf_id(42, config)
+
+    def nearest_many(self, positions, catalogs):
+        assert [c["name"] for c in catalogs] == ["TNS", "NED"]
+        return [
+            [{"body": {"ra": ra}, "dist_arcsec": dec}, None] for ra, dec in positions
+        ]
+
+    calls = mocker.patch.object(
+        T2CatalogMatch, "cone_search_nearest_many", autospec=True, side_effect=nearest_many
+    )
+
+    t0 = mock_context.db.get_collection("t0")
+    t2 = mock_context.db.get_collection("t2")
+    ndocs = 25
+    t0.insert_many(
+        [{"id": i, "stock": i, "body": {"ra": float(i), "dec": 0.5}} for i in range(ndocs)]
+        + [{"id": ndocs, "stock": ndocs, "body": {}}]
+    )
+    t2.insert_many(
+        [
+            {
+                "unit": "T2CatalogMatch",
+                "config": 42,
+                "link": i,
+                "stock": i,
+                "channel": ["TEST"],
+                "code": DocumentCode.NEW,
+                "meta": [],
+            }
+            for i in range(ndocs + 1)
+        ]
+    )
+
+    worker = mock_context.loader.new_context_unit(
+        UnitModel(unit="T2BatchWorker", config={"batch_size": 10, "send_beacon": False}),
+        context=mock_context,
+        process_name="t2",
+        raise_exc=True,
+        sub_type=T2BatchWorker,
+    )
+    assert worker.run() == ndocs + 1
+    assert calls.call_count == 3
+    assert [len(call.args[1]) for call in calls.call_args_list] == [10, 10, 5]
+
+    for doc in t2.find({}):
+        if doc["link"] == ndocs:
+            assert doc["code"] == DocumentCode.T2_MISSING_INFO
+            continue
+        assert doc["code"] == DocumentCode.OK
+        assert doc["body"] == [
+            {"TNS": {"dist2transient": 0.5, "ra": float(doc["link"])}, "NED": None}
+        ]
+
+
+def test_t2catalogmatch_result_store(mock_context: AmpelContext, ampel_logger):
+    class Session:
+        def __init__(self):
+            self.requests = []
+
+        def post(self, url, json, **kwargs):
+            self.requests.append([c["name"] for c in json["catalogs"]])
+            return _FakeResponse(
+                [{"body": {"name": c["name"]}, "dist_arcsec": 1.0} for c in json["catalogs"]]
+            )
+
+    session = Session()
+    # unique store config, so that other tests do not share the store
+    store = {"max_size": 12345}
+
+    def unit(*names, rs_arcsec=3):
+        unit = mock_context.loader.new_logical_unit(
+            UnitModel(
+                unit="T2CatalogMatch",
+                config={
+                    "catalogs": {
+                        name: {"use": "catsHTM", "rs_arcsec": rs_arcsec} for name in names
+                    },
+                    "result_store": store,
+                },
+            ),
+            logger=ampel_logger,
+            sub_type=T2CatalogMatch,
+        )
+        unit.__dict__["session"] = session
+        return unit
+
+    dp = DataPoint({"id": 0, "body": {"ra": 10.0, "dec": 20.0}})
+    first = unit("NED", "SDSS_spec").process(dp)
+    second = unit("SDSS_spec", "GAIA").process(dp)
+    assert session.requests == [["NED", "SDSS_spec"], ["GAIA"]]
+    assert first["SDSS_spec"] == second["SDSS_spec"] == {"dist2transient": 1.0, "name": "SDSS_spec"}
+    assert second["GAIA"] == {"dist2transient": 1.0, "name": "GAIA"}
+
+    # different radius is a different request
+    unit("GAIA", rs_arcsec=5).process(dp)
+    assert session.requests[-1] == ["GAIA"]
+    assert len(session.requests) == 3
+    unit("GAIA", "NED").process(dp)
+    assert len(session.requests) == 3
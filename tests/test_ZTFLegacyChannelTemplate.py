@@ -115,9 +115,41 @@ def test_archive_t2(logger, first_pass_config):
     directive = IngestDirective(**process["processor"]["config"]["directives"][0])
     assert isinstance(directive.filter, FilterModel)
     assert isinstance(directive.ingest.mux, MuxModel)
-    assert directive.ingest.mux.unit == "ChainedT0Muxer"
+    assert directive.ingest.mux.unit == "ZiChainedT0Muxer"
     assert len(directive.ingest.mux.config["muxers"]) == 2
+    assert "track_coverage" not in directive.ingest.mux.config["muxers"][1]["config"]
     assert len(directive.ingest.mux.combine) == 1
     assert len(units := directive.ingest.mux.combine[0].state_t2) == 2
     assert {u.unit for u in units} == {"DemoLightCurveT2Unit", "T2LightCurveSummary"}
     assert directive.ingest.combine is None
+
+
+@pytest.mark.parametrize("live_history", [True, False])
+def test_archive_track_coverage(logger, first_pass_config, live_history):
+    """
+    Coverage tracking is opt-in, and only where ZiMongoMuxer supplies the skipped points
+    """
+    template = ZTFLegacyChannelTemplate(
+        **{
+            "channel": "EXAMPLE_TNS_MSIP",
+            "contact": "ampel@desy.de",
+            "version": 0,
+            "active": True,
+            "auto_complete": False,
+            "template": "ztf_uw_public",
+            "t0_filter": {"unit": "BasicMultiFilter", "config": {"filters": []}},
+            "live_history": live_history,
+            "archive_history": 42,
+            "archive_track_coverage": True,
+        }
+    )
+    process = template.get_processes(
+        logger=logger, first_pass_config=first_pass_config
+    )[0]
+    mux = process["processor"]["config"]["directives"][0]["ingest"]["mux"]
+    if live_history:
+        assert mux["unit"] == "ZiChainedT0Muxer"
+        assert mux["config"]["muxers"][1]["config"]["track_coverage"]
+    else:
+        assert mux["unit"] == "ZiArchiveMuxer"
+        assert "track_coverage" not in mux["config"]
@@ -0,0 +1,155 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from requests_toolbelt.sessions import BaseUrlSession
+
+from ampel.model.UnitModel import UnitModel
+from ampel.ztf.ingest.ArchivePhotopointCache import ArchivePhotopointCache
+
+from .test_muxers import _make_muxer, consolidated_alert, raw_alert_dicts  # noqa: F401
+
+
+@pytest.fixture
+def archive_service(consolidated_alert):
+    """
+    Local stand-in for the archive's object/{name}/photopoints endpoint
+    """
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: float(v[0]) for k, v in parse_qs(url.query).items()}
+            requests.append((url.path, params))
+            points = [
+                pp
+                for pp in [
+                    consolidated_alert["candidate"],
+                    *consolidated_alert["prv_candidates"],
+                ]
+                if params["jd_start"] <= pp["jd"] <= params["jd_end"]
+            ]
+            body = (
+                json.dumps(
+                    {
+                        **consolidated_alert,
+                        "candidate": points[0],
+                        "prv_candidates": points[1:],
+                    }
+                )
+                if points
+                else "null"
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            ...
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/", requests
+    server.shutdown()
+    thread.join()
+
+
+@pytest.fixture
+def cached_archive_muxer(mock_context, archive_service, tmp_path):
+    url, requests = archive_service
+    muxer = _make_muxer(
+        mock_context,
+        UnitModel(
+            unit="ZiArchiveMuxer",
+            config={"history_days": 30, "cache_path": str(tmp_path / "archive.db")},
+        ),
+    )
+    muxer.__dict__["session"] = BaseUrlSession(base_url=url)
+    return muxer, requests
+
+
+def _jds(alert):
+    return sorted(
+        pp["jd"] for pp in [alert["candidate"], *alert["prv_candidates"]]
+    )
+
+
+def test_cached_photopoints(cached_archive_muxer, consolidated_alert):
+    muxer, requests = cached_archive_muxer
+    name = consolidated_alert["objectId"]
+    before_jd = consolidated_alert["candidate"]["jd"]
+
+    direct = muxer.request_photopoints(name, before_jd - 30, before_jd)
+    assert len(requests) == 1
+
+    cached = muxer.get_photopoints(name, before_jd)
+    assert len(requests) == 2
+    assert _jds(cached) == _jds(direct)
+    assert cached["candidate"]["candid"] == direct["candidate"]["candid"]
+
+    assert muxer.get_photopoints(name, before_jd) == cached
+    assert len(requests) == 2, "fully covered interval is not requested again"
+
+    # only the uncovered parts of overlapping intervals are requested
+    muxer.get_photopoints(name, before_jd - 10)
+    assert requests[-1][0] == f"/object/{name}/photopoints"
+    assert requests[-1][1] == {"jd_start": before_jd - 40, "jd_end": before_jd - 30}
+    assert len(requests) == 3
+    muxer.get_photopoints(name, before_jd + 5)
+    assert requests[-1][1] == {"jd_start": before_jd, "jd_end": before_jd + 5}
+    assert len(requests) == 4
+
+    coverage = muxer._cache._con.execute("SELECT jd_start, jd_end FROM coverage").fetchall()
+    assert coverage == [(before_jd - 40, before_jd + 5)], "intervals merged"
+
+
+def test_eviction(tmp_path, consolidated_alert):
+    alert = consolidated_alert
+    size = len(json.dumps(alert))
+    cache = ArchivePhotopointCache(str(tmp_path / "archive.db"), max_size=int(1.5 * size))
+    jd = alert["candidate"]["jd"]
+
+    for name in ("ZTF00aaaaaaa", "ZTF00aaaaaab"):
+        assert cache.get(name, jd - 1000, jd, lambda *_: alert)
+
+    names = [name for name, in cache._con.execute("SELECT name FROM objects")]
+    assert names == ["ZTF00aaaaaab"], "least recently used object evicted"
+    assert cache._missing("ZTF00aaaaaaa", jd - 1000, jd) == [(jd - 1000, jd)]
+    assert cache._missing("ZTF00aaaaaab", jd - 1000, jd) == []
+
+
+def test_recent_coverage(tmp_path, consolidated_alert, mocker):
+    """
+    Intervals are only recorded as covered up to the archive's ingestion lag,
+    also when the archive returns nothing
+    """
+    jd = consolidated_alert["candidate"]["jd"]
+    cache = ArchivePhotopointCache(str(tmp_path / "archive.db"), ingest_lag=2)
+    mocker.patch.object(cache, "_now_jd", return_value=jd + 1)
+    fetch = mocker.Mock(return_value=None)
+
+    assert cache.get("ZTF00aaaaaaa", jd - 30, jd, fetch) is None
+    assert cache._missing("ZTF00aaaaaaa", jd - 30, jd) == [(jd - 1, jd)]
+    assert cache.get("ZTF00aaaaaaa", jd - 30, jd, fetch) is None
+    assert fetch.call_args_list[-1].args == (jd - 1, jd)
+
+    # nothing is recorded for intervals entirely within the lag
+    cache.get("ZTF00aaaaaab", jd - 0.5, jd, fetch)
+    assert cache._missing("ZTF00aaaaaab", jd - 0.5, jd) == [(jd - 0.5, jd)]
+
+
+def test_latest_candidate(consolidated_alert):
+    docs = [consolidated_alert["candidate"], *consolidated_alert["prv_candidates"]]
+    latest = max(
+        (doc for doc in docs if doc.get("candid")), key=lambda doc: doc["jd"]
+    )
+    for shuffled in (docs, docs[::-1]):
+        alert = ArchivePhotopointCache._to_alert("ZTF00aaaaaaa", list(shuffled))
+        assert alert["candidate"] is latest
+        assert len(alert["prv_candidates"]) == len(docs) - 1
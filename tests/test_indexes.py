@@ -0,0 +1,146 @@
+import pytest
+from pymongo.collection import Collection
+
+from ampel.core.AmpelContext import AmpelContext
+from ampel.log.AmpelLogger import AmpelLogger
+from ampel.model.UnitModel import UnitModel
+from ampel.mongo.update.DBUpdatesBuffer import DBUpdatesBuffer
+from ampel.ztf.ingest.indexes import (
+    check_t0_indexes,
+    ensure_t0_indexes,
+    get_index_id,
+    t0_indexes,
+    t0_stock_jd_id,
+)
+from ampel.ztf.ingest.ZiArchiveMuxer import ZiArchiveMuxer
+from ampel.ztf.ingest.ZiDataPointShaper import ZiDataPointShaperBase
+from ampel.ztf.ingest.ZiMongoMuxer import ZiMongoMuxer
+
+from .test_muxers import alerts, raw_alert_dicts, t0_ingester  # noqa: F401
+
+
+def test_ensure_indexes(mock_context: AmpelContext):
+    t0 = mock_context.db.get_collection("t0", "w")
+    logger = AmpelLogger.get_logger()
+    assert check_t0_indexes(t0), "compound index not created by default"
+    assert ensure_t0_indexes(t0, logger) == check_t0_indexes(t0), "verify only"
+    assert ensure_t0_indexes(t0, logger, create=True) == []
+    assert check_t0_indexes(t0) == []
+    assert len(t0.index_information()) >= len(t0_indexes)
+
+
+def test_check_indexes_non_numeric(mock_context: AmpelContext):
+    t0 = mock_context.db.get_collection("t0", "w")
+    t0.index_information = lambda: {
+        "_id_": {"key": [("_id", 1)]},
+        "body.name_text": {"key": [("_fts", "text"), ("_ftsx", 1)]},
+        "pos_2dsphere": {"key": [("pos", "2dsphere")]},
+        "id_1": {"key": [("id", 1.0)]},
+    }
+    missing = check_t0_indexes(t0)
+    assert {"index": [("id", 1)], "args": {"unique": True}} not in missing
+    assert len(missing) == len(t0_indexes) - 1
+
+
+def _stages(plan: dict) -> list[str]:
+    """Flatten the stages of a (winning) query plan"""
+    stages = [plan["stage"]]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += _stages(plan[key])
+    for sub in plan.get("inputStages", []):
+        stages += _stages(sub)
+    return stages
+
+
+def _winning_plan(explain: dict) -> dict:
+    if "queryPlanner" in explain:
+        return explain["queryPlanner"]["winningPlan"]
+    # aggregation pipelines
+    for stage in explain.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"]["queryPlanner"]["winningPlan"]
+    raise KeyError("no query planner output in explain")
+
+
+def _index_names(plan: dict) -> list[str]:
+    """Names of the indexes scanned by a (winning) query plan"""
+    names = [plan["indexName"]] if plan["stage"] == "IXSCAN" else []
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            names += _index_names(plan[key])
+    for sub in plan.get("inputStages", []):
+        names += _index_names(sub)
+    return names
+
+
+@pytest.fixture
+def t0_with_alerts(dev_context, t0_ingester, alerts):
+    ingester, compiler = t0_ingester
+    t0 = dev_context.db.get_collection("t0", "w")
+    ensure_t0_indexes(t0, AmpelLogger.get_logger(), create=True)
+    alert_list = list(alerts())
+    for alert in alert_list:
+        compiler.add(
+            ZiDataPointShaperBase().process(alert.datapoints, stock=alert.stock),
+            channel="EXAMPLE_TNS_MSIP",
+            trace_id=0,
+        )
+    compiler.commit(ingester, 0)
+    ingester.updates_buffer.push_updates()
+    assert t0.count_documents({}) > 0
+    return t0, alert_list
+
+
+def test_get_dps_uses_index(t0_with_alerts):
+    t0, alert_list = t0_with_alerts
+    plan = _winning_plan(
+        t0.find({"stock": alert_list[0].stock}, ZiMongoMuxer.projection).explain()
+    )
+    assert "COLLSCAN" not in _stages(plan)
+
+
+@pytest.mark.parametrize("walk_jd_index", [False, True])
+def test_get_earliest_jd_uses_index(
+    dev_context: AmpelContext, t0_with_alerts, mocker, walk_jd_index
+):
+    t0, alert_list = t0_with_alerts
+    muxer = dev_context.loader.new_context_unit(
+        model=UnitModel(
+            unit="ZiArchiveMuxer",
+            config={"history_days": 30, "walk_jd_index": walk_jd_index},
+        ),
+        sub_type=ZiArchiveMuxer,
+        context=dev_context,
+        logger=AmpelLogger.get_logger(),
+        updates_buffer=DBUpdatesBuffer(
+            dev_context.db, run_id=0, logger=AmpelLogger.get_logger()
+        ),
+    )
+    stock = alert_list[-1].stock
+    datapoints = list(
+        t0.find({"stock": stock, "id": {"$gt": 0}}).sort("body.jd", -1).limit(1)
+    )
+    earliest_jd = min(
+        doc["body"]["jd"] for doc in t0.find({"stock": stock, "id": {"$gt": 0}})
+    )
+
+    find = mocker.spy(Collection, "find")
+    aggregate = mocker.spy(Collection, "aggregate")
+    assert muxer.get_earliest_jd(stock, datapoints) == earliest_jd
+
+    if walk_jd_index:
+        assert aggregate.call_count == 0
+        assert find.call_args.args[1]["tag"] == "ZTF", "tag predicate is kept"
+        plan = _winning_plan(find.spy_return.clone().explain())
+        stages = _stages(plan)
+        assert "COLLSCAN" not in stages
+        # jd order comes from the index, so the scan stops at the first match
+        assert "SORT" not in stages
+        assert _index_names(plan) == [get_index_id(t0_stock_jd_id)]
+    else:
+        assert aggregate.call_count == 1
+        explain = t0.database.command(
+            "aggregate", t0.name, pipeline=aggregate.call_args.args[1], explain=True
+        )
+        assert "COLLSCAN" not in _stages(_winning_plan(explain))
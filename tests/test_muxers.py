@@ -1,4 +1,4 @@
-import itertools, os, fastavro, pytest, before_after
+import asyncio, itertools, os, random, threading, time, fastavro, pytest, before_after
 from collections import defaultdict
 from pymongo.operations import UpdateOne
 
@@ -7,6 +7,7 @@ from ampel.dev.UnitTestAlertSupplier import UnitTestAlertSupplier
 from ampel.ingest.ChainedIngestionHandler import ChainedIngestionHandler
 from ampel.ingest.T0Compiler import T0Compiler
 from ampel.log.AmpelLogger import DEBUG, AmpelLogger
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
 from ampel.model.ingest.IngestDirective import IngestDirective
 from ampel.model.UnitModel import UnitModel
 from ampel.mongo.update.DBUpdatesBuffer import DBUpdatesBuffer
@@ -15,6 +16,9 @@ from ampel.secret.AmpelVault import AmpelVault
 from ampel.secret.DictSecretProvider import DictSecretProvider
 from ampel.ztf.alert.ZiAlertSupplier import ZiAlertSupplier
 from ampel.ztf.ingest.ZiArchiveMuxer import ZiArchiveMuxer
+from ampel.ztf.ingest.ZiMongoMuxer import ZiMongoMuxer
+from ampel.ztf.ingest.ZiAsyncMongoMuxer import ZiAsyncMongoMuxer
+from ampel.ztf.ingest.T0Snapshot import T0Snapshot
 from ampel.ztf.ingest.ZiCompilerOptions import ZiCompilerOptions
 from ampel.ztf.ingest.ZiDataPointShaper import ZiDataPointShaperBase
 from ampel.protocol.AmpelAlertProtocol import AmpelAlertProtocol
@@ -243,6 +247,149 @@ def test_integration(patch_mongo, dev_context, mock_get_photopoints, alerts):
     )
 
 
+def test_prefetch(mock_context, mock_get_photopoints, alerts):
+    """
+    Prefetched archive responses are used by process()
+    """
+    mock_archive_muxer = _make_muxer(
+        mock_context, UnitModel(unit="ZiArchiveMuxer", config={"history_days": 30})
+    )
+    get_photopoints = ZiArchiveMuxer.get_photopoints
+    batch = [
+        (ZiDataPointShaperBase().process(alert.datapoints, stock=alert.stock), alert.stock)
+        for alert in alerts()
+    ]
+    intervals = {
+        (stock, *mock_archive_muxer.get_interval(stock, dps)) for dps, stock in batch
+    }
+
+    mock_archive_muxer.prefetch(batch)
+    for future, _ in mock_archive_muxer._prefetched.values():
+        future.result()
+    assert get_photopoints.call_count == len(intervals)
+    assert set(mock_archive_muxer._prefetched) == intervals
+    assert sum(n for _, n in mock_archive_muxer._prefetched.values()) == len(batch)
+
+    dps, stock = batch[0]
+    before_jd = mock_archive_muxer.get_earliest_jd(stock, dps)
+    key = (stock, before_jd - 30, before_jd)
+    assert key in mock_archive_muxer._prefetched
+    for dps, stock in batch:
+        extended, _ = mock_archive_muxer.process(dps, stock)
+        assert len(extended) > len(dps)
+    assert get_photopoints.call_count == len(intervals), "no additional request"
+    assert not mock_archive_muxer._prefetched
+
+    # prefetch for a different interval is not used
+    dps, stock = batch[0]
+    mock_archive_muxer.prefetch([(dps, stock)])
+    future, _ = mock_archive_muxer._prefetched.pop(key)
+    future.result()
+    mock_archive_muxer._prefetched[(stock, before_jd - 31, before_jd - 1)] = future, 1
+    mock_archive_muxer.process(dps, stock)
+    assert get_photopoints.call_count == len(intervals) + 2
+    assert get_photopoints.call_args.kwargs["before_jd"] == before_jd
+
+
+def test_archive_coverage(mock_context, mocker, alerts):
+    """
+    Archive history is requested once per covered interval
+    """
+    muxer = _make_muxer(
+        mock_context,
+        UnitModel(
+            unit="ZiArchiveMuxer", config={"history_days": 30, "track_coverage": True}
+        ),
+    )
+    get_photopoints = mocker.patch.object(muxer, "get_photopoints", return_value=None)
+    get_earliest_jd = mocker.spy(muxer, "get_earliest_jd")
+
+    alert = list(alerts())[-1]
+    dps = ZiDataPointShaperBase().process(alert.datapoints, stock=alert.stock)
+    before_jd = muxer.get_earliest_alert_jd(dps)
+
+    assert muxer.process(dps, alert.stock) == (dps, dps)
+    assert get_photopoints.call_count == 1
+    assert get_earliest_jd.call_count == 1
+    muxer.updates_buffer.push_updates()
+    assert muxer.get_coverage(alert.stock) == {
+        "start": before_jd - 30,
+        "end": before_jd,
+        "earliest": before_jd,
+    }
+
+    # neither t0 nor the archive are queried again
+    assert muxer.process(dps, alert.stock) == (dps, dps)
+    assert get_photopoints.call_count == 1
+    assert get_earliest_jd.call_count == 1
+
+    # only the uncovered part is requested
+    mock_context.db.get_collection("stock").update_one(
+        {"stock": alert.stock}, {"$set": {"ztf_archive.start": before_jd - 10}}
+    )
+    assert muxer.get_interval(alert.stock, dps) == (before_jd - 30, before_jd - 10)
+
+
+def test_chained_muxers_share_t0_snapshot(mock_context, mocker, alerts):
+    """
+    Chained ZTF muxers read the t0 documents of a stock once per alert
+    """
+    directive = {
+        "channel": "EXAMPLE_TNS_MSIP",
+        "ingest": {
+            "mux": {
+                "unit": "ZiChainedT0Muxer",
+                "config": {
+                    "muxers": [
+                        {"unit": "ZiMongoMuxer"},
+                        {"unit": "ZiArchiveMuxer", "config": {"history_days": 30}},
+                    ]
+                },
+                "combine": [{"unit": "ZiT1Combiner"}],
+            },
+        },
+    }
+    handler = get_handler(mock_context, [IngestDirective(**directive)])
+    chain = next(iter(handler._mux_cache.values()))
+    mongo_muxer, archive_muxer = chain._muxers
+    threads = []
+    get_photopoints = mocker.patch.object(
+        archive_muxer,
+        "get_photopoints",
+        side_effect=lambda *args, **kwargs: threads.append(threading.current_thread().name),
+    )
+    find = mocker.spy(chain._t0_snapshot._col, "find")
+    get_dps = mocker.spy(mongo_muxer, "_get_dps")
+    aggregate = mocker.spy(archive_muxer._t0_col, "aggregate")
+
+    alert_list = list(alerts())
+    for alert in alert_list:
+        _ingest(handler, alert)
+
+    assert get_photopoints.call_count == len(alert_list)
+    assert all(name.startswith("ZiArchiveMuxer") for name in threads), "prefetched"
+    assert not archive_muxer._prefetched, "every prefetched response is used"
+    assert get_dps.call_count == 0
+    assert aggregate.call_count == 0
+    assert (
+        len([c for c in find.call_args_list if c.args[1] == ZiMongoMuxer.projection])
+        == len(alert_list)
+    ), "one t0 read per alert"
+
+    # the earliest jd is the same as from a direct query
+    alert = list(alerts())[-1]
+    dps = ZiDataPointShaperBase().process(alert.datapoints, stock=alert.stock)
+    from_snapshot = archive_muxer.get_earliest_jd(alert.stock, dps)
+    chain._t0_snapshot.reset()
+    archive_muxer.share_t0_snapshot(None)
+    assert archive_muxer.get_earliest_jd(alert.stock, dps) == from_snapshot
+
+    # the prefetch threads are shut down with the updates buffer
+    executor = archive_muxer.executor
+    handler.updates_buffer.stop()
+    assert executor._shutdown
+
+
 @pytest.fixture
 def archive_token(mock_context, monkeypatch):
     if not (token := os.environ.get("ARCHIVE_TOKEN")):
@@ -375,6 +522,17 @@ def test_superseded_candidates_serial(
     candids = [alert.datapoints[0]["candid"] for alert in alerts]
     assert candids[0] < candids[1]
 
+    def sample(name, **labels):
+        return (
+            AmpelMetricsRegistry.registry().get_sample_value(
+                f"ampel_ztf_mongomuxer_{name}", labels
+            )
+            or 0
+        )
+
+    superseded = sample("superseded_total")
+    reads = sample("time_seconds_count", phase="read")
+
     dps = [_ingest(ingestion_handler_with_mongomuxer, alert) for alert in alerts]
 
     pp_db = mock_context.db.get_collection("t0").find_one(
@@ -382,15 +540,80 @@ def test_superseded_candidates_serial(
     )
 
     assert "SUPERSEDED" in pp_db["tag"], f"{candids[0]} marked as superseded in db"
+    assert sample("superseded_total") > superseded
+    assert sample("time_seconds_count", phase="read") == reads + len(alerts)
+    assert sample("datapoints") > 0
+
+
+def test_superseded_candidates_deferred(mock_context, superseded_alerts, mocker):
+    """
+    Supersession updates of several alerts are written with a single bulk write
+    """
+    directive = {
+        "channel": "EXAMPLE_TNS_MSIP",
+        "ingest": {
+            "mux": {
+                "unit": "ZiMongoMuxer",
+                "config": {"defer_supersession": True},
+                "combine": [{"unit": "ZiT1Combiner"}],
+            },
+        },
+    }
+    handler = get_handler(mock_context, [IngestDirective(**directive)])
+    muxer = next(iter(handler._mux_cache.values()))
+    bulk_write = mocker.spy(handler.updates_buffer, "call_bulk_write")
+
+    alerts = list(reversed(list(superseded_alerts())))
+    candids = [alert.datapoints[0]["candid"] for alert in alerts]
+    for alert in alerts:
+        _ingest(handler, alert)
+
+    def supersession_writes():
+        return [
+            ops
+            for col, ops in (call.args for call in bulk_write.call_args_list)
+            if any("$elemMatch" in repr(op) for op in ops)
+        ]
+
+    t0 = mock_context.db.get_collection("t0")
+    assert supersession_writes() == []
+    assert muxer._deferred_ops
+
+    # pending updates are written by the periodic job of the updates buffer
+    handler.updates_buffer.get_scheduler().run_all()
+    assert len(supersession_writes()) == 1
+    for old in candids[:-1]:
+        assert "SUPERSEDED" in t0.find_one({"id": old})["tag"]
+    assert "SUPERSEDED" not in t0.find_one({"id": candids[-1]})["tag"]
+
+    # and when the updates buffer is stopped at the end of the run
+    _ingest(handler, alerts[0])
+    assert muxer._deferred_ids
+    writes = len(supersession_writes())
+    handler.updates_buffer.stop()
+    assert not muxer._deferred_ids
+    assert len(supersession_writes()) == writes + 1
+    assert len(handler.updates_buffer.get_scheduler().jobs) == 1, "only the autopush job is left"
 
 
 @pytest.mark.parametrize("ordering", list(itertools.permutations(range(3))))
-def test_superseded_candidates_concurrent(mock_context, superseded_alerts, ordering):
+@pytest.mark.parametrize(
+    "muxer_config",
+    [
+        {},
+        {"sorted_supersession_threshold": 0},
+        {"defer_supersession": True},
+    ],
+)
+def test_superseded_candidates_concurrent(
+    mock_context, superseded_alerts, ordering, muxer_config
+):
     directive = {
         "channel": "EXAMPLE_TNS_MSIP",
         "ingest": {
             "mux": {
                 "unit": "ZiMongoMuxer",
+                "config": muxer_config,
                 "combine": [
                     {
                         "unit": "ZiT1Combiner",
@@ -440,6 +663,8 @@ def test_superseded_candidates_concurrent(mock_context, superseded_alerts, order
             _ingest(indexes)
 
     ingest(ordering)
+    for i in ordering:
+        next(iter(ingesters[i]._mux_cache.values())).flush_supersessions()
 
     t0 = mock_context.db.get_collection("t0")
 
@@ -465,3 +690,143 @@ def test_superseded_candidates_concurrent(mock_context, superseded_alerts, order
     assert (
         "SUPERSEDED" not in t0.find_one({"id": candids[2]})["tag"]
     ), f"candid {candids[2]} not superseded"
+
+
+def _long_history(count: int, reprocessed: float = 0.05) -> list:
+    """
+    Synthetic datapoints for a single stock, a fraction of which have been
+    reprocessed (i.e. appear with more than one id at the same jd, rcid)
+    """
+    rng = random.Random(count)
+    ids = rng.sample(range(1, 2**62), count)
+    dps = []
+    for i, dp_id in enumerate(ids):
+        if dps and rng.random() < reprocessed:
+            body = dict(rng.choice(dps)["body"])
+        else:
+            body = {"jd": 2458000.5 + i * 0.01, "rcid": rng.randrange(64)}
+        # upper limits carry negative ids
+        dps.append({"id": dp_id if rng.random() < 0.5 else -dp_id, "body": body})
+    # db and alert may contain the same points
+    return dps + rng.sample(dps, count // 10)
+
+
+@pytest.mark.parametrize("count", [100, 1_000, 10_000, 50_000])
+def test_supersession_scaling(count):
+    """
+    Insertion-based and sort-based supersession resolution agree
+    """
+    dps = _long_history(count)
+    superseded, final = ZiMongoMuxer._resolve_supersessions(dps)
+    assert superseded, "some points are superseded"
+    assert ZiMongoMuxer._resolve_supersessions_sorted(dps) == (superseded, final)
+
+
+@pytest.mark.benchmark
+def test_supersession_scaling_benchmark():
+    """
+    The sort-based supersession resolution is not slower on long histories
+    """
+    dps = _long_history(50_000)
+    seconds = {}
+    for name, resolve in (
+        ("insertion", ZiMongoMuxer._resolve_supersessions),
+        ("sorted", ZiMongoMuxer._resolve_supersessions_sorted),
+    ):
+        start = time.perf_counter()
+        resolve(dps)
+        seconds[name] = time.perf_counter() - start
+    # loose bound, the sort-based resolution is ~2x faster at this size
+    assert seconds["sorted"] < 2 * seconds["insertion"]
+
+
+def test_async_muxer(mock_context, superseded_alerts, alerts, mocker):
+    """
+    Alerts for different stocks are processed concurrently, alerts for the
+    same stock in submission order
+    """
+    logger = AmpelLogger.get_logger()
+    muxer = ZiAsyncMongoMuxer(
+        max_concurrency=4,
+        context=mock_context,
+        logger=logger,
+        updates_buffer=DBUpdatesBuffer(mock_context.db, run_id=0, logger=logger),
+    )
+    shaper = ZiDataPointShaperBase()
+    batch = [
+        (shaper.process(alert.datapoints, stock=alert.stock), alert.stock)
+        for alert in itertools.chain(reversed(list(superseded_alerts())), alerts())
+    ]
+
+    started = []
+    active = set()
+    process = muxer.process
+
+    def _process(dps, stock_id):
+        assert stock_id not in active, "one alert per stock at a time"
+        active.add(stock_id)
+        started.append((stock_id, dps[0]["id"]))
+        try:
+            return process(dps, stock_id)
+        finally:
+            active.remove(stock_id)
+
+    mocker.patch.object(muxer, "process", side_effect=_process)
+
+    results = asyncio.run(muxer.process_many(batch))
+
+    assert len(results) == len(batch)
+    for (dps, _), (insert, combine) in zip(batch, results):
+        assert insert == dps, "all points are new"
+        assert combine
+    for stock in {stock for _, stock in batch}:
+        assert [dp_id for s, dp_id in started if s == stock] == [
+            dps[0]["id"] for dps, s in batch if s == stock
+        ], "alerts of the same stock processed in submission order"
+    assert not muxer._stock_locks, "locks are released"
+
+
+def test_async_muxer_shared_snapshot(mock_context, alerts, mocker):
+    """
+    Alerts are processed one at a time while a t0 snapshot is shared, and
+    close() shuts the worker threads down
+    """
+    logger = AmpelLogger.get_logger()
+    muxer = ZiAsyncMongoMuxer(
+        max_concurrency=4,
+        context=mock_context,
+        logger=logger,
+        updates_buffer=DBUpdatesBuffer(mock_context.db, run_id=0, logger=logger),
+    )
+    muxer.share_t0_snapshot(
+        T0Snapshot(mock_context.db.get_collection("t0"), muxer.projection)
+    )
+    shaper = ZiDataPointShaperBase()
+    # as if each alert belonged to a different stock
+    batch = [
+        (shaper.process(alert.datapoints, stock=i), i)
+        for i, alert in enumerate(alerts())
+    ]
+
+    active = []
+    overlaps = []
+    process = muxer.process
+
+    def _process(dps, stock_id):
+        overlaps.append(len(active))
+        active.append(stock_id)
+        try:
+            time.sleep(0.001)
+            return process(dps, stock_id)
+        finally:
+            active.remove(stock_id)
+
+    mocker.patch.object(muxer, "process", side_effect=_process)
+
+    results = asyncio.run(muxer.process_many(batch))
+    assert len(results) == len(batch)
+    assert len({stock for _, stock in batch}) > 1
+    assert not any(overlaps), "one alert at a time"
+
+    muxer.close()
+    assert muxer._executor._shutdown